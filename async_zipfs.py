@@ -1,8 +1,540 @@
 from fsspec.asyn import AsyncFileSystem
 import asyncio
 import posixpath
-from typing import List, Optional
+from collections.abc import Iterable
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional, Tuple
 import struct
+import hashlib
+import os
+import mmap
+import math
+import time
+import contextlib
+import logging
+import tempfile
+import weakref
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Central directory file header fields and their types (order matters)
+# These use exact wording from https://pkwaredownloads.blob.core.windows.net/pkware-general/Documentation/APPNOTE-6.3.9.TXT
+CD_FILE_HEADER_DTYPE = np.dtype([
+    ('central file header signature', '<u4'),
+    ('version made by', '<u2'),
+    ('version needed to extract', '<u2'),
+    ('general purpose bit flag', '<u2'),
+    ('compression method', '<u2'),
+    ('last mod file time', '<u2'),
+    ('last mod file date', '<u2'),
+    ('crc-32', '<u4'),
+    ('compressed size', '<u4'),
+    ('uncompressed size', '<u4'),
+    ('file name length', '<u2'),
+    ('extra field length', '<u2'),
+    ('file comment length', '<u2'),
+    ('disk number start', '<u2'),
+    ('internal file attributes', '<u2'),
+    ('external file attributes', '<u4'),
+    ('relative offset of local header', '<u4')
+])
+
+# Central or local file header ZIP64 extended information extra field variables, in order
+# These share names with the standard fields but are 8 bytes long
+ZIP64_FILE_HEADER_VARS = ['uncompressed size', 'compressed size', 'relative offset of local header']
+
+
+def _gather(raw: np.ndarray, positions: np.ndarray, dtype: str) -> np.ndarray:
+    """Decode little-endian values of the given dtype at the given byte positions of raw."""
+    itemsize = np.dtype(dtype).itemsize
+    return raw[positions[:, None] + np.arange(itemsize)].view(dtype).ravel()
+
+
+class ZipIndex:
+    """Compact array-backed file table of a zip file.
+
+    Entries are sorted by name and stored in NumPy arrays: names (as UTF-8
+    bytes), offsets of file data, sizes of file data (-1 for directories), and
+    the index of the parent directory of each entry (-1 for the root directory
+    which has the empty name). Lookup by name is by binary search. The children
+    of a directory are found by binary search in the entries sorted by parent.
+    """
+
+    def __init__(self, names: np.ndarray, offsets: np.ndarray, sizes: np.ndarray, parents: np.ndarray):
+        """Initialize the ZipIndex from sorted arrays. Use from_entries to build from unsorted entries."""
+        self.names = names
+        self.offsets = offsets
+        self.sizes = sizes
+        self.parents = parents
+        # Entries grouped by parent, each group in name order
+        self._children_order = np.argsort(parents, kind='stable')
+        self._children_parents = parents[self._children_order]
+
+    @classmethod
+    def from_entries(cls, names: List[bytes], offsets, sizes, path: str) -> "ZipIndex":
+        """Build a ZipIndex from entries in central directory order.
+
+        Args:
+            names: Entry names as bytes, without trailing slash for directories.
+            offsets: Offsets of file data.
+            sizes: Sizes of file data, -1 for directories.
+            path: Path of the zip file, for error messages.
+
+        If a name occurs several times, the last entry is used. The root
+        directory is created automatically.
+        """
+        names = np.array([b''] + list(names), dtype=bytes)
+        offsets = np.concatenate([[0], np.asarray(offsets, dtype=np.int64)])
+        sizes = np.concatenate([[-1], np.asarray(sizes, dtype=np.int64)])
+
+        # Sort by name, keeping only the last entry of each name
+        order = np.argsort(names, kind='stable')
+        is_last = np.append(names[order[1:]] != names[order[:-1]], True)
+        order = order[is_last]
+        names, offsets, sizes = names[order], offsets[order], sizes[order]
+
+        # Find parent directories
+        parent_names = np.array([name.rpartition(b'/')[0] for name in names], dtype=names.dtype)
+        parents = np.searchsorted(names, parent_names)
+        missing = (parents >= len(names)) | (names[np.minimum(parents, len(names) - 1)] != parent_names)
+        missing[0] = False  # Root has no parent
+        if missing.any():
+            parent = parent_names[np.argmax(missing)].decode('utf-8')
+            raise NotImplementedError(f"Autocreation of parent folder {parent} not implemented, in {path}")
+        if (sizes[parents[1:]] >= 0).any():
+            raise ValueError(f"File used as a folder in {path}")
+        parents[0] = -1
+        return cls(names, offsets, sizes, parents)
+
+    def find(self, path: str) -> int:
+        """Get the index of an entry by name, or -1 if not found."""
+        name = path.encode('utf-8')
+        index = int(np.searchsorted(self.names, name))
+        if index < len(self.names) and self.names[index] == name:
+            return index
+        return -1
+
+    def name(self, index: int) -> str:
+        """Get the name of an entry."""
+        return self.names[index].decode('utf-8')
+
+    def is_dir(self, index: int) -> bool:
+        """Check whether an entry is a directory."""
+        return self.sizes[index] < 0
+
+    def children(self, index: int) -> np.ndarray:
+        """Get the indices of the entries in a directory, in name order."""
+        start = np.searchsorted(self._children_parents, index, side='left')
+        end = np.searchsorted(self._children_parents, index, side='right')
+        return self._children_order[start:end]
+
+    def to_bytes(self) -> bytes:
+        """Serialize to a compact binary form that from_bytes loads without parsing."""
+        return (
+            struct.pack('<QQ', len(self.names), self.names.dtype.itemsize)
+            + self.offsets.astype('<i8').tobytes()
+            + self.sizes.astype('<i8').tobytes()
+            + self.parents.astype('<i8').tobytes()
+            + self.names.tobytes()
+        )
+
+    @classmethod
+    def from_bytes(cls, data: bytes, pos: int = 0) -> "ZipIndex":
+        """Deserialize from data starting at pos, as written by to_bytes.
+
+        Raises ValueError or struct.error if the data is truncated or has extra bytes.
+        """
+        num_entries, name_length = struct.unpack_from('<QQ', data, pos)
+        pos += 16
+        if len(data) - pos != num_entries*(24 + max(name_length, 1)):
+            raise ValueError(f"Invalid ZipIndex size: {len(data) - pos} bytes for {num_entries} entries")
+        arrays = []
+        for _ in range(3):
+            arrays.append(np.frombuffer(data, dtype='<i8', count=num_entries, offset=pos))
+            pos += 8*num_entries
+        names = np.frombuffer(data, dtype=f'S{max(name_length, 1)}', count=num_entries, offset=pos)
+        return cls(names, *arrays)
+
+
+def parse_central_directory(cd_data: bytes, cd_offset: int, cd_entries: int, path: str) -> ZipIndex:
+    """Parse the central directory of an uncompressed zip file into a ZipIndex.
+
+    The fixed-size headers of all entries are decoded in bulk using a NumPy
+    structured dtype. Entries are located by searching for the header
+    signature. If the hits do not chain exactly (a signature occurring inside
+    a name or an extra field), the chain of entries is walked from the start.
+    ZIP64 extended information extra fields are decoded in bulk, one extra
+    field position at a time.
+
+    Args:
+        cd_data: The central directory.
+        cd_offset: Offset of the central directory in the zip file.
+        cd_entries: Number of entries in the central directory.
+        path: Path of the zip file, for error messages.
+    """
+    raw = np.frombuffer(cd_data, dtype=np.uint8)
+    header_size = CD_FILE_HEADER_DTYPE.itemsize  # 46 bytes
+
+    # Find candidate entries by signature and decode their headers
+    positions = np.flatnonzero(
+        (raw[:-3] == 0x50) & (raw[1:-2] == 0x4b) & (raw[2:-1] == 0x01) & (raw[3:] == 0x02)
+    )
+    positions = positions[positions + header_size <= len(raw)]
+    headers = raw[positions[:, None] + np.arange(header_size)].view(CD_FILE_HEADER_DTYPE).ravel()
+    next_positions = positions + header_size + headers['file name length'] + headers['extra field length'] + headers['file comment length']
+    if not (len(positions) == cd_entries and cd_entries > 0 and positions[0] == 0 and (next_positions[:-1] == positions[1:]).all()):
+        # Walk the chain of entries
+        next_by_position = dict(zip(positions.tolist(), next_positions.tolist()))
+        chain = []
+        position = 0
+        for _ in range(cd_entries):
+            if position + header_size > len(raw):
+                raise ValueError(f"Truncated central directory entry in {path}")
+            if position not in next_by_position:
+                raise ValueError(f"Invalid central directory header signature in {path}")
+            chain.append(position)
+            position = next_by_position[position]
+        selected = np.searchsorted(positions, chain)
+        positions, headers, next_positions = positions[selected], headers[selected], next_positions[selected]
+    if cd_entries > 0 and next_positions[-1] > len(raw):
+        raise ValueError(f"Truncated central directory entry in {path}")
+
+    if ((headers['compression method'] != 0) | (headers['compressed size'] != headers['uncompressed size'])).any():
+        raise ValueError(f"File in {path} is not stored (uncompressed)")
+
+    # Decode ZIP64 extended information extra fields for values marked as ZIP64 (0xFFFFFFFF)
+    values = {var: headers[var].astype(np.int64) for var in ZIP64_FILE_HEADER_VARS}
+    marked = {var: values[var] == 0xFFFFFFFF for var in ZIP64_FILE_HEADER_VARS}
+    zip64_entries = np.flatnonzero(np.logical_or.reduce(list(marked.values())))
+    if len(zip64_entries) > 0:
+        field_positions = positions[zip64_entries] + header_size + headers['file name length'][zip64_entries]
+        extra_ends = field_positions + headers['extra field length'][zip64_entries]
+        found = np.zeros(len(zip64_entries), dtype=bool)
+        while True:
+            active = np.flatnonzero(~found & (field_positions < extra_ends))
+            if len(active) == 0:
+                break
+            if (field_positions[active] + 4 > extra_ends[active]).any():
+                raise ValueError(f"Truncated extra field in {path}")
+            tags = _gather(raw, field_positions[active], '<u2')
+            sizes = _gather(raw, field_positions[active] + 2, '<u2')
+            if (field_positions[active] + 4 + sizes > extra_ends[active]).any():
+                raise ValueError(f"Truncated extra field in {path}")
+            zip64_active = active[tags == 0x0001]
+            var_positions = field_positions[zip64_active] + 4
+            for var in ZIP64_FILE_HEADER_VARS:
+                # Only variables that were marked as ZIP64 are present
+                is_marked = marked[var][zip64_entries[zip64_active]]
+                values[var][zip64_entries[zip64_active][is_marked]] = _gather(raw, var_positions[is_marked], '<u8').astype(np.int64)
+                var_positions = var_positions + 8*is_marked
+            found[zip64_active] = True
+            field_positions[active] += 4 + sizes
+        if not found.all():
+            raise ValueError(f"Missing ZIP64 extended information extra field in {path}")
+
+    # Read file names
+    name_starts = (positions + header_size).tolist()
+    name_ends = (positions + header_size + headers['file name length']).tolist()
+    names = [cd_data[start:end] for start, end in zip(name_starts, name_ends)]
+
+    # Detect directories and remove trailing slash
+    is_dir = np.array([name.endswith(b'/') for name in names], dtype=bool)
+    names = [name[:-1] if name.endswith(b'/') else name for name in names]
+
+    # We require the files to be stored in the order of the central directory
+    # entries. File offset = next local header offset (or CD offset for the last
+    # file) - file size. This should work unless there is empty space in the zip
+    # file, which is unlikely.
+    header_offsets = values['relative offset of local header']
+    next_header_offsets = np.append(header_offsets[1:], cd_offset)
+    sizes = values['compressed size']
+    if (next_header_offsets[~is_dir] <= header_offsets[~is_dir]).any():
+        raise ValueError(f"Non-ascending order of local header offsets in {path}")
+    offsets = np.where(is_dir, 0, next_header_offsets - sizes)
+    sizes = np.where(is_dir, -1, sizes)
+    return ZipIndex.from_entries(names, offsets, sizes, path)
+
+def parse_eocd(data: bytes, path: str) -> Tuple[int, int, int]:
+    """Parse the (ZIP64) end of central directory records in the tail of a zip file.
+
+    Args:
+        data: Tail of the zip file, containing the EOCD, and the ZIP64 EOCD and
+            ZIP64 EOCD locator if present.
+        path: Path of the zip file, for error messages.
+
+    Returns:
+        Tuple of the offset, size and number of entries of the central directory.
+    """
+    if len(data) < 22:  # Minimum size for standard EOCD
+        raise ValueError(f"EOCD doesn't fit in {path}: {len(data)} bytes")
+
+    # EOCD variables and their lengths (order matters)
+    # These dicts use exact wording from https://pkwaredownloads.blob.core.windows.net/pkware-general/Documentation/APPNOTE-6.3.9.TXT
+    eocd_var_lengths = {
+        'end of central dir signature': 4,  # Signature (0x06054b50)
+        'number of this disk': 2,  # Disk number
+        'number of the disk with the start of the central directory': 2,  # Disk number of the central directory
+        'total number of entries in the central directory on this disk': 2,  # Number of entries on this disk
+        'total number of entries in the central directory': 2,  # Total number of entries
+        'size of the central directory': 4,  # Size of the central directory
+        'offset of start of central directory with respect to the starting disk number': 4,  # Offset of the start of the central directory
+        '.ZIP file comment length': 2  # Length of the comment
+    }
+
+    # ZIP64 EOCD variables and their lengths (order matters)
+    zip64_eocd_var_lengths = {
+        'zip64 end of central dir signature': 4,
+        'size of zip64 end of central directory record': 8,
+        'version made by': 2,
+        'version needed to extract': 2,
+        'number of this disk': 4,
+        'number of the disk with the start of the central directory': 4,
+        'total number of entries in the central directory on this disk': 8,
+        'total number of entries in the central directory': 8,
+        'size of the central directory': 8,
+        'offset of start of central directory with respect to the starting disk number': 8
+    }
+
+    # Map lengths to struct formats
+    var_length_to_format = {
+        2: 'H',  # Unsigned short (2 bytes)
+        4: 'L',  # Unsigned long (4 bytes)
+        8: 'Q'   # Unsigned long long (8 bytes)
+    }
+
+    # Parse EOCD
+    eocd = {}
+    is_zip64 = False
+    eocd_pos = data[:-20+4].rfind(b'\x50\x4b\x05\x06') # 20 bytes for EOCD, 4 bytes for EOCD signature
+    if eocd_pos == -1:
+        raise ValueError(f"No EOCD in the last {len(data)} bytes of {path}")
+    pos = eocd_pos
+    for var, length in eocd_var_lengths.items():
+        eocd[var] = struct.unpack_from(f'<{var_length_to_format[length]}', data, pos)[0]
+        # Check for ZIP64 values 0xFF or 0xFFFFFFFF
+        if eocd[var] == 2**(length*8) - 1:
+            eocd[var] = None
+            is_zip64 = True
+        pos += length
+    if is_zip64:
+        if len(data) - 22 < 56 + 20:  # 56 bytes for ZIP64 EOCD + 20 bytes for locator
+            raise ValueError(f"ZIP64 EOCD and ZIP64 EOCD locator do not fit in {path}")
+        # Find ZIP64 EOCD
+        zip64_eocd_pos = data[:eocd_pos-56+4].rfind(b'\x50\x4b\x06\x06') # 20 bytes for EOCD, 56 bytes for ZIP64 EOCD, 4 bytes for ZIP64 EOCD signature
+        if zip64_eocd_pos == -1:
+            raise ValueError(f"No ZIP64 EOCD in the last {len(data)} bytes of {path}")
+        pos = zip64_eocd_pos
+        for var, length in zip64_eocd_var_lengths.items():
+            eocd[var] = struct.unpack_from(f'<{var_length_to_format[length]}', data, pos)[0]
+            pos += length
+
+    # Require single-disk zip
+    if eocd['number of this disk'] != 0 or eocd['number of the disk with the start of the central directory'] != 0 or eocd['total number of entries in the central directory on this disk'] != eocd['total number of entries in the central directory']:
+        raise ValueError(f"Unsupported multi-disk central directory in {path}")
+    
+    # Convenience variables
+    cd_size = eocd['size of the central directory']
+    cd_offset = eocd['offset of start of central directory with respect to the starting disk number']
+    cd_entries = eocd['total number of entries in the central directory']
+    return cd_offset, cd_size, cd_entries
+
+
+class LatencyHistogram:
+    """A histogram of request latencies in logarithmically spaced bins.
+
+    Bin i holds latencies from min_latency * 2**((i - 1) / bins_per_octave)
+    up to min_latency * 2**(i / bins_per_octave) seconds, with bin 0 holding
+    all latencies up to min_latency and the last bin all latencies above the
+    range.
+    """
+
+    def __init__(self, min_latency: float = 1e-4, bins_per_octave: int = 4, num_bins: int = 96):
+        """Initialize the LatencyHistogram.
+
+        Args:
+            min_latency: Upper edge in seconds of the first bin.
+            bins_per_octave: Number of bins per doubling of latency.
+            num_bins: Number of bins.
+        """
+        self.min_latency = min_latency
+        self.bins_per_octave = bins_per_octave
+        self.counts = [0] * num_bins
+        self.count = 0
+        self.sum = 0.0
+
+    def upper_edge(self, bin_index: int) -> float:
+        """Get the upper edge in seconds of a bin."""
+        return self.min_latency * 2**(bin_index / self.bins_per_octave)
+
+    def record(self, latency: float):
+        """Record a latency in seconds."""
+        if latency <= self.min_latency:
+            bin_index = 0
+        else:
+            bin_index = min(math.ceil(math.log2(latency / self.min_latency) * self.bins_per_octave), len(self.counts) - 1)
+        self.counts[bin_index] += 1
+        self.count += 1
+        self.sum += latency
+
+    def quantile(self, q: float) -> float:
+        """Get an upper bound in seconds of the q-quantile of the recorded latencies."""
+        cumulative_count = 0
+        for bin_index, count in enumerate(self.counts):
+            cumulative_count += count
+            if cumulative_count >= q * self.count:
+                return self.upper_edge(bin_index)
+        return math.inf
+
+    def to_dict(self) -> dict:
+        """Get the count, mean, p50, p95 and p99 latencies, and the non-empty bins as {upper edge: count}."""
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count > 0 else None,
+            'p50': self.quantile(0.5) if self.count > 0 else None,
+            'p95': self.quantile(0.95) if self.count > 0 else None,
+            'p99': self.quantile(0.99) if self.count > 0 else None,
+            'bins': {self.upper_edge(bin_index): count for bin_index, count in enumerate(self.counts) if count > 0}
+        }
+
+
+class BlockCache:
+    """An LRU cache of fixed-size aligned blocks of a file, with a memory budget.
+
+    Reads are split into blocks of block_size bytes aligned at multiples of
+    block_size. Cached blocks are served from memory. Runs of consecutive
+    missing blocks are fetched with a single read of the underlying file, and
+    concurrent requests for a block that is already being fetched wait for
+    that fetch instead of issuing another. The fetches run in their own tasks,
+    so that a cancelled read (for example by a timeout) does not cancel a fetch
+    that other reads wait for. Least recently used blocks are evicted when the
+    cached blocks exceed max_bytes in total.
+    """
+
+    def __init__(self, fetch: Callable[[int, int], Awaitable[bytes]], block_size: int, max_bytes: int):
+        """Initialize the BlockCache.
+
+        Args:
+            fetch: Coroutine function reading the byte range [start, end) of
+                the underlying file.
+            block_size: Size of a block in bytes.
+            max_bytes: Memory budget in bytes for the cached blocks.
+        """
+        self.fetch = fetch
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._blocks = OrderedDict()  # Block index -> block data, in LRU order
+        self._cached_bytes = 0
+        self._in_flight = {}  # Block index -> future of block data
+        self._fetch_tasks = set()  # Keep references to the running fetch tasks
+
+    def stats(self) -> dict:
+        """Get block hit, miss and eviction counts and the number of cached bytes."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'cached_bytes': self._cached_bytes
+        }
+
+    def _store(self, block_index: int, data: bytes):
+        """Cache a block and evict least recently used blocks to stay within budget."""
+        if len(data) > self.max_bytes:
+            return
+        self._blocks[block_index] = data
+        self._cached_bytes += len(data)
+        while self._cached_bytes > self.max_bytes:
+            _, evicted_data = self._blocks.popitem(last=False)
+            self._cached_bytes -= len(evicted_data)
+            self.evictions += 1
+
+    async def _fetch_blocks(self, first_block: int, last_block: int):
+        """Fetch consecutive blocks with a single read and resolve their in-flight futures.
+
+        The blocks are always removed from the in-flight blocks. If the read
+        fails, the exception is set on the futures, and if it is cancelled,
+        the futures are cancelled, so that no read waits for them forever.
+        """
+        block_indices = range(first_block, last_block + 1)
+        futures = [self._in_flight[block_index] for block_index in block_indices]
+        try:
+            data = await self.fetch(first_block*self.block_size, (last_block + 1)*self.block_size)
+        except BaseException as e:
+            for block_index, future in zip(block_indices, futures):
+                del self._in_flight[block_index]
+                if isinstance(e, asyncio.CancelledError):
+                    future.cancel()
+                else:
+                    future.set_exception(e)
+                    future.exception()  # Avoid an unretrieved exception warning if nobody else waits
+            if not isinstance(e, Exception):
+                raise
+            return
+        for block_index, future in zip(block_indices, futures):
+            block_data = data[(block_index - first_block)*self.block_size:(block_index - first_block + 1)*self.block_size]
+            del self._in_flight[block_index]
+            self._store(block_index, block_data)
+            future.set_result(block_data)
+
+    async def read(self, start: int, end: int) -> bytes:
+        """Read the byte range [start, end) of the underlying file through the cache."""
+        loop = asyncio.get_running_loop()
+        first_block = start // self.block_size
+        last_block = (end - 1) // self.block_size
+
+        # Get cached blocks, register fetches for missing blocks, and wait for in-flight blocks
+        blocks = {}
+        waits = {}
+        missing = []
+        for block_index in range(first_block, last_block + 1):
+            if block_index in self._blocks:
+                self._blocks.move_to_end(block_index)
+                blocks[block_index] = self._blocks[block_index]
+                self.hits += 1
+            elif block_index in self._in_flight:
+                waits[block_index] = self._in_flight[block_index]
+                self.hits += 1
+            else:
+                self._in_flight[block_index] = loop.create_future()
+                waits[block_index] = self._in_flight[block_index]
+                missing.append(block_index)
+                self.misses += 1
+
+        # Fetch runs of consecutive missing blocks
+        runs = []
+        for block_index in missing:
+            if runs and runs[-1][1] == block_index - 1:
+                runs[-1][1] = block_index
+            else:
+                runs.append([block_index, block_index])
+        for run_first, run_last in runs:
+            task = asyncio.ensure_future(self._fetch_blocks(run_first, run_last))
+            self._fetch_tasks.add(task)
+            task.add_done_callback(self._fetch_tasks.discard)
+        for block_index, future in waits.items():
+            # Shielded, so that cancelling this read does not cancel a future that other reads wait for
+            blocks[block_index] = await asyncio.shield(future)
+
+        # Assemble the requested range
+        data = b''.join(blocks[block_index] for block_index in range(first_block, last_block + 1))
+        return data[start - first_block*self.block_size:end - first_block*self.block_size]
+
+
+def _close_mmap(file_mmap: mmap.mmap, mmap_view: memoryview):
+    """Close a memory mapping and its file descriptor, unless memoryviews of it are still in use.
+
+    Memoryviews of the mapping returned by reads keep it open, and it is
+    closed when the last of them is released.
+    """
+    try:
+        mmap_view.release()
+        file_mmap.close()
+    except BufferError:
+        pass
+
 
 class ReadOnlyZipFileSystem(AsyncFileSystem):
     """An async read-only file system for uncompressed zip files using fsspec.
@@ -33,288 +565,238 @@ class ReadOnlyZipFileSystem(AsyncFileSystem):
     directory (EOCD), the ZIP64 EOCD locator, and the standard EOCD, using
     _cat_file with negative start offset and therefore not needing to query the
     file size first. Reads the CD using _cat_file with positive start offset.
-    Parses the CD for the file names and the header offsets. Requires that the
-    CD contains an entry of each directory (except for the autogenerated root
-    dir) before the entries of their files and subdirectories. Requires that
+    Parses the CD for the file names and the header offsets, decoding the
+    fixed-size headers in bulk with NumPy, into a compact array-backed ZipIndex
+    sorted by name. Requires that the CD contains an entry of each directory
+    (except for the autogenerated root dir). Requires that
     the CD entries appear in the same order as the file headers and the files.
     Assumes that there are no gaps between file headers and files. This way the
     file headers need not be read, because the file offset will be the offset
-    of the next file header (or CD for the last file) minus the file size. File
+    of the next file header (or CD for the last file) minus the file size. If
+    a name occurs several times in the CD, the last entry is used. File
     datetimes are not available.
 
+    Byte ranges requested through _cat_ranges (for example by Zarr partial
+    reads) are mapped to absolute offsets in the zip file, and ranges that are
+    adjacent or separated by at most max_gap bytes are merged into a single
+    read of the underlying file system, up to max_block bytes per read. The
+    merged reads are issued concurrently. With batch_cat_file=True, concurrent
+    _cat_file calls are coalesced the same way, which reduces the number of
+    S3 requests when neighbouring Zarr chunks are stored next to each other in
+    the zip.
+
+    If index_cache_dir is given, the parsed file table is stored there in
+    a compact binary index cache file named by a hash of the zip file path.
+    The cache file is keyed by the path, size and ETag (or mtime) of the zip
+    file, obtained with a single _info call, and is loaded with a single read.
+    A cache file for a different version of the zip file is ignored and
+    replaced. This way, processes opening the same zip need not read and parse
+    the central directory again.
+
+    If block_cache_size is given, reads of the zip file go through an LRU
+    BlockCache of block_size-aligned blocks with a memory budget of
+    block_cache_size bytes. Concurrent requests for the same block share a
+    single read. Hit and miss counts are available from block_cache.stats().
+    This way, Zarr chunks read repeatedly, for example by overlapping patches,
+    are served from memory.
+
+    If use_mmap is True, the zip file must be in the local file system. It is
+    memory-mapped once, and reads are served as zero-copy memoryview slices of
+    the mapping, without a thread hop, file open, seek or copy per read. An
+    optional madvise hint (mmap_advice) tells the kernel whether to expect
+    random or sequential access. Usage:
+
+    ```Python
+    zipfs = ReadOnlyZipFileSystem(async_local_fs, ZIP_PATH, use_mmap=True, mmap_advice="random")
+    ```
+
+    The mapping and its file descriptor are closed by close(), or when the
+    file system is garbage collected.
+
+    Reads of the underlying file system can be limited to max_concurrency
+    at a time. With hedge_quantile, for example 0.95, a read that has not
+    finished within that quantile of the recorded read latencies is issued
+    again, and whichever copy finishes first is used. This cuts the tail of
+    read latencies on shared object storage. Read counts, bytes and latency
+    histograms for tuning these settings are available from read_stats().
+
+    Instances are not cached by fsspec (cachable = False), so that opening
+    a zip file again after it was appended to or repacked reads its new
+    central directory (or an index cache file keyed by its new version).
+
     While not currently supported, support for compressed zip files could be
     implemented by reading the file headers (ending the read at the next header
     or CD) and by decompression.
     """
     protocol = "zipfs"
+    cachable = False  # A cached instance would keep the index of the zip file from before an append or repack
     MAX_ZIP_TAIL_READ = 64 * 1024
+    DEFAULT_MAX_GAP = 256 * 1024
+    DEFAULT_MAX_BLOCK = 64 * 1024 * 1024
+    DEFAULT_BLOCK_SIZE = 1024 * 1024
+    INDEX_CACHE_MAGIC = b'ZIPIDX02'
+    INDEX_CACHE_HEADER = struct.Struct('<8sI')  # Magic, cache key length
 
-    def __init__(self, fs: AsyncFileSystem, path: str, **kwargs):
+    def __init__(self, fs: AsyncFileSystem, path: str, max_gap: int = DEFAULT_MAX_GAP, max_block: int = DEFAULT_MAX_BLOCK, batch_cat_file: bool = False, index_cache_dir: Optional[str] = None, block_cache_size: int = 0, block_size: int = DEFAULT_BLOCK_SIZE, use_mmap: bool = False, mmap_advice: Optional[str] = None, max_concurrency: Optional[int] = None, hedge_quantile: Optional[float] = None, hedge_min_samples: int = 20, **kwargs):
         """Initialize the ReadOnlyZipFileSystem.
 
         Args:
             fs: The underlying AsyncFileSystem containing the zip file.
             path: Path to the zip file in the underlying file system.
+            max_gap: Largest gap in bytes between byte ranges that are merged
+                into a single read of the underlying file system by _cat_ranges.
+            max_block: Largest size in bytes of a merged read.
+            batch_cat_file: If True, concurrent _cat_file calls (such as Zarr
+                chunk gets launched together) are queued and read coalesced
+                like in _cat_ranges.
+            index_cache_dir: Optional local folder for caching the parsed
+                central directory. If None, the index cache is not used.
+            block_cache_size: Memory budget in bytes of the block cache. If 0,
+                the block cache is not used.
+            block_size: Size in bytes of a block in the block cache.
+            use_mmap: If True, path is a path in the local file system, and
+                the zip file is memory-mapped and read through the mapping.
+            mmap_advice: Optional madvise hint for the mapping: "normal",
+                "random", "sequential" or "willneed".
+            max_concurrency: Maximum number of concurrent reads of the
+                underlying file system. If None, not limited.
+            hedge_quantile: If given, a read that takes longer than this
+                quantile (for example 0.95) of the recorded read latencies is
+                re-issued, and the first copy to finish is used.
+            hedge_min_samples: Number of recorded read latencies required
+                before reads are hedged.
             **kwargs: Additional arguments passed to AsyncFileSystem.
         """
         super().__init__(**kwargs)
         self.asynchronous = True
         self.fs = fs
         self.path = path
-        self._files = None
+        self.max_gap = max_gap
+        self.max_block = max_block
+        self.batch_cat_file = batch_cat_file
+        self.index_cache_dir = index_cache_dir
+        self.block_cache = BlockCache(self._fetch, block_size, block_cache_size) if block_cache_size > 0 else None
+        self.use_mmap = use_mmap
+        self.mmap_advice = mmap_advice
+        self._mmap = None
+        self._mmap_view = None
+        self._mmap_finalizer = None
+        self.max_concurrency = max_concurrency
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.latency_histogram = LatencyHistogram()
+        self.read_requests = 0
+        self.read_bytes = 0
+        self.hedged_requests = 0
+        self.hedge_wins = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency is not None else None
+        self._index = None
         self._lock = asyncio.Lock()
+        self._pending_reads = []
+        self._flush_tasks = set()
 
     async def _initialize(self):
-        """Initialize self._files by reading and parsing the central directory.
+        """Initialize self._index from the index cache or the central directory.
         
-        All other methods that require self._files first await this method.
-        They never modify self._files. Locking is used to ensure that the
+        All other methods that require self._index first await this method.
+        They never modify self._index. Locking is used to ensure that the
         initialization is thread-safe. The other methods need not lock
         explicitly.
         """
         async with self._lock:
-            if self._files is not None:
+            if self._index is not None:
                 return
-            # Read tail of file (up to MAX_ZIP_TAIL_READ) from the end
-            data = await self.fs._cat_file(self.path, start=-self.MAX_ZIP_TAIL_READ, end=None)
-            if len(data) < 22:  # Minimum size for standard EOCD
-                raise ValueError(f"EOCD doesn't fit in {self.path}: {len(data)} bytes")
-
-            # EOCD variables and their lengths (order matters)
-            # These dicts use exact wording from https://pkwaredownloads.blob.core.windows.net/pkware-general/Documentation/APPNOTE-6.3.9.TXT
-            eocd_var_lengths = {
-                'end of central dir signature': 4,  # Signature (0x06054b50)
-                'number of this disk': 2,  # Disk number
-                'number of the disk with the start of the central directory': 2,  # Disk number of the central directory
-                'total number of entries in the central directory on this disk': 2,  # Number of entries on this disk
-                'total number of entries in the central directory': 2,  # Total number of entries
-                'size of the central directory offset of start of central directory with respect to': 4,  # Size of the central directory
-                'the starting disk number': 4,  # Offset of the start of the central directory
-                '.ZIP file comment length': 2  # Length of the comment
-            }
-
-            # ZIP64 EOCD variables and their lengths (order matters)
-            zip64_eocd_var_lengths = {
-                'zip64 end of central dir signature': 4,
-                'size of zip64 end of central directory record': 8,
-                'version made by': 2,
-                'version needed to extract': 2,
-                'number of this disk': 4,
-                'number of the disk with the start of the central directory': 4,
-                'total number of entries in the central directory on this disk': 8,
-                'total number of entries in the central directory': 8,
-                'size of the central directory': 8,
-                'offset of start of central directory with respect to the starting disk number': 8
-            }
-
-            # Map lengths to struct formats
-            var_length_to_format = {
-                2: 'H',  # Unsigned short (2 bytes)
-                4: 'L',  # Unsigned long (4 bytes)
-                8: 'Q'   # Unsigned long long (8 bytes)
-            }
-
-            # Parse EOCD
-            eocd = {}
-            is_zip64 = False
-            eocd_pos = data[:-20+4].rfind(b'\x50\x4b\x05\x06') # 20 bytes for EOCD, 4 bytes for EOCD signature
-            if eocd_pos == -1:
-                raise ValueError(f"No EOCD in the last {self.MAX_ZIP_TAIL_READ} bytes of {self.path}")
-            pos = eocd_pos
-            for var, length in eocd_var_lengths.items():
-                eocd[var] = struct.unpack_from(f'<{var_length_to_format[length]}', data, pos)[0]
-                # Check for ZIP64 values 0xFF or 0xFFFFFFFF
-                if eocd[var] == 2**(length*8) - 1:
-                    eocd[var] = None
-                    is_zip64 = True
-                pos += length
-            if is_zip64:
-                if len(data) - 22 < 56 + 20:  # 56 bytes for ZIP64 EOCD + 20 bytes for locator
-                    raise ValueError(f"ZIP64 EOCD and ZIP64 EOCD locator do not fit in {self.path}")
-                # Find ZIP64 EOCD
-                zip64_eocd_pos = data[:eocd_pos-56+4].rfind(b'\x50\x4b\x06\x06') # 20 bytes for EOCD, 56 bytes for ZIP64 EOCD, 4 bytes for ZIP64 EOCD signature
-                if zip64_eocd_pos == -1:
-                    raise ValueError(f"No ZIP64 EOCD in the last {self.MAX_ZIP_TAIL_READ} bytes of {self.path}")
-                pos = zip64_eocd_pos
-                for var, length in zip64_eocd_var_lengths.items():
-                    eocd[var] = struct.unpack_from(f'<{var_length_to_format[length]}', data, pos)[0]
-                    pos += length
-
-            # Require single-disk zip
-            if eocd['number of this disk'] != 0 or eocd['number of the disk with the start of the central directory'] != 0 or eocd['total number of entries in the central directory on this disk'] != eocd['total number of entries in the central directory']:
-                raise ValueError(f"Unsupported multi-disk central directory in {self.path}")
-            
-            # Convenience variables
-            cd_size = eocd['size of the central directory']
-            cd_offset = eocd['offset of start of central directory with respect to the starting disk number']
-            cd_entries = eocd['total number of entries in the central directory']
-
-            # Read and parse central directory
-            if cd_size == 0:
-                # No central directory, empty zip file
-                return
-            cd_data = await self.fs._cat_file(self.path, start=cd_offset, end=cd_offset + cd_size)
-            # Save data to file
-
-            if len(cd_data) != cd_size:
-                raise ValueError(f"Failed to read central directory: expected {cd_size} bytes, got {len(cd_data)}")
-
-            # Central directory file header variables and their lengths
-            cd_file_header_var_lengths = {
-                'central file header signature': 4,
-                'version made by': 2,
-                'version needed to extract': 2,
-                'general purpose bit flag': 2,
-                'compression method': 2,
-                'last mod file time': 2,
-                'last mod file date': 2,
-                'crc-32': 4,
-                'compressed size': 4,
-                'uncompressed size': 4,
-                'file name length': 2,
-                'extra field length': 2,
-                'file comment length': 2,
-                'disk number start': 2,
-                'internal file attributes': 2,
-                'external file attributes': 4,
-                'relative offset of local header': 4
-            }
-
-            # Central or local file header ZIP64 extended information extra field variables and their lengths
-            # These share names with the standard fields but have different lengths
-            zip64_file_header_var_lengths = {
-                'uncompressed size': 8,
-                'compressed size': 8,
-                'relative offset of local header': 8,
-                'disk number start': 4
-            }
-            
-            # Autocreate root dir
-            self._files = {
-                '': {
-                    'children': []
-                }
-            }
-
-            # Parse central directory entries
-            pos = 0
-            previous_file = None
-            for file_index in range(cd_entries):
-                if pos + 46 > len(cd_data):  # 46 bytes for the central directory file header
-                    raise ValueError(f"Truncated central directory entry in {self.path}")
-                cd_file_header = {}
-                for var, length in cd_file_header_var_lengths.items():
-                    cd_file_header[var] = struct.unpack_from(f'<{var_length_to_format[length]}', cd_data, pos)[0]
-                    # Check for ZIP64 values 0xFF or 0xFFFFFFFF
-                    if cd_file_header[var] == 2**(length*8) - 1:
-                        cd_file_header[var] = None
-                    pos += length
-                if cd_file_header['central file header signature'] != 0x02014b50:
-                    raise ValueError(f"Invalid central directory header signature in {self.path}")
-                if cd_file_header['compression method'] != 0 or cd_file_header['compressed size'] != cd_file_header['uncompressed size']:
-                    raise ValueError(f"File in {self.path} is not stored (uncompressed)")
-                utf8 = cd_file_header['general purpose bit flag'] & 0x800 != 0 # Bit 11
-
-                # Convenience variables
-                fname_len = cd_file_header['file name length']
-                extra_len = cd_file_header['extra field length']
-                comment_len = cd_file_header['file comment length']
-
-                # Read filename
-                if pos + fname_len > len(cd_data):
-                    raise ValueError(f"Truncated filename in {self.path}")
-                if utf8:
-                    fname = cd_data[pos:pos+fname_len].decode('utf-8')
-                else:
-                    fname = cd_data[pos:pos+fname_len].decode('ascii')
-                pos += fname_len
-
-                # Parse extra field
-                extra_end = pos + extra_len
-                if extra_end > len(cd_data):
-                    raise ValueError(f"Truncated extra field in {self.path}")
-                while pos < extra_end:
-                    if pos + 4 > extra_end:
-                        raise ValueError(f"Truncated extra field in {self.path}")
-                    tag, size = struct.unpack_from('<HH', cd_data, pos)
-                    pos += 4
-                    if pos + size > extra_end:
-                        raise ValueError(f"Truncated extra field in {self.path}")
-                    backup_pos = pos
-                    if tag == 0x0001:
-                        # ZIP64 extended information extra field
-                        for var, length in zip64_file_header_var_lengths.items():
-                            # Only parse variables that were marked as ZIP64
-                            if cd_file_header[var] is None:
-                                cd_file_header[var] = struct.unpack_from(f'<{var_length_to_format[length]}', cd_data, pos)[0]
-                                pos += length
-                    else:
-                        if tag == 0x5455:
-                            # Extended Timestamp, not handled
-                            None
-                        elif tag == 0x7875:
-                            # Info-ZIP New Unix Extra Field, skip it
-                            None
-                        else:
-                            # Unknown extra field, skip it
-                            None
-                        pos += size                     
-                        if backup_pos + size != pos:
-                            raise ValueError(f"Invalid extra field size in {self.path}")
-                    pos = backup_pos + size
-
-                # Convenience variables
-                size = cd_file_header['compressed size']
-                offset = cd_file_header['relative offset of local header']
-
-                # Skip comment
-                pos += comment_len
-
-                # Detect directory
-                is_dir = fname.endswith('/')
-                if is_dir:
-                    # Remove trailing slash
-                    fname = fname[:-1]
-
-                # Store file info
-                if is_dir:
-                    # Dirs can be recognized by key 'children' existing
-                    file = {
-                        'children': []
-                    }
-                else:
-                    # It's a file
-                    file = {
-                        'size': size,
-                        'offset': offset
-                    }
-                self._files[fname] = file
-
-                # Add file as the parent directory's child
-                if fname != '':
-                    parent = posixpath.dirname(fname)
-                    if parent not in self._files:
-                        raise NotImplementedError("Autocreation of parent folder {parent} not implemented, in {self.path}")
-                    self._files[parent]['children'].append(fname)
-
-                # Calculate offset of previous file
-                if previous_file is not None and 'children' not in previous_file:
-                    # We require the files to be stored in the order of the central directory entries,
-                    # although sorting would be an option
-                    if offset <= previous_file['offset']:
-                        raise ValueError(f"Non-ascending order of local header offsets in {self.path}")
-                    # Previous file's offset = current file's offset - previous file's size
-                    # This should work unless there is empty space in the zip file, which is unlikely.
-                    previous_file['offset'] = offset - previous_file['size']
-
-                previous_file = file
-
-            # Calculate offset of previous file
-            if previous_file is not None and 'children' not in previous_file:
-                if cd_offset <= previous_file['offset']:
-                    raise ValueError(f"Non-ascending order of local header offsets in {self.path}")
-                # Last file ends where central directory begins
-                previous_file['offset'] = cd_offset - previous_file['size']
+            if self.index_cache_dir is not None:
+                # Try to load the file table from the index cache
+                cache_key = await self._get_index_cache_key()
+                self._index = self._load_index_cache(cache_key)
+                if self._index is not None:
+                    return
+            await self._read_central_directory()
+            if self.index_cache_dir is not None and self._index is not None:
+                self._save_index_cache(cache_key)
+
+    async def _read_central_directory(self):
+        """Initialize self._index by reading and parsing the central directory of the zip file."""
+        # Read tail of file (up to MAX_ZIP_TAIL_READ) from the end
+        data = await self.fs._cat_file(self.path, start=-self.MAX_ZIP_TAIL_READ, end=None)
+        cd_offset, cd_size, cd_entries = parse_eocd(data, self.path)
+
+        # Read and parse central directory
+        if cd_size == 0:
+            # No central directory, empty zip file
+            self._index = ZipIndex.from_entries([], [], [], self.path)
+            return
+        cd_data = await self.fs._cat_file(self.path, start=cd_offset, end=cd_offset + cd_size)
+
+        if len(cd_data) != cd_size:
+            raise ValueError(f"Failed to read central directory: expected {cd_size} bytes, got {len(cd_data)}")
+
+        self._index = parse_central_directory(cd_data, cd_offset, cd_entries, self.path)
+
+    def _get_index_cache_path(self) -> str:
+        """Get the path of the index cache file of the zip file."""
+        path_hash = hashlib.sha256(f"{self.fs.protocol}:{self.path}".encode('utf-8')).hexdigest()
+        return os.path.join(self.index_cache_dir, f"{path_hash}.zipidx")
+
+    async def _get_index_cache_key(self) -> bytes:
+        """Get a key that changes when the zip file changes: its path, size and ETag or mtime."""
+        info = await self.fs._info(self.path)
+        version = info.get('ETag', info.get('etag', info.get('mtime', info.get('LastModified'))))
+        return f"{self.path}\n{info['size']}\n{version}".encode('utf-8')
+
+    def _load_index_cache(self, cache_key: bytes) -> Optional["ZipIndex"]:
+        """Load the file table from the index cache file with a single read.
+
+        Returns None if there is no cache file, if it was created for
+        a different version of the zip file, as told by cache_key, or if it
+        cannot be read or decoded (for example if it is truncated), so that
+        the central directory is parsed instead.
+        """
+        cache_path = self._get_index_cache_path()
+        try:
+            with open(cache_path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning("Ignoring unreadable index cache file %s: %s", cache_path, e)
+            return None
+        if len(data) < self.INDEX_CACHE_HEADER.size:
+            return None
+        magic, key_len = self.INDEX_CACHE_HEADER.unpack_from(data, 0)
+        pos = self.INDEX_CACHE_HEADER.size
+        if magic != self.INDEX_CACHE_MAGIC or data[pos:pos+key_len] != cache_key:
+            return None
+        try:
+            return ZipIndex.from_bytes(data, pos + key_len)
+        except (struct.error, ValueError) as e:
+            logger.warning("Ignoring corrupt index cache file %s: %s", cache_path, e)
+            return None
+
+    def _save_index_cache(self, cache_key: bytes):
+        """Save the file table to the index cache file, atomically replacing any old cache file."""
+        data = (
+            self.INDEX_CACHE_HEADER.pack(self.INDEX_CACHE_MAGIC, len(cache_key))
+            + cache_key
+            + self._index.to_bytes()
+        )
+        cache_path = self._get_index_cache_path()
+        os.makedirs(self.index_cache_dir, exist_ok=True)
+        # A unique temporary file per writer, so that concurrent threads and processes do not collide
+        with tempfile.NamedTemporaryFile(dir=self.index_cache_dir, prefix=f"{os.path.basename(cache_path)}.", suffix='.tmp', delete=False) as file:
+            file.write(data)
+        try:
+            os.replace(file.name, cache_path)
+        except OSError:
+            os.remove(file.name)
+            raise
+
+    @staticmethod
+    def _normalize_path(path: str) -> str:
+        """Convert a path to the internal form without root or trailing slash."""
+        path = posixpath.normpath(path).lstrip('/').rstrip('/')
+        return '' if path == '.' else path
 
     async def _ls(self, path: str, detail: bool = True, **kwargs) -> List:
         """ List files and directories in the given path.
@@ -322,16 +804,17 @@ class ReadOnlyZipFileSystem(AsyncFileSystem):
         If the path points to a file, list just the file.
         """
 
-        # Always await self._initialize() in functions needing self._files
+        # Always await self._initialize() in functions needing self._index
         await self._initialize()
         
         # Internally we don't use a root slash, so strip it. Also strip any trailing slash.
-        path = posixpath.normpath(path).lstrip('/').rstrip('/')
+        path = self._normalize_path(path)
 
         # Helper function to get file name or details
-        def get_file_listing(file, fname, detail):
+        def get_file_listing(index, detail):
+            fname = self._index.name(index)
             if detail:
-                if 'children' in file:
+                if self._index.is_dir(index):
                     return {
                         'name': f'/{fname}',
                         'type': 'directory',
@@ -343,7 +826,7 @@ class ReadOnlyZipFileSystem(AsyncFileSystem):
                     return {
                             'name': f'/{fname}',
                             'type': 'file',
-                            'size': file['size'],
+                            'size': int(self._index.sizes[index]),
                             'created': None,
                             'islink': False
                     }
@@ -351,38 +834,55 @@ class ReadOnlyZipFileSystem(AsyncFileSystem):
                 return f'/{fname}'
 
         # List children
-        results = []
-        if path not in self._files:
+        index = self._index.find(path)
+        if index < 0:
             raise FileNotFoundError(f"Path {path} not found")
-        file = self._files[path]
-        if 'children' in file:
+        if self._index.is_dir(index):
             # Path points to a dir
-            for child in file['children']:
-                results.append(get_file_listing(self._files[child], child, detail))
+            results = [get_file_listing(child, detail) for child in self._index.children(index)]
         else:
             # Path points to a file
-            results = [get_file_listing(file, path, detail)]
+            results = [get_file_listing(index, detail)]
         return results
 
-    async def _cat_file(self, path: str, start: Optional[int] = None, end: Optional[int] = None, **kwargs) -> bytes:
-        """Read the contents of a file in the zip."""
-
-        # Always await self._initialize() in functions needing self._files
-        await self._initialize()
+    def _locate(self, path: str) -> Tuple[int, int]:
+        """Get the offset and size of a file in the zip, raising FileNotFoundError if not a file."""
 
         # Internally we don't use a root slash, so strip it. Also strip any trailing slash.
-        path = posixpath.normpath(path).lstrip('/').rstrip('/')
+        path = self._normalize_path(path)
 
         # Check if the file is available
-        if path not in self._files:
+        index = self._index.find(path)
+        if index < 0:
             raise FileNotFoundError(f"File {path} not found")
-        elif 'children' in self._files[path]:
+        elif self._index.is_dir(index):
             raise FileNotFoundError(f"{path} is a directory")
-        
-        # Get offset and size of the file in the zip file
-        info = self._files[path]
-        offset = info['offset']
-        size = info['size']
+        return int(self._index.offsets[index]), int(self._index.sizes[index])
+
+    async def _list_members(self) -> Tuple[List[str], List[str], np.ndarray, np.ndarray]:
+        """List the directories, and the files with their offsets and sizes in the zip file.
+
+        Returns:
+            Tuple of directory names, file names, file offsets and file sizes,
+            with the files in ascending order of offset.
+        """
+
+        # Always await self._initialize() in functions needing self._index
+        await self._initialize()
+
+        is_dir = self._index.sizes < 0
+        dir_names = [name.decode('utf-8') for name in self._index.names[is_dir]]
+        file_indices = np.flatnonzero(~is_dir)
+        file_indices = file_indices[np.argsort(self._index.offsets[file_indices], kind='stable')]
+        file_names = [name.decode('utf-8') for name in self._index.names[file_indices]]
+        return dir_names, file_names, self._index.offsets[file_indices], self._index.sizes[file_indices]
+
+    @staticmethod
+    def _clamp_range(size: int, start: Optional[int], end: Optional[int]) -> Tuple[int, int]:
+        """Convert a file-relative (start, end) to a clamped range within [0, size].
+
+        Returns an empty range (start == end) if nothing is to be read.
+        """
 
         # Set start to beginning of file if not specified
         start = start or 0
@@ -398,14 +898,464 @@ class ReadOnlyZipFileSystem(AsyncFileSystem):
         if end < 0:
             end = max(0, size + end)  # Clamp too large negative start to the beginning of file
 
-        # For start beyond the end of the file or the end, return empty data
+        # For start beyond the end of the file or the end, return empty range
         if start >= size or end <= start:
+            return 0, 0
+
+        return start, min(end, size)  # Clamp too large end at size
+
+    async def _read(self, start: int, end: int) -> bytes:
+        """Read the absolute byte range [start, end) of the zip file, through the block cache if enabled."""
+        if self.block_cache is not None:
+            return await self.block_cache.read(start, end)
+        return await self._fetch(start, end)
+
+    async def _fetch(self, start: int, end: int) -> bytes:
+        """Read the absolute byte range [start, end) of the zip file from the underlying file system.
+
+        If use_mmap is True, returns a zero-copy memoryview of the memory-mapped zip file instead.
+        """
+        if self.use_mmap:
+            if self._mmap is None:
+                self._open_mmap()
+            return self._mmap_view[start:end]
+        if self.hedge_quantile is None or self.latency_histogram.count < self.hedge_min_samples:
+            return await self._timed_fetch(start, end)
+        return await self._hedged_fetch(start, end)
+
+    async def _timed_fetch(self, start: int, end: int, started: Optional[asyncio.Event] = None) -> bytes:
+        """Read from the underlying file system, recording the latency, the request and the bytes.
+
+        Waits for a free slot if max_concurrency is given, and then sets the
+        optional started event. The latency is measured from the start of the
+        read. If the read is cancelled, for example because the other copy of
+        a hedged read finished first, the time until cancellation is recorded
+        as a lower bound of its latency, so that slow reads still count in the
+        hedge quantile.
+        """
+        async with self._semaphore if self._semaphore is not None else contextlib.nullcontext():
+            if started is not None:
+                started.set()
+            request_start = time.perf_counter()
+            try:
+                data = await self.fs._cat_file(self.path, start=start, end=end)
+            except asyncio.CancelledError:
+                self.latency_histogram.record(time.perf_counter() - request_start)
+                raise
+            self.latency_histogram.record(time.perf_counter() - request_start)
+            self.read_requests += 1
+            self.read_bytes += len(data)
+            return data
+
+    async def _hedged_fetch(self, start: int, end: int) -> bytes:
+        """Read from the underlying file system, re-issuing the read if it is slower than the hedge quantile.
+
+        Both copies count towards max_concurrency. The hedge quantile is
+        counted from the start of the read, not including the wait for a free
+        slot. Whichever copy is still in flight when the read returns, fails
+        or is cancelled is cancelled.
+        """
+        threshold = self.latency_histogram.quantile(self.hedge_quantile)
+        started = asyncio.Event()
+        first = asyncio.ensure_future(self._timed_fetch(start, end, started))
+        pending = {first}
+        try:
+            started_wait = asyncio.ensure_future(started.wait())
+            try:
+                await asyncio.wait({first, started_wait}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                started_wait.cancel()
+            done, pending = await asyncio.wait(pending, timeout=threshold)
+            if done:
+                return first.result()
+            self.hedged_requests += 1
+            second = asyncio.ensure_future(self._timed_fetch(start, end))
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+            # Both copies failed
+            return first.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def read_stats(self) -> dict:
+        """Get statistics of reads of the underlying file system.
+
+        Returns the number of read requests and bytes read, the number of
+        hedged reads and how many of them were won by the hedged copy, the
+        read latency histogram, and the block cache statistics if enabled.
+        """
+        return {
+            'requests': self.read_requests,
+            'bytes': self.read_bytes,
+            'hedged_requests': self.hedged_requests,
+            'hedge_wins': self.hedge_wins,
+            'latency': self.latency_histogram.to_dict(),
+            'block_cache': self.block_cache.stats() if self.block_cache is not None else None
+        }
+
+    def _open_mmap(self):
+        """Memory-map the local zip file and apply the madvise hint."""
+        with open(self.path, 'rb') as file:
+            file_mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        mmap_view = memoryview(file_mmap)
+        # The finalizer must not refer to self, so that it runs when self is garbage collected
+        self._mmap_finalizer = weakref.finalize(self, _close_mmap, file_mmap, mmap_view)
+        self._mmap = file_mmap
+        self._mmap_view = mmap_view
+        if self.mmap_advice is not None:
+            advice = getattr(mmap, f'MADV_{self.mmap_advice.upper()}', None)
+            if advice is None:
+                self.close()
+                raise ValueError(f"Unsupported mmap advice {self.mmap_advice}")
+            file_mmap.madvise(advice)
+
+    def close(self):
+        """Close the memory mapping of the zip file and its file descriptor, if any.
+
+        A later read maps the zip file again. If memoryviews returned by reads
+        are still in use, the mapping is closed when the last of them is
+        released.
+        """
+        if self._mmap_finalizer is not None:
+            self._mmap_finalizer()
+        self._mmap = None
+        self._mmap_view = None
+        self._mmap_finalizer = None
+
+    async def _read_coalesced(self, ranges: List[Tuple[int, int]], max_gap: Optional[int] = None, max_block: Optional[int] = None) -> List[bytes]:
+        """Read many absolute byte ranges of the zip file using as few reads as possible.
+
+        Ranges that are adjacent or separated by at most max_gap bytes are
+        merged into a single read, as long as the merged read does not exceed
+        max_block bytes. A single range larger than max_block is read as is.
+        The merged reads are issued concurrently and the results are sliced
+        back out in the order of the requested ranges.
+        """
+        max_gap = self.max_gap if max_gap is None else max_gap
+        max_block = self.max_block if max_block is None else max_block
+
+        # Merge ranges in ascending order of start offset
+        order = sorted((index for index, (start, end) in enumerate(ranges) if end > start), key=lambda index: ranges[index])
+        blocks = []  # List of [block start, block end, list of range indices]
+        for index in order:
+            start, end = ranges[index]
+            if blocks and start - blocks[-1][1] <= max_gap and max(end, blocks[-1][1]) - blocks[-1][0] <= max_block:
+                blocks[-1][1] = max(end, blocks[-1][1])
+                blocks[-1][2].append(index)
+            else:
+                blocks.append([start, end, [index]])
+
+        # Read merged blocks concurrently
+        block_datas = await asyncio.gather(*[self._read(block_start, block_end) for block_start, block_end, _ in blocks])
+
+        # Slice the requested ranges out of the blocks
+        results = [b''] * len(ranges)
+        for (block_start, block_end, indices), block_data in zip(blocks, block_datas):
+            if len(block_data) != block_end - block_start:
+                raise ValueError(f"Short read from {self.path}: expected {block_end - block_start} bytes, got {len(block_data)}")
+            for index in indices:
+                start, end = ranges[index]
+                results[index] = block_data[start - block_start:end - block_start]
+        return results
+
+    async def _cat_file(self, path: str, start: Optional[int] = None, end: Optional[int] = None, **kwargs) -> bytes:
+        """Read the contents of a file in the zip."""
+
+        # Always await self._initialize() in functions needing self._index
+        await self._initialize()
+
+        # Get offset and size of the file in the zip file
+        offset, size = self._locate(path)
+
+        # Clamp the read to the file
+        start, end = self._clamp_range(size, start, end)
+        if start == end:
             return b''
 
-        # Calculate zip file read start and read size
+        # Calculate zip file read start and read end
         read_start = offset + start
-        read_size = min(end, size) - start  # Clamp too large end at size
+        read_end = offset + end
+
+        # Read data, possibly together with other concurrent reads
+        if self.batch_cat_file:
+            return await self._batched_read(read_start, read_end)
+        return await self._read(read_start, read_end)
+
+    async def _batched_read(self, start: int, end: int) -> bytes:
+        """Queue an absolute byte range to be read together with other concurrent reads.
+
+        The first queued read schedules a flush to run after all tasks that are
+        already ready to run in the event loop. Those tasks, for example Zarr
+        chunk gets launched together by asyncio.gather, get to queue their
+        reads before the flush, which reads all queued ranges coalesced.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self._pending_reads:
+            loop.call_soon(self._flush_batched_reads)
+        self._pending_reads.append((start, end, future))
+        return await future
+
+    def _flush_batched_reads(self):
+        """Start a task that reads all queued ranges coalesced and resolves their futures."""
+        pending_reads = self._pending_reads
+        self._pending_reads = []
+
+        async def read_pending():
+            try:
+                datas = await self._read_coalesced([(start, end) for start, end, _ in pending_reads])
+            except Exception as e:
+                for _, _, future in pending_reads:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, _, future), data in zip(pending_reads, datas):
+                    if not future.done():
+                        future.set_result(data)
+
+        task = asyncio.ensure_future(read_pending())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _cat_ranges(self, paths: List[str], starts, ends, max_gap: Optional[int] = None, on_error: str = "return", **kwargs) -> List:
+        """Read byte ranges of one or more files in the zip, coalescing nearby ranges.
 
-        # Read data
-        data = await self.fs._cat_file(self.path, start=read_start, end=read_start+read_size)
-        return data
\ No newline at end of file
+        Args:
+            paths: List of file paths in the zip.
+            starts: Start offset for each path, or a single start offset for all.
+            ends: End offset for each path, or a single end offset for all.
+            max_gap: Largest gap in bytes between ranges that are merged into
+                a single read. Defaults to self.max_gap.
+            on_error: If "return", exceptions are placed in the output list at
+                the position of the failed range. Otherwise the first exception
+                is raised.
+
+        Returns:
+            List of bytes objects (or exceptions), one per requested range.
+        """
+
+        # Always await self._initialize() in functions needing self._index
+        await self._initialize()
+
+        if not isinstance(paths, list):
+            raise TypeError("paths must be a list")
+        if not isinstance(starts, Iterable):
+            starts = [starts] * len(paths)
+        if not isinstance(ends, Iterable):
+            ends = [ends] * len(paths)
+        if len(starts) != len(paths) or len(ends) != len(paths):
+            raise ValueError("paths, starts and ends must have equal lengths")
+
+        # Map file-relative ranges to absolute ranges in the zip file
+        results = [b''] * len(paths)
+        ranges = []
+        range_indices = []
+        for index, (path, start, end) in enumerate(zip(paths, starts, ends)):
+            try:
+                offset, size = self._locate(path)
+            except FileNotFoundError as e:
+                if on_error != "return":
+                    raise
+                results[index] = e
+                continue
+            start, end = self._clamp_range(size, start, end)
+            if start < end:
+                ranges.append((offset + start, offset + end))
+                range_indices.append(index)
+
+        # Read coalesced
+        try:
+            datas = await self._read_coalesced(ranges, max_gap=max_gap)
+        except Exception as e:
+            if on_error != "return":
+                raise
+            datas = [e] * len(ranges)
+        for index, data in zip(range_indices, datas):
+            results[index] = data
+        return results
+
+
+class ShardedZipFileSystem(AsyncFileSystem):
+    """An async read-only union file system of several zip files using fsspec.
+
+    Mounts a set of ReadOnlyZipFileSystem shards, for example one zipped Zarr
+    per tile-year or per band group, under a single hierarchy. Each shard is
+    mounted at a mount path. Several shards can share a mount path, in which
+    case their contents are merged, and a name in several shards resolves to
+    the shard listed last. Zarr usage:
+
+    ```Python
+    shards = [
+        ("35VLH/2024", ReadOnlyZipFileSystem(s3, f"{S3_BUCKET}/35VLH_2024.zip")),
+        ("35VLH/2025", ReadOnlyZipFileSystem(s3, f"{S3_BUCKET}/35VLH_2025.zip"))
+    ]
+    zipfs = ShardedZipFileSystem(shards)
+    zarr_store = zarr.storage.FsspecStore(fs=zipfs, read_only=True, path="")
+    ```
+
+    The shards are initialized lazily. A path under the mount path of only
+    one shard is routed to that shard directly, initializing only that shard.
+    Other paths, and listings, need the merged index, for which the central
+    directories of all shards are initialized concurrently. The merged index
+    is a ZipIndex of all entries with their mount paths, with the shard
+    number in place of the offset. Reads of several paths by _cat_ranges are
+    grouped by shard, and the groups are read concurrently, each coalesced by
+    its shard. Because the shards are separate zip files, each can be staged
+    or downloaded separately, in parallel.
+    """
+    protocol = "shardedzipfs"
+    cachable = False  # Like the shards, not cached across changes of the zip files
+
+    def __init__(self, shards: List[Tuple[str, "ReadOnlyZipFileSystem"]], **kwargs):
+        """Initialize the ShardedZipFileSystem.
+
+        Args:
+            shards: List of (mount path, ReadOnlyZipFileSystem) tuples. The
+                mount path "" mounts a shard at the root.
+            **kwargs: Additional arguments passed to AsyncFileSystem.
+        """
+        super().__init__(**kwargs)
+        self.asynchronous = True
+        self.shards = [(ReadOnlyZipFileSystem._normalize_path(mount), shard) for mount, shard in shards]
+        self._index = None
+        self._lock = asyncio.Lock()
+
+    async def _initialize(self):
+        """Initialize all shards concurrently and build the merged index self._index."""
+        async with self._lock:
+            if self._index is not None:
+                return
+            await asyncio.gather(*[shard._initialize() for _, shard in self.shards])
+            names, shard_numbers, sizes = [], [], []
+            for shard_number, (mount, shard) in enumerate(self.shards):
+                # Directories of the mount path itself
+                parts = mount.split('/') if mount else []
+                for depth in range(1, len(parts) + 1):
+                    names.append('/'.join(parts[:depth]).encode('utf-8'))
+                    shard_numbers.append(shard_number)
+                    sizes.append(-1)
+                prefix = f'{mount}/'.encode('utf-8') if mount else b''
+                names.extend(prefix + name for name in shard._index.names[1:].tolist())
+                shard_numbers.extend([shard_number] * (len(shard._index.names) - 1))
+                sizes.extend(shard._index.sizes[1:].tolist())
+            self._index = ZipIndex.from_entries(names, shard_numbers, sizes, "sharded zip file system")
+
+    def _mounted_shards(self, path: str) -> List[int]:
+        """Get the numbers of the shards whose mount path contains path."""
+        return [
+            shard_number for shard_number, (mount, _) in enumerate(self.shards)
+            if mount == '' or path == mount or path.startswith(f'{mount}/')
+        ]
+
+    async def _route(self, path: str) -> Tuple["ReadOnlyZipFileSystem", str]:
+        """Get the shard containing a file and the path of the file in the shard."""
+        path = ReadOnlyZipFileSystem._normalize_path(path)
+        shard_numbers = self._mounted_shards(path)
+        if len(shard_numbers) != 1:
+            # Always await self._initialize() in functions needing self._index
+            await self._initialize()
+            index = self._index.find(path)
+            if index < 0 or self._index.is_dir(index):
+                raise FileNotFoundError(f"File {path} not found")
+            shard_numbers = [int(self._index.offsets[index])]
+        mount, shard = self.shards[shard_numbers[0]]
+        return shard, path[len(mount) + 1:] if mount else path
+
+    async def _ls(self, path: str, detail: bool = True, **kwargs) -> List:
+        """List files and directories in the given path.
+
+        If the path points to a file, list just the file.
+        """
+
+        # Always await self._initialize() in functions needing self._index
+        await self._initialize()
+
+        path = ReadOnlyZipFileSystem._normalize_path(path)
+        index = self._index.find(path)
+        if index < 0:
+            raise FileNotFoundError(f"Path {path} not found")
+        indices = self._index.children(index) if self._index.is_dir(index) else [index]
+        results = []
+        for index in indices:
+            fname = self._index.name(index)
+            if detail:
+                results.append({
+                    'name': f'/{fname}',
+                    'type': 'directory' if self._index.is_dir(index) else 'file',
+                    'size': max(0, int(self._index.sizes[index])),
+                    'created': None,
+                    'islink': False
+                })
+            else:
+                results.append(f'/{fname}')
+        return results
+
+    async def _cat_file(self, path: str, start: Optional[int] = None, end: Optional[int] = None, **kwargs) -> bytes:
+        """Read the contents of a file in the shard containing it."""
+        shard, shard_path = await self._route(path)
+        return await shard._cat_file(shard_path, start=start, end=end)
+
+    async def _cat_ranges(self, paths: List[str], starts, ends, max_gap: Optional[int] = None, on_error: str = "return", **kwargs) -> List:
+        """Read byte ranges of one or more files, grouped by shard and read concurrently.
+
+        Arguments and return value are as in ReadOnlyZipFileSystem._cat_ranges.
+        """
+        if not isinstance(paths, list):
+            raise TypeError("paths must be a list")
+        if not isinstance(starts, Iterable):
+            starts = [starts] * len(paths)
+        if not isinstance(ends, Iterable):
+            ends = [ends] * len(paths)
+        if len(starts) != len(paths) or len(ends) != len(paths):
+            raise ValueError("paths, starts and ends must have equal lengths")
+
+        # Group the ranges by shard
+        results = [b''] * len(paths)
+        groups = {}
+        for index, (path, start, end) in enumerate(zip(paths, starts, ends)):
+            try:
+                shard, shard_path = await self._route(path)
+            except FileNotFoundError as e:
+                if on_error != "return":
+                    raise
+                results[index] = e
+                continue
+            group = groups.setdefault(id(shard), (shard, [], [], [], []))
+            group[1].append(index)
+            group[2].append(shard_path)
+            group[3].append(start)
+            group[4].append(end)
+
+        # Read the groups concurrently
+        group_results = await asyncio.gather(*[
+            shard._cat_ranges(shard_paths, shard_starts, shard_ends, max_gap=max_gap, on_error=on_error)
+            for shard, _, shard_paths, shard_starts, shard_ends in groups.values()
+        ])
+        for (_, indices, _, _, _), datas in zip(groups.values(), group_results):
+            for index, data in zip(indices, datas):
+                results[index] = data
+        return results
+
+    def close(self):
+        """Close the memory mappings of the shards, if any."""
+        for _, shard in self.shards:
+            shard.close()
+
+    def read_stats(self) -> dict:
+        """Get the statistics of reads of the underlying file systems.
+
+        Returns the numbers of read requests, bytes read, hedged reads and
+        hedged reads won by the hedged copy of all shards together, and the
+        read statistics of each shard, by mount path and zip file path.
+        """
+        shard_stats = {f"{mount}:{shard.path}": shard.read_stats() for mount, shard in self.shards}
+        stats = {name: sum(stats[name] for stats in shard_stats.values()) for name in ['requests', 'bytes', 'hedged_requests', 'hedge_wins']}
+        stats['shards'] = shard_stats
+        return stats
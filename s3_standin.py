@@ -0,0 +1,396 @@
+import asyncio
+import argparse
+import datetime
+import hashlib
+import os
+import re
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from xml.sax.saxutils import escape
+from aiohttp import web
+
+class RateLimiter:
+    """An async limiter of a byte rate, shared by the coroutines that acquire from it."""
+
+    def __init__(self, rate: float):
+        """Initialize the RateLimiter.
+
+        Args:
+            rate: Maximum rate in bytes per second.
+        """
+        self.rate = rate
+        self._next_time = 0.0
+
+    async def acquire(self, num_bytes: int):
+        """Wait until num_bytes more bytes can be sent within the rate."""
+        now = time.monotonic()
+        start = max(now, self._next_time)
+        self._next_time = start + num_bytes / self.rate
+        if self._next_time > now:
+            await asyncio.sleep(self._next_time - now)
+
+class S3StandIn:
+    """A local S3-compatible HTTP server over local folders and files, with traffic shaping.
+
+    Serves the subset of the S3 API used by s3fs and GDAL /vsicurl/ for
+    reading: GetObject with Range, HeadObject and ListObjectsV2, with path-style
+    URLs and no authentication (for anonymous clients). Each bucket is a local
+    folder, and single objects can be mapped to local files. To emulate object
+    storage, each request waits latency seconds before responding, responses
+    are sent at most at request_bandwidth bytes per second each and at most at
+    bandwidth bytes per second in total, and at most max_connections requests
+    are served at a time, with the others waiting in a queue. Usage:
+
+    ```Python
+    server = S3StandIn({"zarr-bucket": ZARR_FOLDER}, latency=0.02, bandwidth=100*1024**2)
+    endpoint_url = server.start()
+    s3 = s3fs.S3FileSystem(anon=True, endpoint_url=endpoint_url, asynchronous=True)
+    ...
+    server.stop()
+    ```
+
+    The server runs its own event loop in a background thread. Request and
+    byte counts are available from stats().
+    """
+    CHUNK_SIZE = 64 * 1024
+    MAX_KEYS = 1000
+
+    def __init__(self, buckets: Dict[str, str], objects: Optional[Dict[Tuple[str, str], str]] = None, latency: float = 0, bandwidth: Optional[float] = None, request_bandwidth: Optional[float] = None, max_connections: Optional[int] = None, host: str = "127.0.0.1", port: int = 0):
+        """Initialize the S3StandIn.
+
+        Args:
+            buckets: Dict of bucket name -> local folder.
+            objects: Dict of (bucket name, key) -> local file, for objects
+                that are not in a bucket folder.
+            latency: Time in seconds to wait before responding to a request.
+            bandwidth: Maximum total rate in bytes per second of response
+                bodies. If None, not limited.
+            request_bandwidth: Maximum rate in bytes per second of the
+                response body of each request. If None, not limited.
+            max_connections: Maximum number of requests served at a time.
+                If None, not limited.
+            host: Host to listen on.
+            port: Port to listen on, 0 for any free port.
+        """
+        self.buckets = dict(buckets)
+        self.objects = dict(objects or {})
+        for bucket, _ in self.objects:
+            self.buckets.setdefault(bucket, None)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.request_bandwidth = request_bandwidth
+        self.max_connections = max_connections
+        self.host = host
+        self.port = port
+        self.endpoint_url = None
+        self.num_requests = 0
+        self.num_bytes = 0
+        self._loop = None
+        self._thread = None
+        self._runner = None
+        self._semaphore = None
+        self._limiter = None
+
+    def stats(self) -> dict:
+        """Get the configuration, and the numbers of requests served and body bytes sent."""
+        return {
+            "latency": self.latency,
+            "bandwidth": self.bandwidth,
+            "request_bandwidth": self.request_bandwidth,
+            "max_connections": self.max_connections,
+            "requests": self.num_requests,
+            "bytes": self.num_bytes
+        }
+
+    def _resolve(self, bucket: str, key: str) -> Optional[str]:
+        """Get the local file of an object, or None if there is no such object."""
+        if (bucket, key) in self.objects:
+            return self.objects[(bucket, key)]
+        folder = self.buckets.get(bucket)
+        if folder is None or key == "" or key.endswith("/"):
+            return None
+        path = os.path.normpath(os.path.join(folder, key))
+        if not path.startswith(os.path.normpath(folder) + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    @staticmethod
+    def _object_headers(path: str) -> dict:
+        stat = os.stat(path)
+        return {
+            "ETag": '"' + hashlib.md5(f"{stat.st_size}-{stat.st_mtime_ns}".encode()).hexdigest() + '"',
+            "Last-Modified": datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc).strftime("%a, %d %b %Y %H:%M:%S GMT"),
+            "Accept-Ranges": "bytes",
+            "Content-Type": "application/octet-stream"
+        }
+
+    @staticmethod
+    def _error(status: int, code: str, message: str) -> web.Response:
+        body = f'<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>{code}</Code><Message>{escape(message)}</Message></Error>'
+        return web.Response(status=status, body=body.encode(), content_type="application/xml")
+
+    @staticmethod
+    def _parse_range(range_header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+        """Parse a Range header into an absolute (start, end) range, end exclusive.
+
+        Returns (0, size) for no Range header. Returns None if not satisfiable.
+        """
+        if range_header is None:
+            return 0, size
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", range_header.strip())
+        if match is None or match.group(1) == match.group(2) == "":
+            return 0, size
+        if match.group(1) == "":
+            # Suffix range: the last N bytes
+            start, end = max(0, size - int(match.group(2))), size
+        else:
+            start = int(match.group(1))
+            end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+        if start >= size or end <= start:
+            return None
+        return start, end
+
+    async def _handle(self, request: web.Request) -> web.StreamResponse:
+        if self._semaphore is None:
+            return await self._handle_shaped(request)
+        async with self._semaphore:
+            return await self._handle_shaped(request)
+
+    async def _handle_shaped(self, request: web.Request) -> web.StreamResponse:
+        self.num_requests += 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        bucket = request.match_info["bucket"]
+        key = request.match_info.get("key", "")
+        if request.method not in ("GET", "HEAD"):
+            return self._error(405, "MethodNotAllowed", f"Method {request.method} is not allowed, the server is read-only")
+        if bucket not in self.buckets:
+            return self._error(404, "NoSuchBucket", f"Bucket {bucket} does not exist")
+        if key == "" and request.method == "GET":
+            return await self._list_objects(request, bucket)
+        path = self._resolve(bucket, key)
+        if path is None:
+            return self._error(404, "NoSuchKey", f"Key {key} does not exist")
+        headers = self._object_headers(path)
+        size = os.path.getsize(path)
+        if request.method == "HEAD":
+            headers["Content-Length"] = str(size)
+            return web.Response(status=200, headers=headers)
+        byte_range = self._parse_range(request.headers.get("Range"), size)
+        if byte_range is None:
+            headers["Content-Range"] = f"bytes */{size}"
+            return web.Response(status=416, headers=headers)
+        start, end = byte_range
+        if "Range" in request.headers:
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+        response = web.StreamResponse(status=206 if "Range" in request.headers else 200, headers=headers)
+        response.content_length = end - start
+        await response.prepare(request)
+        request_limiter = RateLimiter(self.request_bandwidth) if self.request_bandwidth else None
+        with open(path, "rb") as file:
+            file.seek(start)
+            position = start
+            while position < end:
+                data = file.read(min(self.CHUNK_SIZE, end - position))
+                if not data:
+                    break
+                if request_limiter is not None:
+                    await request_limiter.acquire(len(data))
+                if self._limiter is not None:
+                    await self._limiter.acquire(len(data))
+                await response.write(data)
+                self.num_bytes += len(data)
+                position += len(data)
+        await response.write_eof()
+        return response
+
+    def _list_keys(self, bucket: str, prefix: str, delimiter: str):
+        """List (key, path) of the objects and the common prefixes of a bucket under a prefix."""
+        keys = {key: path for (object_bucket, key), path in self.objects.items() if object_bucket == bucket and key.startswith(prefix)}
+        common_prefixes = set()
+        folder = self.buckets.get(bucket)
+        if folder is not None:
+            prefix_folder = prefix.rpartition("/")[0]
+            list_folder = os.path.join(folder, prefix_folder)
+            if os.path.isdir(list_folder):
+                if delimiter == "/":
+                    # List only the folder of the prefix
+                    for entry in os.scandir(list_folder):
+                        key = f"{prefix_folder}/{entry.name}" if prefix_folder else entry.name
+                        if not key.startswith(prefix):
+                            continue
+                        if entry.is_dir():
+                            common_prefixes.add(f"{key}/")
+                        else:
+                            keys[key] = entry.path
+                else:
+                    for walk_folder, _, file_names in os.walk(list_folder):
+                        for file_name in file_names:
+                            path = os.path.join(walk_folder, file_name)
+                            key = os.path.relpath(path, folder).replace(os.sep, "/")
+                            if key.startswith(prefix):
+                                keys[key] = path
+        if delimiter and delimiter != "/":
+            for key in list(keys):
+                index = key.find(delimiter, len(prefix))
+                if index >= 0:
+                    common_prefixes.add(key[:index + len(delimiter)])
+                    del keys[key]
+        return keys, common_prefixes
+
+    async def _list_objects(self, request: web.Request, bucket: str) -> web.Response:
+        """Respond to ListObjectsV2 (and ListObjects) with continuation by the last returned key."""
+        prefix = request.query.get("prefix", "")
+        delimiter = request.query.get("delimiter", "")
+        max_keys = min(int(request.query.get("max-keys", self.MAX_KEYS)), self.MAX_KEYS)
+        start_after = request.query.get("continuation-token") or request.query.get("start-after") or request.query.get("marker") or ""
+        keys, common_prefixes = await asyncio.to_thread(self._list_keys, bucket, prefix, delimiter)
+        entries = sorted([(key, path) for key, path in keys.items()] + [(common_prefix, None) for common_prefix in common_prefixes])
+        entries = [entry for entry in entries if entry[0] > start_after]
+        is_truncated = len(entries) > max_keys
+        entries = entries[:max_keys]
+        parts = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+            f'<Name>{escape(bucket)}</Name>',
+            f'<Prefix>{escape(prefix)}</Prefix>',
+            f'<Delimiter>{escape(delimiter)}</Delimiter>' if delimiter else '',
+            f'<MaxKeys>{max_keys}</MaxKeys>',
+            f'<KeyCount>{len(entries)}</KeyCount>',
+            f'<IsTruncated>{"true" if is_truncated else "false"}</IsTruncated>'
+        ]
+        if is_truncated:
+            parts.append(f'<NextContinuationToken>{escape(entries[-1][0])}</NextContinuationToken>')
+            parts.append(f'<NextMarker>{escape(entries[-1][0])}</NextMarker>')
+        for key, path in entries:
+            if path is None:
+                parts.append(f'<CommonPrefixes><Prefix>{escape(key)}</Prefix></CommonPrefixes>')
+            else:
+                stat = os.stat(path)
+                last_modified = datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+                parts.append(
+                    f'<Contents><Key>{escape(key)}</Key><LastModified>{last_modified}</LastModified>'
+                    f'<ETag>{escape(self._object_headers(path)["ETag"])}</ETag><Size>{stat.st_size}</Size>'
+                    '<StorageClass>STANDARD</StorageClass></Contents>'
+                )
+        parts.append('</ListBucketResult>')
+        return web.Response(status=200, body="".join(parts).encode(), content_type="application/xml")
+
+    async def _start(self):
+        self._semaphore = asyncio.Semaphore(self.max_connections) if self.max_connections else None
+        self._limiter = RateLimiter(self.bandwidth) if self.bandwidth else None
+        app = web.Application()
+        app.router.add_route("*", "/{bucket}", self._handle)
+        app.router.add_route("*", "/{bucket}/", self._handle)
+        app.router.add_route("*", "/{bucket}/{key:.+}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.endpoint_url = f"http://{self.host}:{port}"
+
+    def start(self) -> str:
+        """Start the server in a background thread and return its endpoint URL."""
+        self._loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start())
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.endpoint_url
+
+    def stop(self):
+        """Stop the server and its background thread."""
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Serve local folders as S3 buckets, with injected latency, bandwidth caps and a connection limit'
+    )
+
+    defaults = {
+        "buckets": [],
+        "latency_ms": 0,
+        "bandwidth_mibps": 0,
+        "request_bandwidth_mibps": 0,
+        "max_connections": 0,
+        "port": 9000
+    }
+
+    parser.add_argument(
+        '--buckets',
+        type=str,
+        nargs='+',
+        default=defaults["buckets"],
+        help='List of space-separated BUCKET=FOLDER mappings'
+    )
+
+    parser.add_argument(
+        '--latency_ms',
+        type=float,
+        default=defaults["latency_ms"],
+        help=f'Latency (ms) injected into each request, default: {defaults["latency_ms"]}'
+    )
+
+    parser.add_argument(
+        '--bandwidth_mibps',
+        type=float,
+        default=defaults["bandwidth_mibps"],
+        help=f'Total bandwidth cap (MiB/s), 0 for no cap, default: {defaults["bandwidth_mibps"]}'
+    )
+
+    parser.add_argument(
+        '--request_bandwidth_mibps',
+        type=float,
+        default=defaults["request_bandwidth_mibps"],
+        help=f'Bandwidth cap (MiB/s) of each request, 0 for no cap, default: {defaults["request_bandwidth_mibps"]}'
+    )
+
+    parser.add_argument(
+        '--max_connections',
+        type=int,
+        default=defaults["max_connections"],
+        help=f'Maximum number of requests served at a time, 0 for no limit, default: {defaults["max_connections"]}'
+    )
+
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=defaults["port"],
+        help=f'Port to listen on, default: {defaults["port"]}'
+    )
+
+    return parser.parse_args()
+
+def serve(buckets, latency_ms, bandwidth_mibps, request_bandwidth_mibps, max_connections, port):
+    server = S3StandIn(
+        dict(bucket.split("=", 1) for bucket in buckets),
+        latency=latency_ms / 1000,
+        bandwidth=bandwidth_mibps * 1024**2 or None,
+        request_bandwidth=request_bandwidth_mibps * 1024**2 or None,
+        max_connections=max_connections or None,
+        port=port
+    )
+    print(f"Serving at {server.start()}, press Ctrl+C to stop")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    serve(**vars(args))
@@ -0,0 +1,56 @@
+import os
+import time
+import argparse
+import progressbar
+from zip_writer import list_modified, pack_folder
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Append the new and changed files of a Zarr to a zipped Zarr, without rewriting the existing data'
+    )
+
+    defaults = {
+        "zarr_from_folder": os.environ.get("DSLAB_S2L1C_NETWORK_ZARR_PATH"),
+        "zipzarr_to_path": os.environ.get("DSLAB_S2L1C_NETWORK_ZIPZARR_PATH"),
+        "since": None
+    }
+
+    parser.add_argument(
+        '--zarr_from_folder',
+        type=str,
+        default=defaults["zarr_from_folder"],
+        help=f'Zarr to append files from, default: {defaults["zarr_from_folder"]}'
+    )
+
+    parser.add_argument(
+        '--zipzarr_to_path',
+        type=str,
+        default=defaults["zipzarr_to_path"],
+        help=f'Zipped Zarr to append to, default: {defaults["zipzarr_to_path"]}'
+    )
+
+    parser.add_argument(
+        '--since',
+        type=float,
+        default=defaults["since"],
+        help='Append files modified after this POSIX timestamp, default: modification time of the zipped Zarr (copying or touching the zip changes it, so pass --since explicitly in that case). Files deleted from the Zarr are not removed from the zipped Zarr'
+    )
+
+    return parser.parse_args()
+
+def append(zarr_from_folder, zipzarr_to_path, since):
+    start = time.time()
+    if since is None:
+        since = os.path.getmtime(zipzarr_to_path)
+    names = list_modified(zarr_from_folder, since)
+    progress = progressbar.ProgressBar(max_value=len(names))
+    print("Appending files modified after:", time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(since)))
+    print("Size of the zipped Zarr before appending (truncate to this to undo an interrupted append):", os.path.getsize(zipzarr_to_path))
+    pack_folder(zarr_from_folder, zipzarr_to_path, names=names, progress=progress, append=True)
+    duration = time.time() - start
+    print("Duration (s):", duration)
+    print("Number of appended files:", len(names))
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    append(**vars(args))
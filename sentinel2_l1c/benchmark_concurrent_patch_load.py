@@ -0,0 +1,347 @@
+import asyncio
+import numpy as np
+import boto3
+import time
+import random
+import os
+import json
+import datetime
+import argparse
+import concurrent.futures
+from pathlib import Path
+import zarr
+import zarr.api.asynchronous
+from zarr.core.sync import sync
+from async_zipfs import ReadOnlyZipFileSystem, ShardedZipFileSystem
+from .utils import band_groups
+from .benchmark_patch_load import (
+    get_safe_bounding_cube,
+    get_random_patch_crs_coords,
+    get_patch_image_coords,
+    str_transform_to_transform,
+    get_time_slice,
+    decode_cf_times,
+    year_datacube_benchmark_safe,
+    year_datacube_benchmark_cog,
+    get_benchmark_zarr_store
+)
+from .instrumentation import InstrumentedStore
+
+async def open_band_group_arrays(zarr_store, tile, years, time_start=None, time_end=None, consolidated=True):
+    """Open the data array and parse the geotransform of each band group of each year, all concurrently.
+
+    With consolidated=True, the tile/year groups are opened through their
+    consolidated metadata, with a single metadata read per year, and the band
+    groups and arrays are then opened from it without further reads. A
+    tile/year without consolidated metadata (converted before, or by an
+    interrupted conversion) falls back to reading the metadata of each band
+    group.
+
+    With a time window (time_start inclusive, time_end exclusive, as datetime64),
+    the time coordinate is read and the window is resolved to an index range by
+    binary search.
+
+    Returns a dict of band group -> list of (array, geotransform, time slice) tuples, in the order of years.
+    """
+    if consolidated:
+        year_groups = await asyncio.gather(*[zarr.api.asynchronous.open_group(store=zarr_store, path=f"{tile}/{year}", mode="r", zarr_format=3, use_consolidated=None) for year in years])
+        year_groups = dict(zip(years, year_groups))
+    async def open_band_group(year, band_group):
+        if consolidated:
+            group = await year_groups[year].getitem(band_group)
+        else:
+            group = await zarr.api.asynchronous.open_group(store=zarr_store, path=f"{tile}/{year}/{band_group}", mode="r", zarr_format=3, use_consolidated=False)
+        array = await group.getitem("data")
+        time_slice = slice(None)
+        if time_start is not None or time_end is not None:
+            time_array = await group.getitem("time")
+            times = decode_cf_times(await time_array.getitem(slice(None)), time_array.attrs.get("units"))
+            time_slice = get_time_slice(times, time_start, time_end)
+        return array, str_transform_to_transform(group.attrs["transform"]), time_slice
+    keys = [(year, band_group) for band_group in band_groups.keys() for year in years]
+    opened = await asyncio.gather(*[open_band_group(year, band_group) for year, band_group in keys])
+    band_group_arrays = {band_group: [] for band_group in band_groups.keys()}
+    for (year, band_group), array_and_transform in zip(keys, opened):
+        band_group_arrays[band_group].append(array_and_transform)
+    return band_group_arrays
+
+async def load_patch_zarr_async(band_group_arrays, patch_crs_coords, sequential=False):
+    """Load a patch time series of all band groups and years from opened Zarr arrays.
+
+    The fetches of all years and band groups are in flight at once, so the
+    latency is close to that of the slowest fetch rather than the sum. With
+    sequential=True, they are done one after another instead, for comparison.
+    The years are concatenated along time.
+    """
+    async def load_band_group(array, geo_transform, time_slice):
+        upper_left_x, upper_left_y, lower_right_x, lower_right_y = get_patch_image_coords(geo_transform, *patch_crs_coords)
+        return await array.getitem((time_slice, slice(None), slice(upper_left_y, lower_right_y), slice(upper_left_x, lower_right_x)))
+    keys = [(band_group, index) for band_group, arrays in band_group_arrays.items() for index in range(len(arrays))]
+    if sequential:
+        datas = [await load_band_group(*band_group_arrays[band_group][index]) for band_group, index in keys]
+    else:
+        datas = await asyncio.gather(*[load_band_group(*band_group_arrays[band_group][index]) for band_group, index in keys])
+    band_group_datas = {band_group: [] for band_group in band_group_arrays.keys()}
+    for (band_group, _), data in zip(keys, datas):
+        band_group_datas[band_group].append(data)
+    return {band_group: np.concatenate(datas, axis=0) for band_group, datas in band_group_datas.items()}
+
+async def run_concurrent_zarr(band_group_arrays, patch_crs_coords_list, concurrency, sequential_fetches=False):
+    """Load patches with at most concurrency loads in flight. Returns the wall time, latencies and decoded bytes."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    num_bytes = 0
+
+    async def load(patch_crs_coords):
+        nonlocal num_bytes
+        async with semaphore:
+            start = time.perf_counter()
+            band_group_datacubes = await load_patch_zarr_async(band_group_arrays, patch_crs_coords, sequential=sequential_fetches)
+            latencies.append(time.perf_counter() - start)
+            num_bytes += sum(datacube.nbytes for datacube in band_group_datacubes.values())
+
+    start = time.perf_counter()
+    await asyncio.gather(*[load(patch_crs_coords) for patch_crs_coords in patch_crs_coords_list])
+    return time.perf_counter() - start, latencies, num_bytes
+
+def run_concurrent_files(load_patch, patch_crs_coords_list, concurrency):
+    """Load patches from SAFE or COG files in a thread pool of concurrency threads. Returns the wall time, latencies and decoded bytes."""
+    def load(patch_crs_coords):
+        start = time.perf_counter()
+        _, band_group_datacubes = load_patch(patch_crs_coords)
+        return time.perf_counter() - start, sum(datacube.nbytes for datacube in band_group_datacubes.values())
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(load, patch_crs_coords_list))
+    return time.perf_counter() - start, [latency for latency, _ in results], sum(num_bytes for _, num_bytes in results)
+
+def get_file_year_loader(storage, format, year, s3_endpoint_url=None):
+    """Get a function that loads a patch time series of a year from SAFE or COG files of a storage."""
+    if format == "safe":
+        if storage == "temp":
+            return lambda patch_crs_coords: year_datacube_benchmark_safe(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_TEMP_SAFE_PATH"])
+        elif storage == "network":
+            return lambda patch_crs_coords: year_datacube_benchmark_safe(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_NETWORK_SAFE_PATH"])
+        elif storage == "s3":
+            return lambda patch_crs_coords: year_datacube_benchmark_safe(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_NETWORK_SAFE_PATH"], storage="s3", s3_endpoint=s3_endpoint_url, s3_bucket=os.environ["DSLAB_S2L1C_S3_SAFE_BUCKET"])
+    elif format == "cog":
+        if storage == "temp":
+            return lambda patch_crs_coords: year_datacube_benchmark_cog(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_TEMP_COG_PATH"])
+        elif storage == "network":
+            return lambda patch_crs_coords: year_datacube_benchmark_cog(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_NETWORK_COG_PATH"])
+        elif storage == "s3":
+            return lambda patch_crs_coords: year_datacube_benchmark_cog(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_NETWORK_COG_PATH"], storage="s3", s3_endpoint=s3_endpoint_url, s3_bucket=os.environ["DSLAB_S2L1C_S3_COG_BUCKET"])
+
+def get_file_loader(storage, format, years, s3_endpoint_url=None):
+    """Get a function that loads a patch time series of several years from SAFE or COG files of a storage, concatenated along time."""
+    year_loaders = [get_file_year_loader(storage, format, year, s3_endpoint_url) for year in years]
+    def load_patch(patch_crs_coords):
+        start = time.time()
+        year_band_group_datacubes = [year_loader(patch_crs_coords)[1] for year_loader in year_loaders]
+        band_group_datacubes = {band_group: np.concatenate([band_group_datacubes[band_group] for band_group_datacubes in year_band_group_datacubes], axis=0) for band_group in band_groups.keys()}
+        return time.time() - start, band_group_datacubes
+    return load_patch
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Benchmark concurrent patch timeseries loading from multiple storage systems and formats'
+    )
+
+    bounding_cube = get_safe_bounding_cube()
+
+    defaults = {
+        "storages": ["network", "temp", "s3"],
+        "formats": ["safe", "cog", "zarr", "zipzarr"],
+        "concurrencies": [1, 2, 4, 8, 16, 32],
+        "num_requests": 64,
+        "sequential_fetches": False,
+        "years": [bounding_cube["year"]],
+        "tile": bounding_cube["tile"],
+        "x1": bounding_cube["x1"],
+        "y1": bounding_cube["y1"],
+        "x2": bounding_cube["x2"],
+        "y2": bounding_cube["y2"],
+        "time_start": None,
+        "time_end": None,
+        "consolidated": True
+    }
+
+    parser.add_argument(
+        '--storages',
+        type=str,
+        nargs='+',
+        choices=["network", "temp", "s3"],
+        default=defaults["storages"],
+        help=f'List of space-separated ids of storages to benchmark, default: {" ".join(defaults["storages"])}'
+    )
+
+    parser.add_argument(
+        '--formats',
+        type=str,
+        nargs='+',
+        choices=["safe", "cog", "zarr", "zipzarr", "shardedzarr"],
+        default=defaults["formats"],
+        help=f'List of space-separated ids of formats to benchmark, default: {" ".join(defaults["formats"])}'
+    )
+
+    parser.add_argument(
+        '--concurrencies',
+        type=int,
+        nargs='+',
+        default=defaults["concurrencies"],
+        help=f'List of space-separated numbers of patch loads in flight to benchmark, default: {" ".join(map(str, defaults["concurrencies"]))}'
+    )
+
+    parser.add_argument(
+        '--num_requests',
+        type=int,
+        default=defaults["num_requests"],
+        help=f'Number of patch loads per concurrency, default: {defaults["num_requests"]}'
+    )
+
+    parser.add_argument(
+        '--sequential_fetches',
+        action=argparse.BooleanOptionalAction,
+        default=defaults["sequential_fetches"],
+        help=f'Fetch the years and band groups of a Zarr patch one after another instead of concurrently, default: {defaults["sequential_fetches"]}'
+    )
+
+    parser.add_argument(
+        '--years',
+        type=int,
+        nargs='+',
+        default=defaults["years"],
+        help=f'List of space-separated years of a patch time series, default (from network SAFE): {" ".join(map(str, defaults["years"]))}'
+    )
+
+    parser.add_argument(
+        '--tile',
+        type=str,
+        default=defaults["tile"],
+        help=f'Tile, default (from network SAFE): {defaults["tile"]}'
+    )
+
+    parser.add_argument(
+        '--x1',
+        type=int,
+        default=defaults["x1"],
+        help=f'Bounding box x1, default (from network SAFE): {defaults["x1"]}'
+    )
+    parser.add_argument(
+        '--y1',
+        type=int,
+        default=defaults["y1"],
+        help=f'Bounding box y1, default (from network SAFE): {defaults["y1"]}'
+    )
+    parser.add_argument(
+        '--x2',
+        type=int,
+        default=defaults["x2"],
+        help=f'Bounding box x2, default (from network SAFE): {defaults["x2"]}'
+    )
+    parser.add_argument(
+        '--y2',
+        type=int,
+        default=defaults["y2"],
+        help=f'Bounding box y2, default (from network SAFE): {defaults["y2"]}'
+    )
+
+    parser.add_argument(
+        '--time_start',
+        type=np.datetime64,
+        default=defaults["time_start"],
+        help=f'First UTC time (inclusive) of the time window to load from each year, for example 2024-06-01, Zarr formats only, default (start of year): {defaults["time_start"]}'
+    )
+
+    parser.add_argument(
+        '--time_end',
+        type=np.datetime64,
+        default=defaults["time_end"],
+        help=f'End UTC time (exclusive) of the time window to load from each year, for example 2024-09-01, Zarr formats only, default (end of year): {defaults["time_end"]}'
+    )
+
+    parser.add_argument(
+        '--consolidated',
+        action=argparse.BooleanOptionalAction,
+        default=defaults["consolidated"],
+        help=f'Open the Zarr formats through the consolidated metadata of each tile/year if present, default: {defaults["consolidated"]}'
+    )
+
+    return parser.parse_args()
+
+def benchmark(storages, formats, concurrencies, num_requests, sequential_fetches, years, tile, x1, y1, x2, y2, time_start=None, time_end=None, consolidated=True):
+    if (time_start is not None or time_end is not None) and ("safe" in formats or "cog" in formats):
+        raise ValueError("A time window is only supported by the Zarr formats")
+    s3_endpoint_url = None
+    if "s3" in storages:
+        s3_session = boto3.Session(profile_name=os.environ["DSLAB_S2L1C_S3_PROFILE"])
+        s3_client = s3_session.client('s3')
+        s3_endpoint_url = s3_client.meta.endpoint_url
+    benchmark_timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    print(f"Benchmarking concurrent loading of data for tile {tile}, years {' '.join(map(str, years))}")
+    log = {
+        "tile": tile,
+        "years": years,
+        "num_requests": num_requests,
+        "sequential_fetches": sequential_fetches,
+        "time_start": str(time_start) if time_start is not None else None,
+        "time_end": str(time_end) if time_end is not None else None,
+        "consolidated": consolidated,
+        "open_durations": {},
+        "results": {}
+    }
+    logpath = Path(os.environ["DSLAB_LOG_FOLDER"]) / f"sentinel2_l1c_concurrent_{benchmark_timestamp}.json"
+    random.seed(42)
+    for storage in storages:
+        log["results"][storage] = {}
+        log["open_durations"][storage] = {}
+        for format in formats:
+            print(storage, format)
+            log["results"][storage][format] = {}
+            if format in ["zarr", "zipzarr", "shardedzarr"]:
+                # Wrapped to count the bytes transferred from the store
+                zarr_store = InstrumentedStore(get_benchmark_zarr_store(storage, format, s3_endpoint_url, index_cache_folder=os.environ.get("DSLAB_ZIPFS_INDEX_CACHE_FOLDER")))
+                start = time.perf_counter()
+                band_group_arrays = sync(open_band_group_arrays(zarr_store, tile, years, time_start, time_end, consolidated))
+                log["open_durations"][storage][format] = time.perf_counter() - start
+                # Warmup run, not reported
+                sync(load_patch_zarr_async(band_group_arrays, get_random_patch_crs_coords(x1=x1, y1=y1, x2=x2, y2=y2)))
+            else:
+                load_patch = get_file_loader(storage, format, years, s3_endpoint_url)
+                # Warmup run, not reported
+                load_patch(get_random_patch_crs_coords(x1=x1, y1=y1, x2=x2, y2=y2))
+            for concurrency in concurrencies:
+                patch_crs_coords_list = [get_random_patch_crs_coords(x1=x1, y1=y1, x2=x2, y2=y2) for _ in range(num_requests)]
+                transferred_bytes = None
+                if format in ["zarr", "zipzarr", "shardedzarr"]:
+                    bytes_before = zarr_store.bytes
+                    duration, latencies, num_bytes = sync(run_concurrent_zarr(band_group_arrays, patch_crs_coords_list, concurrency, sequential_fetches))
+                    transferred_bytes = zarr_store.bytes - bytes_before
+                else:
+                    duration, latencies, num_bytes = run_concurrent_files(load_patch, patch_crs_coords_list, concurrency)
+                result = {
+                    "duration": duration,
+                    "samples_per_second": num_requests / duration,
+                    "decoded_bytes_per_second": num_bytes / duration,
+                    "transferred_bytes_per_second": transferred_bytes / duration if transferred_bytes is not None else None,
+                    "mean_latency": np.mean(latencies),
+                    "p50_latency": np.percentile(latencies, 50),
+                    "p95_latency": np.percentile(latencies, 95),
+                    "p99_latency": np.percentile(latencies, 99),
+                    "max_latency": np.max(latencies)
+                }
+                if format == "zipzarr" and isinstance(getattr(zarr_store._store, "fs", None), (ReadOnlyZipFileSystem, ShardedZipFileSystem)):
+                    # Cumulative read statistics of the async zip file system, including the warmup run
+                    result["zipfs_read_stats"] = zarr_store._store.fs.read_stats()
+                log["results"][storage][format][str(concurrency)] = result
+                print(f"Concurrency {concurrency}: {result['samples_per_second']:.3f} samples/s, {result['decoded_bytes_per_second'] / 1024**2:.1f} MiB/s decoded, p50 latency {result['p50_latency']:.3f} s, p95 latency {result['p95_latency']:.3f} s")
+                # Serializing json
+                print(f"Writing log to: {logpath}")
+                logpath.parent.mkdir(parents=True, exist_ok=True)
+                with open(logpath, "w") as out_file:
+                    json.dump(log, out_file, indent = 4)
+
+if __name__=="__main__":
+    args = parse_arguments()
+    benchmark(**vars(args))
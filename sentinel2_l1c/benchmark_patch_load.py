@@ -10,17 +10,22 @@ import xarray as xr
 import dask
 import re
 import rioxarray
+from rasterio.env import get_gdal_config, set_gdal_config
 import json
 import datetime
 import s3fs
 import argparse
+import functools
+import gc
 from pathlib import Path
 import xmltodict
 import zarr.storage
-from async_zipfs import ReadOnlyZipFileSystem
+from async_zipfs import ReadOnlyZipFileSystem, ShardedZipFileSystem
+from s3_standin import S3StandIn
 from fsspec.implementations.local import LocalFileSystem
 from fsspec.implementations.asyn_wrapper import AsyncFileSystemWrapper
 from .utils import band_groups
+from .instrumentation import PhaseTimer, InstrumentedStore, read_process_io, diff_counters
 
 if int(zarr.__version__.split(".")[0]) < 3:
     raise ImportError("zarr version 3 or higher is required. Current version: {zarr.__version__}")
@@ -48,10 +53,13 @@ def get_safe_bounding_cube():
     with open(granule_metadata_file_name, "r", encoding="utf-8") as file:
         xml_content = file.read()
     granule_metadata_dict = xmltodict.parse(xml_content)
-    x1 = int(granule_metadata_dict["n1:Level-1C_Tile_ID"]['n1:Geometric_Info']['Tile_Geocoding']['Geoposition'][0]['ULX'])
-    y1 = int(granule_metadata_dict["n1:Level-1C_Tile_ID"]['n1:Geometric_Info']['Tile_Geocoding']['Geoposition'][0]['ULY'])
-    x2 = x1 + 109800
-    y2 = y1 - 109800
+    tile_geocoding = granule_metadata_dict["n1:Level-1C_Tile_ID"]['n1:Geometric_Info']['Tile_Geocoding']
+    x1 = int(tile_geocoding['Geoposition'][0]['ULX'])
+    y1 = int(tile_geocoding['Geoposition'][0]['ULY'])
+    # Tile size from the 10 m resolution size, 10980 x 10980 pixels in real SAFEs and smaller in synthetic SAFEs
+    size = next(size for size in tile_geocoding['Size'] if size['@resolution'] == '10')
+    x2 = x1 + int(size['NCOLS'])*10
+    y2 = y1 - int(size['NROWS'])*10
     return {
         "tile": tile,
         "year": year,
@@ -73,6 +81,42 @@ def get_patch_image_coords(transform, patch_x1, patch_y1, patch_x2, patch_y2):
     lower_right_x, lower_right_y = crs_coords_to_image_coords(transform, patch_x2, patch_y2)
     return upper_left_x, upper_left_y, lower_right_x, lower_right_y
 
+def get_time_slice(times, time_start=None, time_end=None):
+    """Get the index range of the times in a time window by binary search.
+
+    Args:
+        times: Sorted datetime64 times of a band group.
+        time_start: First time of the window (inclusive) as datetime64, or None for no lower bound.
+        time_end: End time of the window (exclusive) as datetime64, or None for no upper bound.
+
+    Returns:
+        Slice of the time indices in the window.
+
+    Raises:
+        ValueError: If the times are not sorted, or if a bound is given and the times are not
+            datetime64, like the string times of Zarrs converted by older versions.
+    """
+    if (time_start is not None or time_end is not None) and not np.issubdtype(times.dtype, np.datetime64):
+        raise ValueError(f"The times are {times.dtype} rather than datetime64, convert to a new Zarr folder")
+    if np.any(times[1:] < times[:-1]):
+        raise ValueError("The times are not sorted, convert to a new Zarr folder")
+    start = 0 if time_start is None else np.searchsorted(times, time_start, side="left")
+    stop = len(times) if time_end is None else np.searchsorted(times, time_end, side="left")
+    return slice(int(start), int(stop))
+
+def decode_cf_times(values, units):
+    """Decode CF-encoded times, for example with units "seconds since 1970-01-01", to datetime64.
+
+    Raises ValueError if the values are not numbers or the units (None if missing) are not CF
+    time units, like the string times of Zarrs converted by older versions.
+    """
+    values = np.asarray(values)
+    unit_codes = {"days": "D", "hours": "h", "minutes": "m", "seconds": "s", "milliseconds": "ms", "microseconds": "us", "nanoseconds": "ns"}
+    unit, _, reference = (units or "").partition(" since ")
+    if not np.issubdtype(values.dtype, np.number) or unit.strip() not in unit_codes or not reference.strip():
+        raise ValueError(f"The times are {values.dtype} with units {units} rather than CF-encoded datetimes, convert to a new Zarr folder")
+    return np.datetime64(reference.strip()) + values.astype(f"timedelta64[{unit_codes[unit.strip()]}]")
+
 # Define a function to convert geographic coordinates to pixel coordinates.
 def crs_coords_to_image_coords(transform, crs_x, crs_y):
     # Extract the geographic transformation parameters.
@@ -97,7 +141,8 @@ def str_transform_to_transform(matrix_string):
     matrix = [list(map(float, re.findall(r'-?\d+\.\d+', row))) for row in rows]
     return matrix[0][2], matrix[0][0], matrix[0][1], matrix[1][2], matrix[1][0], matrix[1][1]
 
-def year_datacube_benchmark_safe(year, patch_crs_coords, folder, storage="filesystem", s3_endpoint=None, s3_bucket=None):
+def year_datacube_benchmark_safe(year, patch_crs_coords, folder, storage="filesystem", s3_endpoint=None, s3_bucket=None, timer=None):
+    timer = timer or PhaseTimer()
     start = time.time()                   
     path_start = f'{folder}/Sentinel-2/MSI/L1C/{year}'
     if storage == "s3":
@@ -129,7 +174,8 @@ def year_datacube_benchmark_safe(year, patch_crs_coords, folder, storage="filesy
                     bands = band_groups[band_group]["bands"]      
                     for band in bands:
                         #print(band)
-                        image_path = next((granule_folder / "IMG_DATA").glob(f'*{band}.jp2'))
+                        with timer.phase("metadata"):
+                            image_path = next((granule_folder / "IMG_DATA").glob(f'*{band}.jp2'))
                         if storage == "s3":
                             image_s3_path = f"{granule_s3_path}/IMG_DATA/{image_path.name}"
                         #print(image_path)
@@ -137,25 +183,31 @@ def year_datacube_benchmark_safe(year, patch_crs_coords, folder, storage="filesy
                             use_image_path = image_path
                         elif storage == "s3":
                             use_image_path = image_s3_path
-                        ds = rioxarray.open_rasterio(use_image_path, chunks={"x": 1024, "y": 1024})
+                        with timer.phase("metadata"):
+                            ds = rioxarray.open_rasterio(use_image_path, chunks={"x": 1024, "y": 1024})
                         #crs = ds.rio.crs
-                        geo_transform = str_transform_to_transform(str(ds.rio.transform()))
-                        upper_left_x, upper_left_y, lower_right_x, lower_right_y = get_patch_image_coords(geo_transform, *patch_crs_coords)
+                        with timer.phase("geotransform"):
+                            geo_transform = str_transform_to_transform(str(ds.rio.transform()))
+                            upper_left_x, upper_left_y, lower_right_x, lower_right_y = get_patch_image_coords(geo_transform, *patch_crs_coords)
                         patch_data = ds.data[:, upper_left_y:lower_right_y, upper_left_x:lower_right_x]  # Uses Dask array slicing
                         patch_data_lists[band_group].append(patch_data)
         #break # !!! uncomment for 1 month test run
     band_group_datacubes = {}
     for band_group in band_groups:
-        dask_stack = dask.array.stack(patch_data_lists[band_group], axis=0)
-        band_group_datacubes[band_group] = dask_stack.compute()
-        shape = band_group_datacubes[band_group].shape
-        band_group_datacubes[band_group] = band_group_datacubes[band_group].reshape(
-            (shape[0]//len(band_groups[band_group]["bands"]), len(band_groups[band_group]["bands"]), shape[2], shape[3])
-        )
+        with timer.phase("assembly"):
+            dask_stack = dask.array.stack(patch_data_lists[band_group], axis=0)
+        with timer.phase("load"):
+            band_group_datacubes[band_group] = dask_stack.compute()
+        with timer.phase("assembly"):
+            shape = band_group_datacubes[band_group].shape
+            band_group_datacubes[band_group] = band_group_datacubes[band_group].reshape(
+                (shape[0]//len(band_groups[band_group]["bands"]), len(band_groups[band_group]["bands"]), shape[2], shape[3])
+            )
     duration = time.time() - start
     return duration, band_group_datacubes
 
-def year_datacube_benchmark_cog(year, patch_crs_coords, folder, storage="filesystem", s3_endpoint=None, s3_bucket=None):
+def year_datacube_benchmark_cog(year, patch_crs_coords, folder, storage="filesystem", s3_endpoint=None, s3_bucket=None, timer=None):
+    timer = timer or PhaseTimer()
     start = time.time()
     path_start = folder
     utm_zone_folder = next(pathlib.Path(path_start).glob('*'))
@@ -180,16 +232,20 @@ def year_datacube_benchmark_cog(year, patch_crs_coords, folder, storage="filesys
                 elif storage == "s3":
                     use_band_group_image_path = f"{s3_cog_folder}/{band_group}.tif"
                     #print(use_band_group_image_path)
-                ds = rioxarray.open_rasterio(use_band_group_image_path, chunks={"x": 512, "y": 512}, engine="rasterio")
+                with timer.phase("metadata"):
+                    ds = rioxarray.open_rasterio(use_band_group_image_path, chunks={"x": 512, "y": 512}, engine="rasterio")
                 # crs = ds.rio.crs
-                geo_transform = str_transform_to_transform(str(ds.rio.transform()))
-                upper_left_x, upper_left_y, lower_right_x, lower_right_y = get_patch_image_coords(geo_transform, *patch_crs_coords)
+                with timer.phase("geotransform"):
+                    geo_transform = str_transform_to_transform(str(ds.rio.transform()))
+                    upper_left_x, upper_left_y, lower_right_x, lower_right_y = get_patch_image_coords(geo_transform, *patch_crs_coords)
                 patch_data = ds.data[:, upper_left_y:lower_right_y, upper_left_x:lower_right_x]  # Uses Dask array slicing
                 patch_data_lists[band_group].append(patch_data)
     band_group_datacubes = {}
     for band_group in band_groups:
-        dask_stack = dask.array.stack(patch_data_lists[band_group], axis=0)
-        band_group_datacubes[band_group] = dask_stack.compute()
+        with timer.phase("assembly"):
+            dask_stack = dask.array.stack(patch_data_lists[band_group], axis=0)
+        with timer.phase("load"):
+            band_group_datacubes[band_group] = dask_stack.compute()
     
     duration = time.time() - start
     return duration, band_group_datacubes
@@ -208,29 +264,86 @@ async def open_s3_file(s3_endpoint, s3_bucket, s3_path):
     #await session.close()
     return data
 
-def get_s3_zipzarr_store(s3_endpoint, s3_bucket, zip_key, async_zipfs=True):
+def parse_zip_shards(value):
+    """Parse a zipped Zarr path or key, or shards of a zipped Zarr, from the value of an environment variable.
+
+    Shards are given as space-separated mount path=zip path (or key) pairs, for example
+    "35VLH/2024=35VLH_2024.zip 35VLH/2025=35VLH_2025.zip", and are returned as a dict of mount
+    path -> zip path. A single zip path is returned as is.
+    """
+    if "=" not in value:
+        return value
+    return dict(shard.split("=", 1) for shard in value.split())
+
+def get_s3_zipzarr_store(s3_endpoint, s3_bucket, zip_key, async_zipfs=True, index_cache_folder=None, block_cache_size=0, max_concurrency=None, hedge_quantile=None, skip_instance_cache=False):
+    """Get the Zarr store of a zipped Zarr in S3.
+
+    zip_key is the key of the zip file, or a dict of mount path -> key of the shards of a
+    zipped Zarr, which are read as one store through ShardedZipFileSystem. Shards need
+    async_zipfs. max_concurrency limits the reads of each shard.
+    """
     if async_zipfs:
-        s3 = s3fs.S3FileSystem(anon=True, endpoint_url=s3_endpoint, asynchronous=True)
-        zipfs = ReadOnlyZipFileSystem(s3, f"{s3_bucket}/{zip_key}")
+        s3 = s3fs.S3FileSystem(anon=True, endpoint_url=s3_endpoint, asynchronous=True, skip_instance_cache=skip_instance_cache)
+        def open_zipfs(key):
+            return ReadOnlyZipFileSystem(s3, f"{s3_bucket}/{key}", index_cache_dir=index_cache_folder, block_cache_size=block_cache_size, max_concurrency=max_concurrency, hedge_quantile=hedge_quantile, skip_instance_cache=skip_instance_cache)
+        if isinstance(zip_key, dict):
+            zipfs = ShardedZipFileSystem([(mount, open_zipfs(key)) for mount, key in zip_key.items()], skip_instance_cache=skip_instance_cache)
+        else:
+            zipfs = open_zipfs(zip_key)
         zarr_store = zarr.storage.FsspecStore(fs=zipfs, read_only=True, path="")
     else:
-        s3 = s3fs.S3FileSystem(anon=True, endpoint_url=s3_endpoint, asynchronous=False)
+        if isinstance(zip_key, dict):
+            raise ValueError("Shards of a zipped Zarr are only supported by the async zip file system")
+        s3 = s3fs.S3FileSystem(anon=True, endpoint_url=s3_endpoint, asynchronous=False, skip_instance_cache=skip_instance_cache)
         file = s3.open(f"s3://{s3_bucket}/{zip_key}")
         zarr_store = S3ZipStore(file)
     return zarr_store
 
-def get_zipzarr_store(zip_path, async_zipfs=True):
+def get_zipzarr_store(zip_path, async_zipfs=True, index_cache_folder=None, block_cache_size=0, use_mmap=False, skip_instance_cache=False):
+    """Get the Zarr store of a local zipped Zarr.
+
+    zip_path is the path of the zip file, or a dict of mount path -> path of the shards of a
+    zipped Zarr, which are read as one store through ShardedZipFileSystem. Shards need
+    async_zipfs.
+    """
     if async_zipfs:
         local_fs = LocalFileSystem()
         async_local_fs = AsyncFileSystemWrapper(local_fs)
-        zipfs = ReadOnlyZipFileSystem(async_local_fs, zip_path)
+        def open_zipfs(path):
+            return ReadOnlyZipFileSystem(async_local_fs, path, index_cache_dir=index_cache_folder, block_cache_size=block_cache_size, use_mmap=use_mmap, mmap_advice="random" if use_mmap else None, skip_instance_cache=skip_instance_cache)
+        if isinstance(zip_path, dict):
+            zipfs = ShardedZipFileSystem([(mount, open_zipfs(path)) for mount, path in zip_path.items()], skip_instance_cache=skip_instance_cache)
+        else:
+            zipfs = open_zipfs(zip_path)
         zarr_store = zarr.storage.FsspecStore(fs=zipfs, read_only=True, path="")
     else:
+        if isinstance(zip_path, dict):
+            raise ValueError("Shards of a zipped Zarr are only supported by the async zip file system")
         zarr_store = zarr.storage.ZipStore(zip_path, mode='r')
     return zarr_store
 
-def get_s3_zarr_store(s3_endpoint, s3_bucket):
-    s3 = s3fs.S3FileSystem(anon=True, endpoint_url=s3_endpoint, asynchronous=True)
+def start_s3_standin(latency=0, bandwidth=None, request_bandwidth=None, max_connections=None):
+    """Start a local S3 stand-in server serving the network storage SAFE, COG, Zarr and zipped Zarr as the S3 buckets."""
+    buckets = {}
+    for format in ["SAFE", "COG", "ZARR", "SHARDEDZARR"]:
+        if f"DSLAB_S2L1C_S3_{format}_BUCKET" in os.environ and f"DSLAB_S2L1C_NETWORK_{format}_PATH" in os.environ:
+            buckets[os.environ[f"DSLAB_S2L1C_S3_{format}_BUCKET"]] = os.environ[f"DSLAB_S2L1C_NETWORK_{format}_PATH"]
+    objects = {}
+    if "DSLAB_S2L1C_S3_ZIPZARR_BUCKET" in os.environ and "DSLAB_S2L1C_NETWORK_ZIPZARR_PATH" in os.environ:
+        zip_key = parse_zip_shards(os.environ["DSLAB_S2L1C_S3_ZIPZARR_KEY"])
+        zip_path = parse_zip_shards(os.environ["DSLAB_S2L1C_NETWORK_ZIPZARR_PATH"])
+        if isinstance(zip_key, dict):
+            # Each shard key is served from the network storage shard of the same mount path
+            for mount, key in zip_key.items():
+                objects[(os.environ["DSLAB_S2L1C_S3_ZIPZARR_BUCKET"], key)] = zip_path[mount]
+        else:
+            objects[(os.environ["DSLAB_S2L1C_S3_ZIPZARR_BUCKET"], zip_key)] = zip_path
+    server = S3StandIn(buckets, objects=objects, latency=latency, bandwidth=bandwidth, request_bandwidth=request_bandwidth, max_connections=max_connections)
+    server.start()
+    return server
+
+def get_s3_zarr_store(s3_endpoint, s3_bucket, skip_instance_cache=False):
+    s3 = s3fs.S3FileSystem(anon=True, endpoint_url=s3_endpoint, asynchronous=True, skip_instance_cache=skip_instance_cache)
     zarr_store = zarr.storage.FsspecStore(fs=s3, read_only=True, path=s3_bucket)
     return zarr_store
 
@@ -238,7 +351,79 @@ def get_zarr_store(folder):
     zarr_store = zarr.storage.LocalStore(f'{folder}/', read_only=True)
     return zarr_store
 
-def year_datacube_benchmark_zarr(tile, year, patch_crs_coords, zarr_store):
+def get_benchmark_zarr_store(storage, format, s3_endpoint_url=None, async_zipfs=True, index_cache_folder=None, block_cache_size=0, use_mmap=False, max_concurrency=None, hedge_quantile=None, skip_instance_cache=False):
+    """Get the Zarr store of a storage and a format ("zarr", "shardedzarr" or "zipzarr") as configured by the environment variables.
+
+    The arguments after s3_endpoint_url configure the zipped Zarr stores, see
+    get_zipzarr_store and get_s3_zipzarr_store.
+    """
+    if format == "zarr":
+        if (storage == "temp"):
+            return get_zarr_store(folder=os.environ["DSLAB_S2L1C_TEMP_ZARR_PATH"])
+        elif (storage == "network"):
+            return get_zarr_store(folder=os.environ["DSLAB_S2L1C_NETWORK_ZARR_PATH"])
+        elif (storage == "s3"):
+            return get_s3_zarr_store(s3_endpoint=s3_endpoint_url, s3_bucket=os.environ["DSLAB_S2L1C_S3_ZARR_BUCKET"], skip_instance_cache=skip_instance_cache)
+    elif format == "shardedzarr":
+        if (storage == "temp"):
+            return get_zarr_store(folder=os.environ["DSLAB_S2L1C_TEMP_SHARDEDZARR_PATH"])
+        elif (storage == "network"):
+            return get_zarr_store(folder=os.environ["DSLAB_S2L1C_NETWORK_SHARDEDZARR_PATH"])
+        elif (storage == "s3"):
+            return get_s3_zarr_store(s3_endpoint=s3_endpoint_url, s3_bucket=os.environ["DSLAB_S2L1C_S3_SHARDEDZARR_BUCKET"], skip_instance_cache=skip_instance_cache)
+    elif format == "zipzarr":
+        if (storage == "temp"):
+            return get_zipzarr_store(zip_path=parse_zip_shards(os.environ["DSLAB_S2L1C_TEMP_ZIPZARR_PATH"]), async_zipfs=async_zipfs, index_cache_folder=index_cache_folder, block_cache_size=block_cache_size, use_mmap=use_mmap, skip_instance_cache=skip_instance_cache)
+        elif (storage == "network"):
+            return get_zipzarr_store(zip_path=parse_zip_shards(os.environ["DSLAB_S2L1C_NETWORK_ZIPZARR_PATH"]), async_zipfs=async_zipfs, index_cache_folder=index_cache_folder, block_cache_size=block_cache_size, use_mmap=use_mmap, skip_instance_cache=skip_instance_cache)
+        elif (storage == "s3"):
+            return get_s3_zipzarr_store(s3_endpoint=s3_endpoint_url, s3_bucket=os.environ["DSLAB_S2L1C_S3_ZIPZARR_BUCKET"], zip_key=parse_zip_shards(os.environ["DSLAB_S2L1C_S3_ZIPZARR_KEY"]), async_zipfs=async_zipfs, index_cache_folder=index_cache_folder, block_cache_size=block_cache_size, max_concurrency=max_concurrency, hedge_quantile=hedge_quantile, skip_instance_cache=skip_instance_cache)
+
+@functools.lru_cache(maxsize=None)
+def list_data_files(path):
+    """List a file, or all files in a folder recursively. Cached, as the data does not change during a benchmark."""
+    if os.path.isfile(path):
+        return (path,)
+    return tuple(os.path.join(folder, file_name) for folder, _, file_names in os.walk(path) for file_name in file_names)
+
+def evict_page_cache(path):
+    """Evict a file, or all files in a folder recursively, from the OS page cache using posix_fadvise(DONTNEED)."""
+    for file_path in list_data_files(path):
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+def reset_gdal_caches():
+    """Close the GDAL datasets of earlier loads and empty the GDAL raster block cache.
+
+    The datasets opened by rioxarray are left in reference cycles after a load, so they are
+    closed, dropping their cached data, by a garbage collection. The block cache is emptied by
+    shrinking it to zero and restoring its size.
+    """
+    gc.collect()
+    cache_max = get_gdal_config("GDAL_CACHEMAX")
+    set_gdal_config("GDAL_CACHEMAX", 0)
+    set_gdal_config("GDAL_CACHEMAX", cache_max)
+
+def get_local_data_paths(storage, format, tile, year):
+    """Get the local paths of the data of a tile and a year loaded from a storage and a format, empty for S3."""
+    if storage == "s3":
+        return []
+    path = os.environ[f"DSLAB_S2L1C_{storage.upper()}_{format.upper()}_PATH"]
+    if format == "safe":
+        # The SAFE loads read the SAFEs of all tiles of the year
+        return [f"{path}/Sentinel-2/MSI/L1C/{year}"]
+    elif format == "cog":
+        return [f"{path}/{tile[:2]}/{tile[2]}/{tile[3:]}/{year}"]
+    elif format == "zipzarr":
+        zip_path = parse_zip_shards(path)
+        return list(zip_path.values()) if isinstance(zip_path, dict) else [zip_path]
+    return [f"{path}/{tile}/{year}"]
+
+def year_datacube_benchmark_zarr(tile, year, patch_crs_coords, zarr_store, timer=None, time_start=None, time_end=None, consolidated=True):
+    timer = timer or PhaseTimer()
     start = time.time()
     band_group_datacubes = {}
     for band_group in band_groups.keys():
@@ -248,13 +433,27 @@ def year_datacube_benchmark_zarr(tile, year, patch_crs_coords, zarr_store):
             abs(patch_crs_coords[3]-patch_crs_coords[1])//band_groups[band_group]["resolution"],
             abs(patch_crs_coords[2]-patch_crs_coords[0])//band_groups[band_group]["resolution"]
         ))
+    if consolidated:
+        with timer.phase("metadata"):
+            # A single read of the consolidated metadata of the tile/year covers all band groups. Zarrs
+            # without it (converted before, or interrupted) fall back to reading the metadata of each band group
+            year_zarrgroup = zarr.open_group(store=zarr_store, path=f"{tile}/{year}", mode="r", zarr_format=3, use_consolidated=None)
     for band_group in band_groups.keys():
         #print(f"/{tile}/{year}/{band_group}")
-        ds = xr.open_zarr(store=zarr_store, group=f"/{tile}/{year}/{band_group}", zarr_format=3, chunks={}, consolidated=False)
-        geo_transform = str_transform_to_transform(ds.attrs.get("transform", None))
-        upper_left_x, upper_left_y, lower_right_x, lower_right_y = get_patch_image_coords(geo_transform, *patch_crs_coords)
-        patch_data = ds['data'].data[:, :, upper_left_y:lower_right_y, upper_left_x:lower_right_x]  # Uses Dask array slicing
-        band_group_datacubes[band_group] = patch_data.compute()  # Only computes required part
+        with timer.phase("metadata"):
+            if consolidated:
+                ds = xr.open_dataset(xr.backends.ZarrStore(year_zarrgroup[band_group]), chunks={})
+            else:
+                ds = xr.open_zarr(store=zarr_store, group=f"/{tile}/{year}/{band_group}", zarr_format=3, chunks={}, consolidated=False)
+        with timer.phase("geotransform"):
+            geo_transform = str_transform_to_transform(ds.attrs.get("transform", None))
+            upper_left_x, upper_left_y, lower_right_x, lower_right_y = get_patch_image_coords(geo_transform, *patch_crs_coords)
+            # The time coordinate is loaded when opening, so only the chunks of the time window are fetched
+            time_slice = get_time_slice(ds["time"].values, time_start, time_end)
+        with timer.phase("assembly"):
+            patch_data = ds['data'].data[time_slice, :, upper_left_y:lower_right_y, upper_left_x:lower_right_x]  # Uses Dask array slicing
+        with timer.phase("load"):
+            band_group_datacubes[band_group] = patch_data.compute()  # Only computes required part
     duration = time.time() - start
     return duration, band_group_datacubes
 
@@ -278,7 +477,20 @@ def parse_arguments():
         "y1": bounding_cube["y1"],
         "x2": bounding_cube["x2"],
         "y2": bounding_cube["y2"],
-        "async_zipfs": True
+        "async_zipfs": True,
+        "zipfs_block_cache_mib": 0,
+        "zipfs_mmap": False,
+        "zipfs_max_concurrency": 0,
+        "zipfs_hedge_quantile": 0,
+        "cache_mode": "uncontrolled",
+        "s3_standin": False,
+        "s3_standin_latency_ms": 0,
+        "s3_standin_bandwidth_mibps": 0,
+        "s3_standin_request_bandwidth_mibps": 0,
+        "s3_standin_max_connections": 0,
+        "time_start": None,
+        "time_end": None,
+        "zarr_metadata": "consolidated"
     }
 
     parser.add_argument(
@@ -294,7 +506,7 @@ def parse_arguments():
         '--formats',
         type=str,
         nargs='+',
-        choices=["safe", "cog", "zarr", "zipzarr"],
+        choices=["safe", "cog", "zarr", "zipzarr", "shardedzarr"],
         default=defaults["formats"],
         help=f'List of space-separated ids of formats to benchmark, default: {" ".join(defaults["formats"])}'
     )
@@ -350,48 +562,179 @@ def parse_arguments():
         default=defaults["async_zipfs"],
         help=f'Use async zip file system: {defaults["async_zipfs"]}'
     )
+    parser.add_argument(
+        '--zipfs_block_cache_mib',
+        type=int,
+        default=defaults["zipfs_block_cache_mib"],
+        help=f'Memory budget (MiB) of the async zip file system block cache, 0 to disable, default: {defaults["zipfs_block_cache_mib"]}'
+    )
+    parser.add_argument(
+        '--zipfs_mmap',
+        action=argparse.BooleanOptionalAction,
+        default=defaults["zipfs_mmap"],
+        help=f'Memory-map local zipped Zarrs in the async zip file system, default: {defaults["zipfs_mmap"]}'
+    )
+    parser.add_argument(
+        '--zipfs_max_concurrency',
+        type=int,
+        default=defaults["zipfs_max_concurrency"],
+        help=f'Maximum number of concurrent S3 reads by the async zip file system, 0 for no limit, default: {defaults["zipfs_max_concurrency"]}'
+    )
+    parser.add_argument(
+        '--zipfs_hedge_quantile',
+        type=float,
+        default=defaults["zipfs_hedge_quantile"],
+        help=f'Latency quantile (for example 0.95) after which the async zip file system re-issues an S3 read, 0 to disable, default: {defaults["zipfs_hedge_quantile"]}'
+    )
+
+    parser.add_argument(
+        '--cache_mode',
+        type=str,
+        choices=["uncontrolled", "cold", "warm"],
+        default=defaults["cache_mode"],
+        help=f'Cache mode: uncontrolled, cold (page cache evicted and fresh store instances before each load) or warm (data pre-read before each load), default: {defaults["cache_mode"]}'
+    )
+
+    parser.add_argument(
+        '--s3_standin',
+        action=argparse.BooleanOptionalAction,
+        default=defaults["s3_standin"],
+        help=f'Benchmark the s3 storage against a local S3 stand-in server serving the network storage, default: {defaults["s3_standin"]}'
+    )
+    parser.add_argument(
+        '--s3_standin_latency_ms',
+        type=float,
+        default=defaults["s3_standin_latency_ms"],
+        help=f'Latency (ms) injected into each request by the S3 stand-in, default: {defaults["s3_standin_latency_ms"]}'
+    )
+    parser.add_argument(
+        '--s3_standin_bandwidth_mibps',
+        type=float,
+        default=defaults["s3_standin_bandwidth_mibps"],
+        help=f'Total bandwidth cap (MiB/s) of the S3 stand-in, 0 for no cap, default: {defaults["s3_standin_bandwidth_mibps"]}'
+    )
+    parser.add_argument(
+        '--s3_standin_request_bandwidth_mibps',
+        type=float,
+        default=defaults["s3_standin_request_bandwidth_mibps"],
+        help=f'Bandwidth cap (MiB/s) of each request to the S3 stand-in, 0 for no cap, default: {defaults["s3_standin_request_bandwidth_mibps"]}'
+    )
+    parser.add_argument(
+        '--s3_standin_max_connections',
+        type=int,
+        default=defaults["s3_standin_max_connections"],
+        help=f'Maximum number of requests served at a time by the S3 stand-in, 0 for no limit, default: {defaults["s3_standin_max_connections"]}'
+    )
+
+    parser.add_argument(
+        '--time_start',
+        type=np.datetime64,
+        default=defaults["time_start"],
+        help=f'First UTC time (inclusive) of the time window to load, for example 2024-06-01, Zarr formats only, default (start of year): {defaults["time_start"]}'
+    )
+
+    parser.add_argument(
+        '--time_end',
+        type=np.datetime64,
+        default=defaults["time_end"],
+        help=f'End UTC time (exclusive) of the time window to load, for example 2024-09-01, Zarr formats only, default (end of year): {defaults["time_end"]}'
+    )
+
+    parser.add_argument(
+        '--zarr_metadata',
+        type=str,
+        choices=["consolidated", "unconsolidated", "both"],
+        default=defaults["zarr_metadata"],
+        help=f'How Zarr formats open the metadata: through the consolidated metadata of the tile/year if present, from the metadata of each group and array, or both for comparison, default: {defaults["zarr_metadata"]}'
+    )
 
     return parser.parse_args()
 
-def benchmark(storages, formats, num_repeats, year, tile, x1, y1, x2, y2, async_zipfs):
-    if "s3" in storages:
+def benchmark(storages, formats, num_repeats, year, tile, x1, y1, x2, y2, async_zipfs, zipfs_block_cache_mib, zipfs_mmap, zipfs_max_concurrency, zipfs_hedge_quantile, cache_mode, s3_standin, s3_standin_latency_ms, s3_standin_bandwidth_mibps, s3_standin_request_bandwidth_mibps, s3_standin_max_connections, time_start=None, time_end=None, zarr_metadata="consolidated"):
+    if (time_start is not None or time_end is not None) and ("safe" in formats or "cog" in formats):
+        raise ValueError("A time window is only supported by the Zarr formats")
+    s3_standin_server = None
+    s3_endpoint_url = None
+    if "s3" in storages and s3_standin:
+        s3_standin_server = start_s3_standin(
+            latency=s3_standin_latency_ms / 1000,
+            bandwidth=s3_standin_bandwidth_mibps * 1024**2 or None,
+            request_bandwidth=s3_standin_request_bandwidth_mibps * 1024**2 or None,
+            max_connections=s3_standin_max_connections or None
+        )
+        s3_endpoint_url = s3_standin_server.endpoint_url
+        print(f"Using S3 stand-in at {s3_endpoint_url}")
+    elif "s3" in storages:
         s3_session = boto3.Session(profile_name=os.environ["DSLAB_S2L1C_S3_PROFILE"])
         s3_client = s3_session.client('s3')
         s3_endpoint_url = s3_client.meta.endpoint_url    
+    if cache_mode == "cold" and ("safe" in formats or "cog" in formats):
+        # GDAL does not keep the /vsicurl/ data of the SAFE and COG loads from S3 after the files are closed
+        set_gdal_config("CPL_VSIL_CURL_NON_CACHED", "/vsicurl/")
     benchmark_timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
     print(f"Benchmarking loading data for tile {tile}, year {year}")
     log = {
         "tile": tile,
         "year": year,
+        "cache_mode": cache_mode,
+        "time_start": str(time_start) if time_start is not None else None,
+        "time_end": str(time_end) if time_end is not None else None,
+        "zarr_metadata": zarr_metadata,
+        # Settings that change the results, so that the benchmark report does not pool runs with different settings
+        "s3": {
+            "standin": s3_standin,
+            "standin_latency_ms": s3_standin_latency_ms,
+            "standin_bandwidth_mibps": s3_standin_bandwidth_mibps,
+            "standin_request_bandwidth_mibps": s3_standin_request_bandwidth_mibps,
+            "standin_max_connections": s3_standin_max_connections
+        } if s3_standin else {"standin": False},
+        "zipfs": {
+            "async": async_zipfs,
+            "index_cache": os.environ.get("DSLAB_ZIPFS_INDEX_CACHE_FOLDER") is not None and cache_mode != "cold",
+            "block_cache_mib": zipfs_block_cache_mib,
+            "mmap": zipfs_mmap,
+            "max_concurrency": zipfs_max_concurrency,
+            "hedge_quantile": zipfs_hedge_quantile
+        },
         "results": {}
     }
+    def get_format_modes(format):
+        # (Result key, consolidated) of each metadata mode of a format. Unconsolidated Zarr results are
+        # under the key <format>_unconsolidated
+        if format not in ["zarr", "zipzarr", "shardedzarr"]:
+            return [(format, None)]
+        modes = {"consolidated": [True], "unconsolidated": [False], "both": [True, False]}[zarr_metadata]
+        return [(format if consolidated else f"{format}_unconsolidated", consolidated) for consolidated in modes]
     for storage in storages:
         log["results"][storage] = {}
         for format in formats:
-            log["results"][storage][format] = {
-                "durations": [],
-                "band_group_shapes": {},
-                "total_duration": 0,
-            }
-    if "zarr" in formats or "zipzarr" in formats:
+            for result_key, _ in get_format_modes(format):
+                log["results"][storage][result_key] = {
+                    "durations": [],
+                    "band_group_shapes": {},
+                    "total_duration": 0,
+                    "instrumentation": []
+                }
+    def open_zarr_store(storage, format, skip_instance_cache=False):
+        # Wrapped to count the requests and bytes of the store
+        return InstrumentedStore(open_unwrapped_zarr_store(storage, format, skip_instance_cache))
+    def open_unwrapped_zarr_store(storage, format, skip_instance_cache=False):
+        # The index cache is not used in the cold cache mode
+        index_cache_folder = os.environ.get("DSLAB_ZIPFS_INDEX_CACHE_FOLDER") if cache_mode != "cold" else None
+        return get_benchmark_zarr_store(storage, format, s3_endpoint_url, async_zipfs=async_zipfs, index_cache_folder=index_cache_folder, block_cache_size=zipfs_block_cache_mib*1024*1024, use_mmap=zipfs_mmap, max_concurrency=zipfs_max_concurrency or None, hedge_quantile=zipfs_hedge_quantile or None, skip_instance_cache=skip_instance_cache)
+
+    if "zarr" in formats or "zipzarr" in formats or "shardedzarr" in formats:
         zarr_stores = {}
         for storage in storages:
             zarr_stores[storage] = {}
-            for format in filter(lambda x: x in ["zarr", "zipzarr"], formats):
-                if format == "zarr":
-                    if (storage == "temp"):
-                        zarr_stores[storage][format] = get_zarr_store(folder=os.environ["DSLAB_S2L1C_TEMP_ZARR_PATH"])
-                    elif (storage == "network"):
-                        zarr_stores[storage][format] = get_zarr_store(folder=os.environ["DSLAB_S2L1C_NETWORK_ZARR_PATH"])
-                    elif (storage == "s3"):
-                        zarr_stores[storage][format] = get_s3_zarr_store(s3_endpoint=s3_endpoint_url, s3_bucket=os.environ["DSLAB_S2L1C_S3_ZARR_BUCKET"])
-                elif format == "zipzarr":
-                    if (storage == "temp"):
-                        zarr_stores[storage][format] = get_zipzarr_store(zip_path=os.environ["DSLAB_S2L1C_TEMP_ZIPZARR_PATH"], async_zipfs=async_zipfs)
-                    elif (storage == "network"):
-                        zarr_stores[storage][format] = get_zipzarr_store(zip_path=os.environ["DSLAB_S2L1C_NETWORK_ZIPZARR_PATH"], async_zipfs=async_zipfs)
-                    elif (storage == "s3"):
-                        zarr_stores[storage][format] = get_s3_zipzarr_store(s3_endpoint=s3_endpoint_url, s3_bucket=os.environ["DSLAB_S2L1C_S3_ZIPZARR_BUCKET"], zip_key=os.environ["DSLAB_S2L1C_S3_ZIPZARR_KEY"], async_zipfs=async_zipfs)
+            for format in filter(lambda x: x in ["zarr", "zipzarr", "shardedzarr"], formats):
+                zarr_stores[storage][format] = open_zarr_store(storage, format)
+    def get_zipfs(storage, format):
+        # The async zip file system of a zipped Zarr store, or None
+        if format != "zipzarr":
+            return None
+        fs = getattr(zarr_stores[storage][format]._store, "fs", None)
+        return fs if isinstance(fs, (ReadOnlyZipFileSystem, ShardedZipFileSystem)) else None
     random.seed(42)
     for repeat in range(num_repeats + 1):
         random.shuffle(storages)
@@ -400,40 +743,79 @@ def benchmark(storages, formats, num_repeats, year, tile, x1, y1, x2, y2, async_
         for storage in storages:
             print(storage)
             for format in formats:
-                print(format)
-                if format == "safe":
-                    if (storage == "temp"):
-                        duration, band_group_datacubes = year_datacube_benchmark_safe(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_TEMP_SAFE_PATH"])
-                    elif (storage == "network"):
-                        duration, band_group_datacubes = year_datacube_benchmark_safe(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_NETWORK_SAFE_PATH"])
-                    elif (storage == "s3"):
-                        duration, band_group_datacubes = year_datacube_benchmark_safe(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_NETWORK_SAFE_PATH"], storage="s3", s3_endpoint=s3_endpoint_url, s3_bucket=os.environ["DSLAB_S2L1C_S3_SAFE_BUCKET"])
-                elif format == "cog":
-                    if (storage == "temp"):
-                        duration, band_group_datacubes = year_datacube_benchmark_cog(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_TEMP_COG_PATH"])
-                    elif (storage == "network"):
-                        duration, band_group_datacubes = year_datacube_benchmark_cog(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_NETWORK_COG_PATH"])
-                    elif (storage == "s3"):
-                        duration, band_group_datacubes = year_datacube_benchmark_cog(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_NETWORK_COG_PATH"], storage="s3", s3_endpoint=s3_endpoint_url, s3_bucket=os.environ["DSLAB_S2L1C_S3_COG_BUCKET"])
-                elif format == "zarr" or format == "zipzarr":
-                    zarr_store = zarr_stores[storage][format]
-                    duration, band_group_datacubes = year_datacube_benchmark_zarr(tile, year, patch_crs_coords, zarr_store)
-                if repeat > 0:
-                    log["results"][storage][format]["total_duration"] += duration
-                    log["results"][storage][format]["durations"].append(duration)
-                    log["results"][storage][format]["mean_durations"] = np.mean(log["results"][storage][format]["durations"])
-                    log["results"][storage][format]["std_durations"] = np.std(log["results"][storage][format]["durations"])
-                    log["results"][storage][format]["stderr_durations"] = np.std(log["results"][storage][format]["durations"]) / len(log["results"][storage][format]["durations"])           
-                    log["results"][storage][format]["band_group_shapes"] = {}
-                    for band_group, band_group_datacube in band_group_datacubes.items():
-                        log["results"][storage][format]["band_group_shapes"][band_group] = band_group_datacube.shape
+                # Alternate the order of the metadata modes between repeats
+                for result_key, consolidated in get_format_modes(format)[::-1 if repeat % 2 else 1]:
+                    print(result_key)
+                    def load(timer=None):
+                        if format == "safe":
+                            if (storage == "temp"):
+                                duration, band_group_datacubes = year_datacube_benchmark_safe(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_TEMP_SAFE_PATH"], timer=timer)
+                            elif (storage == "network"):
+                                duration, band_group_datacubes = year_datacube_benchmark_safe(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_NETWORK_SAFE_PATH"], timer=timer)
+                            elif (storage == "s3"):
+                                duration, band_group_datacubes = year_datacube_benchmark_safe(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_NETWORK_SAFE_PATH"], storage="s3", s3_endpoint=s3_endpoint_url, s3_bucket=os.environ["DSLAB_S2L1C_S3_SAFE_BUCKET"], timer=timer)
+                        elif format == "cog":
+                            if (storage == "temp"):
+                                duration, band_group_datacubes = year_datacube_benchmark_cog(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_TEMP_COG_PATH"], timer=timer)
+                            elif (storage == "network"):
+                                duration, band_group_datacubes = year_datacube_benchmark_cog(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_NETWORK_COG_PATH"], timer=timer)
+                            elif (storage == "s3"):
+                                duration, band_group_datacubes = year_datacube_benchmark_cog(year, patch_crs_coords, folder=os.environ["DSLAB_S2L1C_NETWORK_COG_PATH"], storage="s3", s3_endpoint=s3_endpoint_url, s3_bucket=os.environ["DSLAB_S2L1C_S3_COG_BUCKET"], timer=timer)
+                        elif format in ["zarr", "zipzarr", "shardedzarr"]:
+                            zarr_store = zarr_stores[storage][format]
+                            duration, band_group_datacubes = year_datacube_benchmark_zarr(tile, year, patch_crs_coords, zarr_store, timer=timer, time_start=time_start, time_end=time_end, consolidated=consolidated)
+                        return duration, band_group_datacubes
+                    if cache_mode == "cold":
+                        # Evict the local data of the tile and year from the page cache and use fresh file system and store instances
+                        for local_data_path in get_local_data_paths(storage, format, tile, year):
+                            evict_page_cache(local_data_path)
+                        if format in ["safe", "cog"]:
+                            reset_gdal_caches()
+                        if format in ["zarr", "zipzarr", "shardedzarr"]:
+                            zipfs = get_zipfs(storage, format)
+                            if zipfs is not None:
+                                # Release the memory mapping of the replaced file system
+                                zipfs.close()
+                            zarr_stores[storage][format] = open_zarr_store(storage, format, skip_instance_cache=True)
+                    elif cache_mode == "warm":
+                        # Pre-read the same data before the measured load
+                        load()
+                    zipfs = get_zipfs(storage, format)
+                    zipfs_stats_before = zipfs.read_stats() if zipfs is not None else None
+                    store_stats_before = zarr_stores[storage][format].stats() if format in ["zarr", "zipzarr", "shardedzarr"] else None
+                    process_io_before = read_process_io()
+                    timer = PhaseTimer()
+                    duration, band_group_datacubes = load(timer)
+                    instrumentation = {
+                        "phase_durations": timer.durations,
+                        "store": diff_counters(zarr_stores[storage][format].stats(), store_stats_before) if store_stats_before is not None else None,
+                        "zipfs": diff_counters({name: zipfs.read_stats()[name] for name in ["requests", "bytes"]}, zipfs_stats_before) if zipfs is not None else None,
+                        "process_io": diff_counters(read_process_io(), process_io_before)
+                    }
+                    if repeat > 0:
+                        log["results"][storage][result_key]["total_duration"] += duration
+                        log["results"][storage][result_key]["durations"].append(duration)
+                        log["results"][storage][result_key]["mean_durations"] = np.mean(log["results"][storage][result_key]["durations"])
+                        log["results"][storage][result_key]["std_durations"] = np.std(log["results"][storage][result_key]["durations"])
+                        log["results"][storage][result_key]["stderr_durations"] = np.std(log["results"][storage][result_key]["durations"]) / np.sqrt(len(log["results"][storage][result_key]["durations"]))
+                        log["results"][storage][result_key]["instrumentation"].append(instrumentation)
+                        log["results"][storage][result_key]["band_group_shapes"] = {}
+                        for band_group, band_group_datacube in band_group_datacubes.items():
+                            log["results"][storage][result_key]["band_group_shapes"][band_group] = band_group_datacube.shape
+                        if zipfs is not None:
+                            # Cumulative read statistics of the async zip file system, including the warmup run
+                            log["results"][storage][result_key]["zipfs_read_stats"] = zipfs.read_stats()
         if repeat > 0:
+            if s3_standin_server is not None:
+                log["s3_standin"] = s3_standin_server.stats()
             # Serializing json
             logpath = Path(os.environ["DSLAB_LOG_FOLDER"]) / f"sentinel2_l1c_{benchmark_timestamp}.json"
             print(f"Writing log to: {logpath}")
             logpath.parent.mkdir(parents=True, exist_ok=True)
             with open(logpath, "w") as out_file:
                 json.dump(log, out_file, indent = 4)    
+    if s3_standin_server is not None:
+        s3_standin_server.stop()
 
 if __name__=="__main__":
     args = parse_arguments()
@@ -0,0 +1,280 @@
+import numpy as np
+import os
+import csv
+import json
+import datetime
+import argparse
+from pathlib import Path
+
+def format_settings(settings):
+    """Format a dict of settings as a compact string, like "mmap=True block_cache_mib=64"."""
+    return " ".join(f"{name}={value}" for name, value in settings.items())
+
+def get_s3_settings(log):
+    """Get the S3 server of a log: the real S3 or the S3 stand-in with its settings, or "" if not recorded."""
+    if "s3" not in log:
+        # Older logs only have the statistics of the S3 stand-in, if it was used
+        return "standin" if "s3_standin" in log else ""
+    settings = dict(log["s3"])
+    if not settings.pop("standin"):
+        return "s3"
+    return format_settings({"standin": True, **settings})
+
+def load_benchmark_logs(paths):
+    """Load the per-load durations from patch load benchmark logs.
+
+    Args:
+        paths: Paths of benchmark log JSON files, or of folders with benchmark log JSON files.
+
+    Returns:
+        Dict of resolved log path -> dict of (benchmark, tile, year, storage, format, cache_mode,
+        s3, zipfs) -> list of durations, where benchmark is "loader" for the patch loader logs
+        and "patch_load" for the patch load benchmark logs, which measure different things and
+        are not pooled. Runs with different cache modes, S3 servers (s3, only for the s3
+        storage) or async zip file system settings (zipfs, only for the zipzarr format) are not
+        pooled either. Logs without per-load durations, like the concurrent benchmark logs,
+        are skipped.
+    """
+    log_paths = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            log_paths += sorted(path.glob("sentinel2_l1c_*.json"))
+        else:
+            log_paths.append(path)
+    logs = {}
+    for log_path in dict.fromkeys(log_path.resolve() for log_path in log_paths):
+        with open(log_path, "r") as file:
+            log = json.load(file)
+        # The patch loader logs have a list of years
+        benchmark = "patch_load" if "year" in log else "loader"
+        year = log["year"] if "year" in log else " ".join(map(str, log.get("years", [])))
+        if log.get("time_start") is not None or log.get("time_end") is not None:
+            # Time window loads are not pooled with full year loads
+            year = f"{year} [{log.get('time_start') or ''}, {log.get('time_end') or ''})"
+        cache_mode = log.get("cache_mode", "uncontrolled")
+        groups = {}
+        for storage, storage_results in log.get("results", {}).items():
+            for format, format_results in storage_results.items():
+                if isinstance(format_results, dict) and len(format_results.get("durations", [])) > 0:
+                    if log.get("consolidated") is False:
+                        # The patch loader logs record the metadata mode of the Zarr per log
+                        format = f"{format}_unconsolidated"
+                    s3 = get_s3_settings(log) if storage == "s3" else ""
+                    zipfs = format_settings(log.get("zipfs", {})) if format.startswith("zipzarr") else ""
+                    groups[(benchmark, log.get("tile"), str(year), storage, format, cache_mode, s3, zipfs)] = format_results["durations"]
+        if len(groups) == 0:
+            print(f"Skipping {log_path}, no per-load durations")
+            continue
+        logs[str(log_path)] = groups
+    return logs
+
+def bootstrap_means(rng, durations, num_bootstrap):
+    """Get the means of bootstrap resamples of durations."""
+    durations = np.asarray(durations)
+    return durations[rng.integers(0, len(durations), size=(num_bootstrap, len(durations)))].mean(axis=1)
+
+def get_statistics(rng, durations, confidence, num_bootstrap):
+    """Get summary statistics of durations.
+
+    The standard error is the sample standard deviation divided by the square
+    root of the number of durations. The confidence interval of the mean is a
+    bootstrap percentile interval.
+    """
+    durations = np.asarray(durations)
+    n = len(durations)
+    std = np.std(durations, ddof=1) if n > 1 else 0.0
+    means = bootstrap_means(rng, durations, num_bootstrap)
+    alpha = 1 - confidence
+    return {
+        "n": n,
+        "mean": np.mean(durations),
+        "std": std,
+        "stderr": std / np.sqrt(n),
+        "ci_low": np.quantile(means, alpha / 2),
+        "ci_high": np.quantile(means, 1 - alpha / 2),
+        "p50": np.percentile(durations, 50),
+        "p90": np.percentile(durations, 90),
+        "p99": np.percentile(durations, 99),
+        "min": np.min(durations),
+        "max": np.max(durations)
+    }
+
+def compare_to_baseline(rng, durations, baseline_durations, confidence, num_bootstrap, threshold):
+    """Compare durations to baseline durations.
+
+    The difference of the means is significant if its bootstrap confidence
+    interval excludes zero. A significant relative increase of the mean
+    larger than threshold is a regression, and a significant relative
+    decrease larger than threshold is an improvement.
+    """
+    differences = bootstrap_means(rng, durations, num_bootstrap) - bootstrap_means(rng, baseline_durations, num_bootstrap)
+    alpha = 1 - confidence
+    ci_low, ci_high = np.quantile(differences, alpha / 2), np.quantile(differences, 1 - alpha / 2)
+    baseline_mean = np.mean(baseline_durations)
+    change = (np.mean(durations) - baseline_mean) / baseline_mean
+    if ci_low > 0 and change > threshold:
+        flag = "regression"
+    elif ci_high < 0 and -change > threshold:
+        flag = "improvement"
+    else:
+        flag = ""
+    return {
+        "baseline_mean": baseline_mean,
+        "change": change,
+        "change_ci_low": ci_low / baseline_mean,
+        "change_ci_high": ci_high / baseline_mean,
+        "flag": flag
+    }
+
+def get_report_rows(logs, baseline=None, confidence=0.95, num_bootstrap=10000, threshold=0.0, seed=42):
+    """Get the report rows of pooled durations per benchmark, tile, year, storage, format and settings.
+
+    Args:
+        logs: Output of load_benchmark_logs.
+        baseline: Resolved path of the baseline log in logs, or None. The baseline log
+            is not pooled with the other logs, which are compared to it.
+        confidence: Confidence level of the confidence intervals.
+        num_bootstrap: Number of bootstrap resamples.
+        threshold: Minimum relative change of the mean to flag.
+        seed: Random seed of the bootstrap.
+
+    Returns:
+        List of dicts, one per benchmark, tile, year, storage, format and settings.
+    """
+    rng = np.random.default_rng(seed)
+    pooled = {}
+    for log_path, groups in logs.items():
+        if log_path == baseline:
+            continue
+        for key, durations in groups.items():
+            pooled.setdefault(key, []).extend(durations)
+    baseline_groups = logs[baseline] if baseline is not None else {}
+    rows = []
+    for key in sorted(pooled):
+        benchmark, tile, year, storage, format, cache_mode, s3, zipfs = key
+        row = {"benchmark": benchmark, "tile": tile, "year": year, "storage": storage, "format": format, "cache_mode": cache_mode, "s3": s3, "zipfs": zipfs}
+        row.update(get_statistics(rng, pooled[key], confidence, num_bootstrap))
+        if key in baseline_groups:
+            row.update(compare_to_baseline(rng, pooled[key], baseline_groups[key], confidence, num_bootstrap, threshold))
+        rows.append(row)
+    return rows
+
+def format_value(value):
+    if isinstance(value, (float, np.floating)):
+        return f"{value:.4g}"
+    return str(value)
+
+def write_markdown(rows, file, confidence):
+    columns = ["benchmark", "tile", "year", "storage", "format", "cache_mode", "s3", "zipfs", "n", "mean", "stderr", "ci_low", "ci_high", "p50", "p90", "p99"]
+    headers = columns[:5] + ["cache mode", "s3", "zipfs", "n", "mean", "stderr", f"{confidence:.0%} CI low", f"{confidence:.0%} CI high", "p50", "p90", "p99"]
+    if any("baseline_mean" in row for row in rows):
+        columns += ["baseline_mean", "change", "flag"]
+        headers += ["baseline mean", "change", "flag"]
+    file.write("| " + " | ".join(headers) + " |\n")
+    file.write("|" + "---|" * len(headers) + "\n")
+    for row in rows:
+        values = []
+        for column in columns:
+            value = row.get(column, "")
+            if column == "change" and value != "":
+                value = f"{value:+.1%} ({row['change_ci_low']:+.1%} to {row['change_ci_high']:+.1%})"
+            elif column == "flag" and value != "":
+                value = f"**{value}**"
+            values.append(format_value(value))
+        file.write("| " + " | ".join(values) + " |\n")
+
+def write_csv(rows, file):
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    writer = csv.DictWriter(file, fieldnames=columns)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({column: row.get(column, "") for column in columns})
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Report statistics of patch load benchmark logs and flag regressions against a baseline log'
+    )
+
+    defaults = {
+        "logs": [os.environ.get("DSLAB_LOG_FOLDER", ".")],
+        "baseline": None,
+        "confidence": 0.95,
+        "num_bootstrap": 10000,
+        "threshold": 0.0,
+        "output_prefix": None
+    }
+
+    parser.add_argument(
+        '--logs',
+        type=str,
+        nargs='+',
+        default=defaults["logs"],
+        help=f'List of space-separated benchmark log files or folders of them, default (from env var DSLAB_LOG_FOLDER): {" ".join(defaults["logs"])}'
+    )
+
+    parser.add_argument(
+        '--baseline',
+        type=str,
+        default=defaults["baseline"],
+        help=f'Baseline benchmark log file to compare the other logs to, default: {defaults["baseline"]}'
+    )
+
+    parser.add_argument(
+        '--confidence',
+        type=float,
+        default=defaults["confidence"],
+        help=f'Confidence level of the bootstrap confidence intervals, default: {defaults["confidence"]}'
+    )
+
+    parser.add_argument(
+        '--num_bootstrap',
+        type=int,
+        default=defaults["num_bootstrap"],
+        help=f'Number of bootstrap resamples, default: {defaults["num_bootstrap"]}'
+    )
+
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=defaults["threshold"],
+        help=f'Minimum relative change of the mean duration to flag as a regression or an improvement, default: {defaults["threshold"]}'
+    )
+
+    parser.add_argument(
+        '--output_prefix',
+        type=str,
+        default=defaults["output_prefix"],
+        help='Path prefix of the Markdown (.md) and CSV (.csv) reports, default: $DSLAB_LOG_FOLDER/sentinel2_l1c_report_YYYY-MM-DD_HH-mm-SS'
+    )
+
+    return parser.parse_args()
+
+def report(logs, baseline, confidence, num_bootstrap, threshold, output_prefix):
+    if baseline is not None:
+        baseline = str(Path(baseline).resolve())
+        logs = logs + [baseline]
+    logs = load_benchmark_logs(logs)
+    if baseline is not None and baseline not in logs:
+        raise ValueError(f"Baseline log {baseline} has no per-load durations")
+    print(f"Loaded {len(logs)} benchmark logs")
+    rows = get_report_rows(logs, baseline=baseline, confidence=confidence, num_bootstrap=num_bootstrap, threshold=threshold)
+    if output_prefix is None:
+        report_timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        output_prefix = Path(os.environ["DSLAB_LOG_FOLDER"]) / f"sentinel2_l1c_report_{report_timestamp}"
+    markdown_path = Path(f"{output_prefix}.md")
+    csv_path = Path(f"{output_prefix}.csv")
+    markdown_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(markdown_path, "w") as file:
+        write_markdown(rows, file, confidence)
+    with open(csv_path, "w", newline="") as file:
+        write_csv(rows, file)
+    print(markdown_path.read_text())
+    print(f"Wrote reports to: {markdown_path} and {csv_path}")
+    num_regressions = sum(row.get("flag") == "regression" for row in rows)
+    if num_regressions > 0:
+        print(f"{num_regressions} significant regressions against {baseline}")
+
+if __name__=="__main__":
+    args = parse_arguments()
+    report(**vars(args))
@@ -1,4 +1,12 @@
 import os
+import json
+import argparse
+import functools
+import itertools
+import contextlib
+import collections
+import multiprocessing
+import concurrent.futures
 import rasterio
 import xarray as xr
 import numpy as np
@@ -12,109 +20,317 @@ if int(zarr.__version__.split(".")[0]) < 3:
 
 from .utils import band_groups
 
-def convert(safe_from_folder = os.environ["DSLAB_S2L1C_NETWORK_SAFE_PATH"], zarr_to_folder = os.environ["DSLAB_S2L1C_NETWORK_ZARR_PATH"]):
-    start = time.time()              
-
-    zarr_store = zarr.storage.LocalStore(zarr_to_folder + "/", read_only=False)
-    
-    # Find number of items
-    total_num_items = 0
-    for year_folder in sorted((Path(safe_from_folder) / f"Sentinel-2/MSI/L1C").glob('*')):
-        # Loop over months, in order
-        for month_folder in sorted(year_folder.glob('*')):
-            # Loop over days, in order
-            for day_folder in sorted(month_folder.glob('*')):
-                # Loop over SAFEs
-                for safe_folder in day_folder.glob('*.SAFE'):
-                    total_num_items += 1
+def parse_safe_name(safe_name):
+    """Get the tile id and the UTC sensing time (as datetime64 with second precision) of a SAFE from its name."""
+    tile_id = safe_name.split(sep="_")[5][1:]  # For example "35VLH"
+    safe_time = safe_name.split(sep="_")[2]
+    utc_time = np.datetime64(f"{safe_time[:4]}-{safe_time[4:6]}-{safe_time[6:8]}T{safe_time[9:11]}:{safe_time[11:13]}:{safe_time[13:]}", "s")  # For example 2024-02-16T09:50:29
+    return tile_id, utc_time
 
-    progress = progressbar.ProgressBar(max_value=total_num_items)
+def get_safe_folders(safe_from_folder):
+    """Get the SAFE folders as a list of (year, SAFE folder), in order of sensing time."""
+    safe_folders = []
     # Loop over years, in order
-    total_num_items = 0
     for year_folder in sorted((Path(safe_from_folder) / f"Sentinel-2/MSI/L1C").glob('*')):
-        year = year_folder.name
         # Loop over months, in order
         for month_folder in sorted(year_folder.glob('*')):
-            month = month_folder.name
             # Loop over days, in order
             for day_folder in sorted(month_folder.glob('*')):
-                day = day_folder.name
-                # Loop over SAFEs
-                for safe_folder in day_folder.glob('*.SAFE'):
-                    progress.update(total_num_items)
-                    total_num_items += 1
-                    safe_name = safe_folder.name
-                    print("safe_name", safe_name)
-                    tile_id = safe_name.split(sep="_")[5][1:]  # For example "35VLH"
-                    tile_id_zarrgroup = zarr.group(store=zarr_store, path=f"{tile_id}")
-                    year_zarrgroup = tile_id_zarrgroup.require_group(f"{year}")
-                    safe_time = safe_name.split(sep="_")[2]
-                    utc_time = f"{safe_time[:4]}-{safe_time[4:6]}-{safe_time[6:8]}T{safe_time[9:11]}:{safe_time[11:13]}:{safe_time[13:]}Z"
-                    print(utc_time)  # For example "2024-02-16T09:50:29Z"
+                # Loop over SAFEs, in order of sensing time
+                for safe_folder in sorted(day_folder.glob('*.SAFE'), key=lambda safe_folder: parse_safe_name(safe_folder.name)[1]):
+                    safe_folders.append((year_folder.name, safe_folder))
+    return safe_folders
+
+def remove_consolidated_metadata(zarr_folder, group_path):
+    """Remove the consolidated metadata from the zarr.json of a group, if any.
+
+    Loaders then read the metadata of each array of the group instead, which
+    is slower but never stale.
+    """
+    metadata_path = Path(zarr_folder) / group_path / "zarr.json"
+    metadata = json.loads(metadata_path.read_text())
+    if metadata.pop("consolidated_metadata", None) is None:
+        return
+    temp_metadata_path = metadata_path.with_name("zarr.json.tmp")
+    temp_metadata_path.write_text(json.dumps(metadata, indent=2))
+    os.replace(temp_metadata_path, metadata_path)
+
+def read_band_group(granule_folder, band_group):
+    """Read and decode the band images of a band group of a SAFE granule.
+
+    Runs in a worker process. Returns the data as an array of shape (1, band, y, x),
+    and the transform and the CRS of the first band.
+    """
+    band_data_array = []
+    # Loop over bands
+    for band_index, band in enumerate(band_groups[band_group]["bands"]):
+        for img_index, img_path in enumerate((granule_folder / "IMG_DATA").glob(f'*{band}.jp2')):  # There is only one image for the band, but use a loop anyhow
+            print(img_path)
+            with rasterio.open(img_path) as src:
+                data = src.read(1)
+                band_data_array.append(data)# = (["y", "x"], data)
+                if band_index == 0 and img_index == 0:
+                    transform = src.transform
+                    crs = src.crs
+    return np.expand_dims(np.stack(band_data_array, axis=0), axis=0), transform, crs
+
+def convert(safe_from_folder = os.environ["DSLAB_S2L1C_NETWORK_SAFE_PATH"], zarr_to_folder = os.environ["DSLAB_S2L1C_NETWORK_ZARR_PATH"], sharded = False, batched = False, num_workers = 1, look_ahead = None, resume = False, max_buffer_mib = 16 * 1024):
+    start = time.time()              
+
+    if sharded and not batched:
+        # Appending one acquisition at a time would rewrite the shards of the last time shard on every append
+        print("Sharded conversion is batched, writing full time shards")
+        batched = True
+    # Size of the writes along time in batched mode, so that each time chunk or shard is written once
+    time_write_size_key = "time_shard_size" if sharded else "time_chunk_size"
+
+    zarr_store = zarr.storage.LocalStore(zarr_to_folder + "/", read_only=False)
+    
+    # Times of the acquisitions in the Zarr or on their way to it, by band group Zarr group path, see get_time_index
+    time_indexes = {}
+    def get_time_index(tile_id, year, band_group):
+        group_path = f"{tile_id}/{year}/{band_group}"
+        if group_path not in time_indexes:
+            # Read the time coordinate of the band group once, creating the groups if they do not exist
+            tile_id_zarrgroup = zarr.group(store=zarr_store, path=f"{tile_id}")
+            year_zarrgroup = tile_id_zarrgroup.require_group(f"{year}")
+            year_zarrgroup.require_group(band_group)
+            print(f"Reading the times of group {group_path}")
+            old_zarr_ds = xr.open_zarr(zarr_store, group=group_path, consolidated=False)
+            old_times = old_zarr_ds.coords["time"].values if "time" in old_zarr_ds.coords else np.array([], dtype="datetime64[s]")
+            old_zarr_ds.close()
+            if not np.issubdtype(old_times.dtype, np.datetime64):
+                raise ValueError(f"Group {group_path} has {old_times.dtype} times rather than datetime64, convert to a new Zarr folder")
+            old_times = old_times.astype("datetime64[s]")
+            time_indexes[group_path] = {"times": set(old_times), "num_written": len(old_times), "last_time": old_times.max() if len(old_times) > 0 else None}
+        return time_indexes[group_path]
+
+    # Find items
+    safe_folders = get_safe_folders(safe_from_folder)
+    total_num_items = len(safe_folders)
+    if resume:
+        # Leave out the SAFEs that are already in all band groups
+        safe_folders = [
+            (year, safe_folder) for year, safe_folder in safe_folders
+            if not all(parse_safe_name(safe_folder.name)[1] in get_time_index(parse_safe_name(safe_folder.name)[0], year, band_group)["times"] for band_group in band_groups)
+        ]
+        print(f"Resuming, {total_num_items - len(safe_folders)} of {total_num_items} SAFE items already converted")
+
+    progress = progressbar.ProgressBar(max_value=len(safe_folders))
+    # Acquisitions waiting to be written, by band group Zarr group path, see write_buffer
+    buffers = {}
+    # Tile/year group paths whose consolidated metadata was removed before writing, see write_buffer
+    unconsolidated_years = set()
+    def write_buffer(group_path):
+        buffer = buffers.pop(group_path)
+        time_index = time_indexes[group_path]
+        band_group_dict = band_groups[buffer["band_group"]]
+        bands = band_group_dict["bands"]
+        band_data_array = np.concatenate(buffer["data"], axis=0)
+        ds = xr.Dataset(
+            {"data": (["time", "band", "y", "x"], band_data_array)},
+            coords={"time": buffer["times"], "band": bands, "y": np.arange(buffer["height"]), "x": np.arange(buffer["width"])},
+            attrs={"crs": str(buffer["crs"]), "transform": str(buffer["transform"])}
+        )
+        year_path = group_path.rsplit("/", 1)[0]
+        if year_path not in unconsolidated_years:
+            # Consolidated metadata would be stale from the first write until consolidate_years,
+            # so remove it, for loaders to fall back to the metadata of each array if interrupted
+            remove_consolidated_metadata(zarr_to_folder, year_path)
+            unconsolidated_years.add(year_path)
+        print(f"Writing {len(buffer['times'])} times to {group_path}")
+        if time_index["num_written"] == 0:
+            # Create
+            compressor = zarr.codecs.BloscCodec(cname="lz4", clevel=5, shuffle=zarr.codecs.BloscShuffle('bitshuffle'))
+            encoding = {
+                "data": {
+                    "compressors": compressor,
+                    "chunks": (band_group_dict["time_chunk_size"], len(bands), band_group_dict["y_chunk_size"], band_group_dict["x_chunk_size"])  # (Time, band, Y, X) chunk sizes
+                },
+                # Explicitly define chunk size for time labels because otherwise it's 1
+                "time": {
+                    "compressor": None,
+                    "chunks": (10_000,),  # Very large number
+                    "units": "seconds since 1970-01-01",
+                    "dtype": "int64"
+                },
+            }
+            if sharded:
+                # Store the chunks inside shards, one object or file per shard, using the sharding codec
+                encoding["data"]["shards"] = (band_group_dict["time_shard_size"], len(bands), band_group_dict["y_shard_size"], band_group_dict["x_shard_size"])  # (Time, band, Y, X) shard sizes
+            print(encoding)
+            ds.to_zarr(zarr_store, mode="w", group=group_path, zarr_format=3, encoding=encoding, consolidated=False)
+        else:
+            # Append
+            ds.to_zarr(zarr_store, group=group_path, append_dim="time", zarr_format=3, consolidated=False)
+        time_index["num_written"] += len(buffer["times"])
+
+    def consolidate_years(year=None):
+        # Consolidate the metadata of the tile/year groups (of a year, or all), so that loaders can open
+        # a tile/year with a single metadata read. Later appends make it stale until consolidated again
+        for year_path in sorted({group_path.rsplit("/", 1)[0] for group_path in time_indexes}):
+            if year is None or year_path.split("/")[1] == str(year):
+                print(f"Consolidating the metadata of group {year_path}")
+                zarr.consolidate_metadata(zarr_store, path=year_path, zarr_format=3)
+                unconsolidated_years.discard(year_path)
+
+    def get_reads():
+        # Band group reads of the SAFEs, in order, leaving out the band groups that already have the time
+        for safe_index, (year, safe_folder) in enumerate(safe_folders):
+            safe_name = safe_folder.name
+            tile_id, utc_time = parse_safe_name(safe_name)
+            granule_folder = None
+            for band_group in band_groups:
+                time_index = get_time_index(tile_id, year, band_group)
+                if utc_time in time_index["times"]:
+                    print(f"{safe_name}: Zarr already contains the time {utc_time} in band group {band_group}. Do nothing (maybe this was a conversion rerun).")
+                    continue
+                # Appending an earlier time would leave the time coordinate unsorted, breaking the binary search of time windows
+                if time_index["last_time"] is not None and utc_time < time_index["last_time"]:
+                    raise ValueError(f"{safe_name}: Time {utc_time} is earlier than the last time {time_index['last_time']} of band group {band_group}, convert to a new Zarr folder")
+                time_index["times"].add(utc_time)
+                time_index["last_time"] = utc_time
+                if granule_folder is None:
                     granule_folder = next((safe_folder / "GRANULE").glob('*'))
-                    # Loop over band groups
-                    for band_group, band_group_dict in band_groups.items():
-                        print("Band group:", band_group)
-                        bands = band_group_dict["bands"]
-                        # Check whether we will create, append or skip (in case the time is already in Zarr)
-                        band_group_zarrgroup = year_zarrgroup.require_group(band_group)
-                        print(f"Checking if Zarr exists (group {band_group_zarrgroup.path})")
-                        old_zarr_ds = xr.open_zarr(zarr_store, group=band_group_zarrgroup.path, consolidated=False)
-                        if len(old_zarr_ds.variables) == 0:
-                            print("Zarr does not exist. Create it.")
-                            action = "create"
-                        elif utc_time in old_zarr_ds.coords["time"].values:
-                            print("Zarr exists and already contains this time. Do nothing (maybe this was a conversion rerun).")
-                            action = "skip"
-                        else:
-                            print("Zarr exists and doesn't contain this time. Append data for this time to Zarr.")
-                            action = "append"
-                        old_zarr_ds.close()
-                        del old_zarr_ds
-                        if action == "skip":
-                            # Skip
-                            continue
-                        band_data_array = []
-                        # Loop over bands
-                        for band_index, band in enumerate(bands):
-                            for img_index, img_path in enumerate((granule_folder / "IMG_DATA").glob(f'*{band}.jp2')):  # There is only one image for the band, but use a loop anyhow
-                                print(img_path)
-                                with rasterio.open(img_path) as src:
-                                    data = src.read(1)
-                                    band_data_array.append(data)# = (["y", "x"], data)
-                                    if band_index == 0 and img_index == 0:
-                                        transform = src.transform
-                                        crs = src.crs
-                                        height, width = src.height, src.width
-                        band_data_array = np.expand_dims(np.stack(band_data_array, axis=0), axis=0)
-                        ds = xr.Dataset(
-                            {"data": (["time", "band", "y", "x"], band_data_array)},
-                            coords={"time": [utc_time], "band": bands, "y": np.arange(height), "x": np.arange(width)},
-                            attrs={"crs": str(crs), "transform": str(transform)}
-                        )
-                        if action == "create":
-                            # Create
-                            compressor = zarr.codecs.BloscCodec(cname="lz4", clevel=5, shuffle=zarr.codecs.BloscShuffle('bitshuffle'))
-                            encoding = {
-                                "data": {
-                                    "compressors": compressor,
-                                    "chunks": (band_group_dict["time_chunk_size"], len(bands), band_group_dict["y_chunk_size"], band_group_dict["x_chunk_size"])  # (Time, band, Y, X) chunk sizes
-                                },
-                                # Explicitly define chunk size for time labels because otherwise it's 1
-                                "time": {
-                                    "compressor": None,
-                                    "chunks": (10_000,)  # Very large number
-                                },
-                            }
-                            print(encoding)
-                            ds.to_zarr(zarr_store, mode="w", group=band_group_zarrgroup.path, zarr_format=3, encoding=encoding, consolidated=False)
-                        else:
-                            # Append
-                            ds.to_zarr(zarr_store, group=band_group_zarrgroup.path, append_dim="time", zarr_format=3, consolidated=False)
+                yield safe_index, year, safe_name, band_group, granule_folder
+
+    # With several workers, the reads are decoded in worker processes, up to look_ahead reads ahead of
+    # the writing, which is done in order in this process. With one worker, each read is decoded in
+    # this process just before it is written, without pickling the decoded band group between processes.
+    reads = get_reads()
+    look_ahead = look_ahead or 2 * num_workers
+    pending_reads = collections.deque()
+    # Spawn rather than fork, as Zarr may have event loop and I/O threads running
+    executor_context = concurrent.futures.ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) if num_workers > 1 else contextlib.nullcontext()
+    with executor_context as executor:
+        def submit_reads():
+            for safe_index, year, safe_name, band_group, granule_folder in itertools.islice(reads, look_ahead - len(pending_reads)):
+                if executor is None:
+                    read = functools.partial(read_band_group, granule_folder, band_group)
+                else:
+                    read = executor.submit(read_band_group, granule_folder, band_group).result
+                pending_reads.append((safe_index, year, safe_name, band_group, read))
+        submit_reads()
+        previous_year = None
+        while len(pending_reads) > 0:
+            safe_index, year, safe_name, band_group, read = pending_reads.popleft()
+            submit_reads()
+            if year != previous_year:
+                # Write the remaining partial time chunks of the previous year
+                for group_path in list(buffers):
+                    write_buffer(group_path)
+                if previous_year is not None:
+                    consolidate_years(previous_year)
+                previous_year = year
+            progress.update(safe_index)
+            tile_id, utc_time = parse_safe_name(safe_name)
+            print("safe_name", safe_name, utc_time, "band group", band_group)
+            group_path = f"{tile_id}/{year}/{band_group}"
+            if group_path not in buffers:
+                buffers[group_path] = {"band_group": band_group, "times": [], "data": []}
+            buffer = buffers[group_path]
+            band_data_array, buffer["transform"], buffer["crs"] = read()
+            buffer["height"], buffer["width"] = band_data_array.shape[2:]
+            buffer["data"].append(band_data_array)
+            buffer["times"].append(utc_time)
+            # In batched mode, write when the buffered times complete the last time chunk (or shard), so that each is written once
+            if not batched or (time_indexes[group_path]["num_written"] + len(buffer["times"])) % band_groups[band_group][time_write_size_key] == 0:
+                write_buffer(group_path)
+            elif max_buffer_mib:
+                # Over the memory budget, write the largest buffers as partial time chunks, which are rewritten when completed
+                buffer_sizes = {buffer_path: sum(data.nbytes for data in buffers[buffer_path]["data"]) for buffer_path in buffers}
+                for buffer_path in sorted(buffer_sizes, key=buffer_sizes.get, reverse=True):
+                    if sum(buffer_sizes.values()) <= max_buffer_mib * 1024**2:
+                        break
+                    write_buffer(buffer_path)
+                    del buffer_sizes[buffer_path]
+    # Write the remaining partial time chunks of the last year
+    for group_path in list(buffers):
+        write_buffer(group_path)
+    # Also consolidates the tile/years with nothing to write, for example of a Zarr converted before
+    consolidate_years()
+    progress.update(len(safe_folders))
 
     duration = time.time() - start
     print("Duration (s):", duration)
     print("Total number of SAFE items:", total_num_items)
                             
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Convert Sentinel 2 L1C SAFEs to Zarr'
+    )
+
+    defaults = {
+        "safe_from_folder": os.environ["DSLAB_S2L1C_NETWORK_SAFE_PATH"],
+        "sharded": False,
+        "batched": False,
+        "num_workers": 1,
+        "look_ahead": 0,
+        "resume": False,
+        "max_buffer_mib": 16 * 1024
+    }
+
+    parser.add_argument(
+        '--safe_from_folder',
+        type=str,
+        default=defaults["safe_from_folder"],
+        help=f'Folder of the SAFEs, default (from env var DSLAB_S2L1C_NETWORK_SAFE_PATH): {defaults["safe_from_folder"]}'
+    )
+
+    parser.add_argument(
+        '--zarr_to_folder',
+        type=str,
+        default=None,
+        help=f'Zarr folder, default (from env var DSLAB_S2L1C_NETWORK_ZARR_PATH, or DSLAB_S2L1C_NETWORK_SHARDEDZARR_PATH if sharded): {os.environ.get("DSLAB_S2L1C_NETWORK_ZARR_PATH")}'
+    )
+
+    parser.add_argument(
+        '--sharded',
+        action=argparse.BooleanOptionalAction,
+        default=defaults["sharded"],
+        help=f'Write the band groups using the Zarr v3 sharding codec with the shard sizes in sentinel2_l1c/utils.py, implies --batched with full time shard writes, default: {defaults["sharded"]}'
+    )
+
+    parser.add_argument(
+        '--batched',
+        action=argparse.BooleanOptionalAction,
+        default=defaults["batched"],
+        help=f'Buffer the acquisitions of each band group until a time chunk is full and write full time chunks, default: {defaults["batched"]}. The buffers use up to --max_buffer_mib of memory, and writing a buffer makes a copy of it'
+    )
+
+    parser.add_argument(
+        '--max_buffer_mib',
+        type=int,
+        default=defaults["max_buffer_mib"],
+        help=f'Memory budget in MiB of the buffered acquisitions in batched mode, above which the largest buffers are written as partial time chunks, 0 for no limit, default: {defaults["max_buffer_mib"]}'
+    )
+
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=defaults["num_workers"],
+        help=f'Number of worker processes decoding band images, default: {defaults["num_workers"]}'
+    )
+
+    parser.add_argument(
+        '--look_ahead',
+        type=int,
+        default=defaults["look_ahead"],
+        help=f'Maximum number of band group reads decoded ahead of writing, 0 for twice the number of workers, default: {defaults["look_ahead"]}'
+    )
+
+    parser.add_argument(
+        '--resume',
+        action=argparse.BooleanOptionalAction,
+        default=defaults["resume"],
+        help=f'Leave out the SAFEs already converted to all band groups up front, default: {defaults["resume"]}'
+    )
+
+    args = parser.parse_args()
+    if args.zarr_to_folder is None:
+        args.zarr_to_folder = os.environ["DSLAB_S2L1C_NETWORK_SHARDEDZARR_PATH" if args.sharded else "DSLAB_S2L1C_NETWORK_ZARR_PATH"]
+    return args
+
 if __name__ == "__main__":
-    convert()
\ No newline at end of file
+    args = parse_arguments()
+    convert(**vars(args))
\ No newline at end of file
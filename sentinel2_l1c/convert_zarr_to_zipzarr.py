@@ -0,0 +1,17 @@
+import os
+import time
+import progressbar
+from zip_writer import list_folder, pack_folder
+
+def convert(zarr_from_folder = os.environ["DSLAB_S2L1C_NETWORK_ZARR_PATH"], zipzarr_to_path = os.environ["DSLAB_S2L1C_NETWORK_ZIPZARR_PATH"]):
+    start = time.time()
+    names = list_folder(zarr_from_folder)
+    progress = progressbar.ProgressBar(max_value=len(names))
+    os.makedirs(os.path.dirname(os.path.abspath(zipzarr_to_path)), exist_ok=True)
+    pack_folder(zarr_from_folder, zipzarr_to_path, names=names, progress=progress)
+    duration = time.time() - start
+    print("Duration (s):", duration)
+    print("Total number of files:", len(names))
+
+if __name__ == "__main__":
+    convert()
@@ -0,0 +1,262 @@
+import os
+import datetime
+import argparse
+import time
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+import xmltodict
+import progressbar
+from pathlib import Path
+
+from .utils import band_groups
+
+# Wavelength (MIN, MAX, CENTRAL) in nm of the physical bands, in the order of the product metadata
+band_wavelengths = {
+    "B1": (411, 456, 442.2),
+    "B2": (456, 533, 492.3),
+    "B3": (538, 583, 558.9),
+    "B4": (646, 684, 664.9),
+    "B5": (695, 714, 703.8),
+    "B6": (731, 749, 739.1),
+    "B7": (769, 797, 779.7),
+    "B8": (784, 900, 832.9),
+    "B8A": (848, 881, 864.0),
+    "B9": (930, 958, 943.2),
+    "B10": (1326, 1419, 1376.9),
+    "B11": (1539, 1684, 1610.4),
+    "B12": (2079, 2321, 2185.7)
+}
+
+band_resolutions = {band: band_group_dict["resolution"] for band_group_dict in band_groups.values() for band in band_group_dict["bands"]}
+
+def get_band_id(physical_band):
+    """Get the band id used in file names, for example "B01" for the physical band "B1"."""
+    return f"{physical_band[0]}0{physical_band[1]}" if len(physical_band) == 2 else physical_band
+
+def get_utm_epsg(tile_id):
+    """Get the EPSG code of the UTM zone CRS of a tile, for example 32635 for "35VLH"."""
+    zone = int(tile_id[:2])
+    # Latitude bands N and up are on the northern hemisphere
+    return (32600 if tile_id[2] >= "N" else 32700) + zone
+
+def get_acquisition_times(year, num_acquisitions):
+    """Get num_acquisitions UTC acquisition times evenly spaced over a year, on distinct days."""
+    year_start = datetime.datetime(year, 1, 1, 9, 50, 29)
+    num_days = (datetime.datetime(year + 1, 1, 1) - datetime.datetime(year, 1, 1)).days
+    return [year_start + datetime.timedelta(days=acquisition_index * num_days // num_acquisitions) for acquisition_index in range(num_acquisitions)]
+
+def get_product_metadata(safe_name, sensing_time):
+    """Get the MTD_MSIL1C.xml product metadata of a SAFE as a dict for xmltodict."""
+    return {
+        "n1:Level-1C_User_Product": {
+            "@xmlns:n1": "https://psd-14.sentinel2.eo.esa.int/PSD/User_Product_Level-1C.xsd",
+            "n1:General_Info": {
+                "Product_Info": {
+                    "PRODUCT_START_TIME": f"{sensing_time.isoformat()}.024Z",
+                    "PRODUCT_STOP_TIME": f"{sensing_time.isoformat()}.024Z",
+                    "PRODUCT_URI": safe_name,
+                    "PROCESSING_LEVEL": "Level-1C",
+                    "PRODUCT_TYPE": "S2MSI1C",
+                    "PROCESSING_BASELINE": "05.10",
+                    "Datatake": {
+                        "@datatakeIdentifier": f"GS2B_{sensing_time.strftime('%Y%m%dT%H%M%S')}_000000_N05.10",
+                        "SPACECRAFT_NAME": "Sentinel-2B",
+                        "DATATAKE_TYPE": "INS-NOBS",
+                        "DATATAKE_SENSING_START": f"{sensing_time.isoformat()}.024Z",
+                        "SENSING_ORBIT_NUMBER": "79",
+                        "SENSING_ORBIT_DIRECTION": "DESCENDING"
+                    }
+                },
+                "Product_Image_Characteristics": {
+                    "QUANTIFICATION_VALUE": {"@unit": "none", "#text": "10000"},
+                    "Spectral_Information_List": {
+                        "Spectral_Information": [
+                            {
+                                "@bandId": str(band_index),
+                                "@physicalBand": physical_band,
+                                "RESOLUTION": str(band_resolutions[get_band_id(physical_band)]),
+                                "Wavelength": {
+                                    "MIN": {"@unit": "nm", "#text": str(wavelength_min)},
+                                    "MAX": {"@unit": "nm", "#text": str(wavelength_max)},
+                                    "CENTRAL": {"@unit": "nm", "#text": str(wavelength_central)}
+                                }
+                            }
+                            for band_index, (physical_band, (wavelength_min, wavelength_max, wavelength_central)) in enumerate(band_wavelengths.items())
+                        ]
+                    }
+                }
+            }
+        }
+    }
+
+def get_tile_metadata(tile_id, granule, sensing_time, size, ulx, uly):
+    """Get the MTD_TL.xml tile metadata of a SAFE granule as a dict for xmltodict."""
+    epsg = get_utm_epsg(tile_id)
+    resolutions = sorted(set(band_resolutions.values()))
+    return {
+        "n1:Level-1C_Tile_ID": {
+            "@xmlns:n1": "https://psd-14.sentinel2.eo.esa.int/PSD/S2_PDI_Level-1C_Tile_Metadata.xsd",
+            "n1:General_Info": {
+                "TILE_ID": granule,
+                "SENSING_TIME": f"{sensing_time.isoformat()}.024Z"
+            },
+            "n1:Geometric_Info": {
+                "Tile_Geocoding": {
+                    "HORIZONTAL_CS_NAME": f"WGS84 / UTM zone {tile_id[:2]}{'N' if epsg < 32700 else 'S'}",
+                    "HORIZONTAL_CS_CODE": f"EPSG:{epsg}",
+                    "Size": [
+                        {"@resolution": str(resolution), "NROWS": str(size * 10 // resolution), "NCOLS": str(size * 10 // resolution)}
+                        for resolution in resolutions
+                    ],
+                    "Geoposition": [
+                        {"@resolution": str(resolution), "ULX": str(ulx), "ULY": str(uly), "XDIM": str(resolution), "YDIM": str(-resolution)}
+                        for resolution in resolutions
+                    ]
+                }
+            }
+        }
+    }
+
+def get_band_data(rng, size, resolution, acquisition_index, band_index):
+    """Get synthetic uint16 reflectances of a band, a smooth field that changes between acquisitions, with noise."""
+    num_pixels = size * 10 // resolution
+    coords = np.arange(num_pixels) * resolution / 1000  # km
+    field = 1500 + 500 * np.sin(coords[:, np.newaxis] / 3 + acquisition_index / 4) * np.cos(coords[np.newaxis, :] / 5 + band_index / 2)
+    return (field + rng.integers(0, 200, size=(num_pixels, num_pixels))).astype(np.uint16)
+
+def write_jp2(path, data, epsg, resolution, ulx, uly):
+    """Write a band as a lossless single-band JPEG 2000 file."""
+    profile = {
+        "driver": "JP2OpenJPEG",
+        "dtype": "uint16",
+        "count": 1,
+        "height": data.shape[0],
+        "width": data.shape[1],
+        "crs": f"EPSG:{epsg}",
+        "transform": from_origin(ulx, uly, resolution, resolution),
+        "QUALITY": "100",
+        "REVERSIBLE": "YES",
+        "YCBCR420": "NO"
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data, 1)
+
+def write_safe(safe_to_folder, tile_id, sensing_time, acquisition_index, size, ulx, uly, rng):
+    """Write a synthetic SAFE with the layout of the SAFEs downloaded from CDSE, and return its folder."""
+    time_string = sensing_time.strftime("%Y%m%dT%H%M%S")
+    generation_time_string = (sensing_time + datetime.timedelta(minutes=52)).strftime("%Y%m%dT%H%M%S")
+    safe_name = f"S2B_MSIL1C_{time_string}_N0510_R079_T{tile_id}_{generation_time_string}.SAFE"
+    granule = f"L1C_T{tile_id}_A{36255 + acquisition_index:06d}_{time_string}"
+    safe_folder = Path(safe_to_folder) / f"Sentinel-2/MSI/L1C/{sensing_time.year}/{sensing_time.month:02d}/{sensing_time.day:02d}" / safe_name
+    img_data_folder = safe_folder / "GRANULE" / granule / "IMG_DATA"
+    img_data_folder.mkdir(parents=True, exist_ok=True)
+    with open(safe_folder / "MTD_MSIL1C.xml", "w", encoding="utf-8") as file:
+        file.write(xmltodict.unparse(get_product_metadata(safe_name, sensing_time), pretty=True))
+    with open(safe_folder / "GRANULE" / granule / "MTD_TL.xml", "w", encoding="utf-8") as file:
+        file.write(xmltodict.unparse(get_tile_metadata(tile_id, granule, sensing_time, size, ulx, uly), pretty=True))
+    for band_index, physical_band in enumerate(band_wavelengths):
+        band = get_band_id(physical_band)
+        resolution = band_resolutions[band]
+        data = get_band_data(rng, size, resolution, acquisition_index, band_index)
+        write_jp2(img_data_folder / f"T{tile_id}_{time_string}_{band}.jp2", data, get_utm_epsg(tile_id), resolution, ulx, uly)
+    return safe_folder
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic Sentinel 2 L1C SAFEs for offline benchmarking'
+    )
+
+    defaults = {
+        "safe_to_folder": os.environ.get("DSLAB_S2L1C_NETWORK_SAFE_PATH"),
+        "tiles": ["35VLH"],
+        "years": [2024],
+        "num_acquisitions": 8,
+        "size": 1098,
+        "ulx": 300000,
+        "uly": 6800040,
+        "seed": 42
+    }
+
+    parser.add_argument(
+        '--safe_to_folder',
+        type=str,
+        default=defaults["safe_to_folder"],
+        help=f'Folder to write the SAFEs to, default (from env var DSLAB_S2L1C_NETWORK_SAFE_PATH): {defaults["safe_to_folder"]}'
+    )
+
+    parser.add_argument(
+        '--tiles',
+        type=str,
+        nargs='+',
+        default=defaults["tiles"],
+        help=f'List of space-separated tile ids, default: {" ".join(defaults["tiles"])}'
+    )
+
+    parser.add_argument(
+        '--years',
+        type=int,
+        nargs='+',
+        default=defaults["years"],
+        help=f'List of space-separated years, default: {" ".join(map(str, defaults["years"]))}'
+    )
+
+    parser.add_argument(
+        '--num_acquisitions',
+        type=int,
+        default=defaults["num_acquisitions"],
+        help=f'Number of acquisitions per tile and year, evenly spaced over the year, default: {defaults["num_acquisitions"]}'
+    )
+
+    parser.add_argument(
+        '--size',
+        type=int,
+        default=defaults["size"],
+        help=f'Tile width and height in 10 m pixels, a multiple of 6 (10980 in real SAFEs), default: {defaults["size"]}'
+    )
+
+    parser.add_argument(
+        '--ulx',
+        type=int,
+        default=defaults["ulx"],
+        help=f'Tile upper left corner x in the tile UTM zone CRS, default: {defaults["ulx"]}'
+    )
+
+    parser.add_argument(
+        '--uly',
+        type=int,
+        default=defaults["uly"],
+        help=f'Tile upper left corner y in the tile UTM zone CRS, default: {defaults["uly"]}'
+    )
+
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=defaults["seed"],
+        help=f'Random seed of the pixel noise, default: {defaults["seed"]}'
+    )
+
+    return parser.parse_args()
+
+def generate(safe_to_folder, tiles, years, num_acquisitions, size, ulx, uly, seed):
+    if size % 6 != 0:
+        raise ValueError(f"Size {size} is not a multiple of 6, needed for the 20 m and 60 m bands")
+    start = time.time()
+    rng = np.random.default_rng(seed)
+    progress = progressbar.ProgressBar(max_value=len(tiles) * len(years) * num_acquisitions)
+    total_num_items = 0
+    for tile_id in tiles:
+        for year in years:
+            for acquisition_index, sensing_time in enumerate(get_acquisition_times(year, num_acquisitions)):
+                progress.update(total_num_items)
+                safe_folder = write_safe(safe_to_folder, tile_id, sensing_time, acquisition_index, size, ulx, uly, rng)
+                print(safe_folder)
+                total_num_items += 1
+    progress.update(total_num_items)
+    duration = time.time() - start
+    print("Duration (s):", duration)
+    print("Total number of SAFE items:", total_num_items)
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    generate(**vars(args))
@@ -0,0 +1,82 @@
+import contextlib
+import time
+import zarr.storage
+
+class PhaseTimer:
+    """Accumulates wall-clock durations of named phases of a patch load.
+
+    Usage:
+
+    ```Python
+    timer = PhaseTimer()
+    with timer.phase("metadata"):
+        ds = xr.open_zarr(...)
+    ```
+
+    A phase entered several times accumulates its durations.
+    """
+
+    def __init__(self):
+        self.durations = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] = self.durations.get(name, 0) + time.perf_counter() - start
+
+class InstrumentedStore(zarr.storage.WrapperStore):
+    """A Zarr store wrapper that counts the get requests, the bytes returned and the time spent in gets.
+
+    The time spent in gets is summed over concurrent gets, so it can be
+    larger than the wall-clock time of a load.
+    """
+
+    def __init__(self, store):
+        super().__init__(store)
+        self.requests = 0
+        self.bytes = 0
+        self.get_seconds = 0.0
+
+    def stats(self):
+        """Get the counts as a dict."""
+        return {"requests": self.requests, "bytes": self.bytes, "get_seconds": self.get_seconds}
+
+    async def get(self, key, prototype, byte_range=None):
+        start = time.perf_counter()
+        buffer = await self._store.get(key, prototype, byte_range)
+        self.get_seconds += time.perf_counter() - start
+        self.requests += 1
+        if buffer is not None:
+            self.bytes += len(buffer)
+        return buffer
+
+    async def get_partial_values(self, prototype, key_ranges):
+        key_ranges = list(key_ranges)
+        start = time.perf_counter()
+        buffers = await self._store.get_partial_values(prototype, key_ranges)
+        self.get_seconds += time.perf_counter() - start
+        self.requests += len(key_ranges)
+        self.bytes += sum(len(buffer) for buffer in buffers if buffer is not None)
+        return buffers
+
+def read_process_io():
+    """Read the I/O counters of this process from /proc/self/io (Linux), or None if not available.
+
+    rchar and syscr count the bytes and the calls of read system calls,
+    including page cache hits and network file systems, and read_bytes
+    counts the bytes fetched from storage devices.
+    """
+    try:
+        with open("/proc/self/io") as file:
+            return {name: int(value) for name, value in (line.split(":") for line in file if line.strip())}
+    except OSError:
+        return None
+
+def diff_counters(after, before):
+    """Get the differences of the counters in two dicts of counters, or None if either is None."""
+    if after is None or before is None:
+        return None
+    return {name: after[name] - before.get(name, 0) for name in after}
@@ -0,0 +1,345 @@
+import asyncio
+import numpy as np
+import boto3
+import time
+import random
+import os
+import json
+import datetime
+import argparse
+import queue
+import multiprocessing
+from pathlib import Path
+from .benchmark_patch_load import get_safe_bounding_cube, get_random_patch_crs_coords, get_benchmark_zarr_store
+from .benchmark_concurrent_patch_load import open_band_group_arrays, load_patch_zarr_async
+
+def patch_loader_worker(worker_index, storage, format, s3_endpoint_url, tile, years, bounding_box, num_patches, concurrency, seed, output_queue, time_start=None, time_end=None, consolidated=True):
+    """Load random patch time series in a worker process and put them in the output queue.
+
+    The worker has its own event loop and Zarr store, and keeps up to
+    concurrency patch loads in flight. Each patch is put in the queue as a
+    dict of band group -> NumPy array. A None is put in the queue when the
+    worker is done, preceded by the exception if loading failed.
+    """
+    random.seed(seed + worker_index)
+    num_started = 0
+
+    async def load_patches(band_group_arrays):
+        nonlocal num_started
+        while num_started < num_patches:
+            num_started += 1
+            patch_crs_coords = get_random_patch_crs_coords(*bounding_box)
+            band_group_datacubes = await load_patch_zarr_async(band_group_arrays, patch_crs_coords)
+            # Blocks while the queue is full, which bounds the prefetching
+            await asyncio.to_thread(output_queue.put, band_group_datacubes)
+
+    async def run():
+        zarr_store = get_benchmark_zarr_store(storage, format, s3_endpoint_url, index_cache_folder=os.environ.get("DSLAB_ZIPFS_INDEX_CACHE_FOLDER"))
+        band_group_arrays = await open_band_group_arrays(zarr_store, tile, years, time_start, time_end, consolidated)
+        await asyncio.gather(*[load_patches(band_group_arrays) for _ in range(concurrency)])
+
+    try:
+        asyncio.run(run())
+    except Exception as e:
+        output_queue.put(e)
+    output_queue.put(None)
+
+class PatchLoader:
+    """A prefetching multi-worker loader of random patch time series from a Zarr, a sharded Zarr or a zipped Zarr.
+
+    Worker processes each open their own Zarr store (using
+    get_benchmark_zarr_store as in the benchmarks) and run their
+    own async event loop, with up to concurrency patch loads in flight per
+    worker. Loaded patches are prefetched into a queue of at most prefetch
+    patches, so that the workers stay ahead of the consumer without using
+    unbounded memory. Iterating yields num_patches patches, each a dict of
+    band group -> NumPy array of shape (time, band, y, x), in order of
+    completion. Usage:
+
+    ```Python
+    for band_group_datacubes in PatchLoader("temp", "zarr", tile, [year], (x1, y1, x2, y2), num_patches=1000):
+        train_step(band_group_datacubes)
+    ```
+
+    If a worker process dies without finishing, for example killed by the
+    out-of-memory killer, iterating raises a RuntimeError within
+    worker_check_interval seconds of the queue running empty.
+    """
+    worker_check_interval = 1.0
+
+    def __init__(self, storage, format, tile, years, bounding_box, num_patches, num_workers=4, concurrency=4, prefetch=16, seed=42, s3_endpoint_url=None, time_start=None, time_end=None, consolidated=True):
+        """Initialize the PatchLoader.
+
+        Args:
+            storage: Storage id: "network", "temp" or "s3".
+            format: Format id: "zarr", "zipzarr" or "shardedzarr".
+            tile: Tile id, for example "35VLH".
+            years: Years of a patch time series, concatenated along time.
+            bounding_box: Tile corners (x1, y1, x2, y2) in the tile UTM zone CRS.
+            num_patches: Total number of patches to load.
+            num_workers: Number of worker processes.
+            concurrency: Number of patch loads in flight per worker.
+            prefetch: Maximum number of loaded patches waiting in the queue.
+            seed: Random seed of the patch locations, offset by the worker index.
+            s3_endpoint_url: S3 endpoint URL, required for storage "s3".
+            time_start: First time (inclusive) of the time window to load from each year as datetime64, or None for the start of the year.
+            time_end: End time (exclusive) of the time window to load from each year as datetime64, or None for the end of the year.
+            consolidated: Open the Zarr through the consolidated metadata of each tile/year.
+        """
+        self.storage = storage
+        self.format = format
+        self.tile = tile
+        self.years = years
+        self.bounding_box = bounding_box
+        self.num_patches = num_patches
+        self.num_workers = num_workers
+        self.concurrency = concurrency
+        self.prefetch = prefetch
+        self.seed = seed
+        self.s3_endpoint_url = s3_endpoint_url
+        self.time_start = time_start
+        self.time_end = time_end
+        self.consolidated = consolidated
+
+    def __iter__(self):
+        # Spawn rather than fork, as the parent may have event loop and I/O threads running
+        context = multiprocessing.get_context("spawn")
+        output_queue = context.Queue(maxsize=self.prefetch)
+        workers = []
+        for worker_index in range(self.num_workers):
+            # Split the patches between the workers
+            num_worker_patches = self.num_patches // self.num_workers + (worker_index < self.num_patches % self.num_workers)
+            worker = context.Process(
+                target=patch_loader_worker,
+                args=(worker_index, self.storage, self.format, self.s3_endpoint_url, self.tile, self.years, self.bounding_box, num_worker_patches, self.concurrency, self.seed, output_queue, self.time_start, self.time_end, self.consolidated),
+                daemon=True
+            )
+            worker.start()
+            workers.append(worker)
+        try:
+            num_done = 0
+            while num_done < self.num_workers:
+                try:
+                    item = output_queue.get(timeout=self.worker_check_interval)
+                except queue.Empty:
+                    # A worker that died cannot put its None, so check the workers rather than wait forever
+                    for worker_index, worker in enumerate(workers):
+                        if worker.exitcode is not None and worker.exitcode != 0:
+                            raise RuntimeError(f"Patch loader worker {worker_index} died with exit code {worker.exitcode}")
+                    if all(worker.exitcode is not None for worker in workers):
+                        raise RuntimeError("Patch loader workers exited without finishing")
+                    continue
+                if item is None:
+                    num_done += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+                worker.join()
+
+    def __len__(self):
+        return self.num_patches
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Measure the throughput of the prefetching multi-worker patch timeseries loader'
+    )
+
+    bounding_cube = get_safe_bounding_cube()
+
+    defaults = {
+        "storage": "temp",
+        "format": "zarr",
+        "num_patches": 256,
+        "num_workers": 4,
+        "concurrency": 4,
+        "prefetch": 16,
+        "years": [bounding_cube["year"]],
+        "tile": bounding_cube["tile"],
+        "x1": bounding_cube["x1"],
+        "y1": bounding_cube["y1"],
+        "x2": bounding_cube["x2"],
+        "y2": bounding_cube["y2"],
+        "time_start": None,
+        "time_end": None,
+        "consolidated": True
+    }
+
+    parser.add_argument(
+        '--storage',
+        type=str,
+        choices=["network", "temp", "s3"],
+        default=defaults["storage"],
+        help=f'Storage to load from, default: {defaults["storage"]}'
+    )
+
+    parser.add_argument(
+        '--format',
+        type=str,
+        choices=["zarr", "zipzarr", "shardedzarr"],
+        default=defaults["format"],
+        help=f'Format to load from, default: {defaults["format"]}'
+    )
+
+    parser.add_argument(
+        '--num_patches',
+        type=int,
+        default=defaults["num_patches"],
+        help=f'Number of patches to load, default: {defaults["num_patches"]}'
+    )
+
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=defaults["num_workers"],
+        help=f'Number of worker processes, default: {defaults["num_workers"]}'
+    )
+
+    parser.add_argument(
+        '--concurrency',
+        type=int,
+        default=defaults["concurrency"],
+        help=f'Number of patch loads in flight per worker, default: {defaults["concurrency"]}'
+    )
+
+    parser.add_argument(
+        '--prefetch',
+        type=int,
+        default=defaults["prefetch"],
+        help=f'Maximum number of prefetched patches, default: {defaults["prefetch"]}'
+    )
+
+    parser.add_argument(
+        '--years',
+        type=int,
+        nargs='+',
+        default=defaults["years"],
+        help=f'List of space-separated years of a patch time series, default (from network SAFE): {" ".join(map(str, defaults["years"]))}'
+    )
+
+    parser.add_argument(
+        '--tile',
+        type=str,
+        default=defaults["tile"],
+        help=f'Tile, default (from network SAFE): {defaults["tile"]}'
+    )
+
+    parser.add_argument(
+        '--x1',
+        type=int,
+        default=defaults["x1"],
+        help=f'Bounding box x1, default (from network SAFE): {defaults["x1"]}'
+    )
+    parser.add_argument(
+        '--y1',
+        type=int,
+        default=defaults["y1"],
+        help=f'Bounding box y1, default (from network SAFE): {defaults["y1"]}'
+    )
+    parser.add_argument(
+        '--x2',
+        type=int,
+        default=defaults["x2"],
+        help=f'Bounding box x2, default (from network SAFE): {defaults["x2"]}'
+    )
+    parser.add_argument(
+        '--y2',
+        type=int,
+        default=defaults["y2"],
+        help=f'Bounding box y2, default (from network SAFE): {defaults["y2"]}'
+    )
+
+    parser.add_argument(
+        '--time_start',
+        type=np.datetime64,
+        default=defaults["time_start"],
+        help=f'First UTC time (inclusive) of the time window to load from each year, for example 2024-06-01, default (start of year): {defaults["time_start"]}'
+    )
+
+    parser.add_argument(
+        '--time_end',
+        type=np.datetime64,
+        default=defaults["time_end"],
+        help=f'End UTC time (exclusive) of the time window to load from each year, for example 2024-09-01, default (end of year): {defaults["time_end"]}'
+    )
+
+    parser.add_argument(
+        '--consolidated',
+        action=argparse.BooleanOptionalAction,
+        default=defaults["consolidated"],
+        help=f'Open the Zarr through the consolidated metadata of each tile/year if present, default: {defaults["consolidated"]}'
+    )
+
+    return parser.parse_args()
+
+def benchmark(storage, format, num_patches, num_workers, concurrency, prefetch, years, tile, x1, y1, x2, y2, time_start=None, time_end=None, consolidated=True):
+    s3_endpoint_url = None
+    if storage == "s3":
+        s3_session = boto3.Session(profile_name=os.environ["DSLAB_S2L1C_S3_PROFILE"])
+        s3_client = s3_session.client('s3')
+        s3_endpoint_url = s3_client.meta.endpoint_url
+    benchmark_timestamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    print(f"Benchmarking patch loader for tile {tile}, years {' '.join(map(str, years))}")
+    log = {
+        "tile": tile,
+        "years": years,
+        "num_workers": num_workers,
+        "concurrency": concurrency,
+        "prefetch": prefetch,
+        "time_start": str(time_start) if time_start is not None else None,
+        "time_end": str(time_end) if time_end is not None else None,
+        "consolidated": consolidated,
+        # Settings that change the results, as in the patch load benchmark logs
+        "cache_mode": "uncontrolled",
+        "s3": {"standin": False},
+        "zipfs": {
+            "async": True,
+            "index_cache": os.environ.get("DSLAB_ZIPFS_INDEX_CACHE_FOLDER") is not None,
+            "block_cache_mib": 0,
+            "mmap": False,
+            "max_concurrency": 0,
+            "hedge_quantile": 0
+        },
+        "results": {
+            storage: {
+                format: {
+                    "durations": [],
+                    "band_group_shapes": {},
+                    "total_duration": 0,
+                }
+            }
+        }
+    }
+    result = log["results"][storage][format]
+    loader = PatchLoader(storage, format, tile, years, (x1, y1, x2, y2), num_patches, num_workers=num_workers, concurrency=concurrency, prefetch=prefetch, s3_endpoint_url=s3_endpoint_url, time_start=time_start, time_end=time_end, consolidated=consolidated)
+    start = time.time()
+    previous = start
+    for band_group_datacubes in loader:
+        # Duration is the time the consumer waited for the patch
+        now = time.time()
+        result["durations"].append(now - previous)
+        previous = now
+        for band_group, band_group_datacube in band_group_datacubes.items():
+            result["band_group_shapes"][band_group] = band_group_datacube.shape
+    # The first duration includes starting the workers and opening the stores
+    result["startup_duration"] = result["durations"].pop(0)
+    result["total_duration"] = previous - start
+    result["mean_durations"] = np.mean(result["durations"])
+    result["std_durations"] = np.std(result["durations"])
+    result["stderr_durations"] = np.std(result["durations"]) / np.sqrt(len(result["durations"]))
+    result["samples_per_second"] = len(result["durations"]) / (previous - start - result["startup_duration"])
+    print(f"{result['samples_per_second']:.3f} samples/s")
+    # Serializing json
+    logpath = Path(os.environ["DSLAB_LOG_FOLDER"]) / f"sentinel2_l1c_loader_{benchmark_timestamp}.json"
+    print(f"Writing log to: {logpath}")
+    logpath.parent.mkdir(parents=True, exist_ok=True)
+    with open(logpath, "w") as out_file:
+        json.dump(log, out_file, indent = 4)
+
+if __name__=="__main__":
+    args = parse_arguments()
+    benchmark(**vars(args))
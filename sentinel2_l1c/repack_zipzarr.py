@@ -0,0 +1,200 @@
+import asyncio
+import os
+import json
+import time
+import argparse
+import posixpath
+import progressbar
+from async_zipfs import ReadOnlyZipFileSystem
+from zip_writer import StoredZipWriter
+from fsspec.implementations.local import LocalFileSystem
+from fsspec.implementations.asyn_wrapper import AsyncFileSystemWrapper
+
+def morton_key(indices):
+    """Interleave the bits of non-negative integer indices into a single Z-order key."""
+    key = 0
+    for bit in range(32):
+        for dim, index in enumerate(indices):
+            key |= ((index >> bit) & 1) << (bit*len(indices) + dim)
+    return key
+
+def parse_chunk_key(array_metadata, relative_name):
+    """Parse a chunk key relative to the array folder into chunk grid indices, or None if not a chunk key."""
+    chunk_key_encoding = array_metadata.get("chunk_key_encoding", {"name": "default"})
+    separator = chunk_key_encoding.get("configuration", {}).get("separator", "/" if chunk_key_encoding["name"] == "default" else ".")
+    if chunk_key_encoding["name"] == "default":
+        if not relative_name.startswith(f"c{separator}"):
+            return None
+        relative_name = relative_name[2:]
+    try:
+        indices = [int(index) for index in relative_name.split(separator)]
+    except ValueError:
+        return None
+    if len(indices) != len(array_metadata["shape"]):
+        return None
+    return indices
+
+def get_layout_order(file_names, array_metadatas, time_dim="time", spatial_order="morton"):
+    """Order the files of a Zarr so that chunks read together are contiguous.
+
+    Metadata and other non-chunk files come first, in name order, so that
+    they can be read in a few reads. Chunks follow array by array (band group
+    by band group). Within an array, chunks are ordered by their spatial chunk
+    indices, either in Z-order ("morton") or in row-major order ("row-major"),
+    and then by their time chunk index, so that all time chunks of a spatial
+    chunk are contiguous. The time dimension is found by name from the array
+    dimension_names, falling back to the first dimension.
+
+    Args:
+        file_names: Names of the files in the Zarr.
+        array_metadatas: Dict of array folder name -> parsed zarr.json of the array.
+        time_dim: Name of the time dimension.
+        spatial_order: "morton" or "row-major".
+    """
+    other_names = []
+    chunk_keys = []
+    for file_name in file_names:
+        array_name = None
+        folder = posixpath.dirname(file_name)
+        while array_name is None:
+            if folder in array_metadatas:
+                array_name = folder
+            elif folder == "":
+                break
+            folder = posixpath.dirname(folder)
+        indices = None
+        if array_name is not None:
+            relative_name = file_name[len(array_name) + 1:] if array_name != "" else file_name
+            indices = parse_chunk_key(array_metadatas[array_name], relative_name)
+        if indices is None:
+            other_names.append(file_name)
+            continue
+        dimension_names = array_metadatas[array_name].get("dimension_names") or []
+        time_axis = dimension_names.index(time_dim) if time_dim in dimension_names else 0
+        other_indices = indices[:time_axis] + indices[time_axis + 1:]
+        # Leading non-spatial dimensions (such as band) are kept together with the spatial dims
+        spatial_key = morton_key(other_indices) if spatial_order == "morton" else tuple(other_indices)
+        chunk_keys.append(((array_name, spatial_key, indices[time_axis]), file_name))
+    return sorted(other_names) + [file_name for _, file_name in sorted(chunk_keys)]
+
+async def get_array_metadatas(zipfs, file_names):
+    """Read the zarr.json of each array in the zip file, as a dict of array folder name -> metadata."""
+    metadata_names = [file_name for file_name in file_names if posixpath.basename(file_name) == "zarr.json"]
+    metadata_datas = await zipfs._cat_ranges(metadata_names, None, None, on_error="raise")
+    array_metadatas = {}
+    for metadata_name, metadata_data in zip(metadata_names, metadata_datas):
+        metadata = json.loads(bytes(metadata_data))
+        if metadata.get("node_type") == "array":
+            array_metadatas[posixpath.dirname(metadata_name)] = metadata
+    return array_metadatas
+
+async def repack_files(zipfs, to_path, file_names, batch_size=256*1024*1024, progress=None):
+    """Write the given files of a zip file to a new zip file, in the given order.
+
+    Files are read in batches of about batch_size bytes using coalesced
+    reads and streamed to the new zip with StoredZipWriter. Files that are
+    not listed, such as superseded entries, are left out.
+    """
+    _, all_file_names, _, all_sizes = await zipfs._list_members()
+    sizes = dict(zip(all_file_names, all_sizes.tolist()))
+    with StoredZipWriter(to_path) as writer:
+        batch = []
+        batch_bytes = 0
+        num_written = 0
+        for file_index, file_name in enumerate(file_names):
+            batch.append(file_name)
+            batch_bytes += sizes[file_name]
+            if batch_bytes >= batch_size or file_index == len(file_names) - 1:
+                datas = await zipfs._cat_ranges(batch, None, None, on_error="raise")
+                for batch_file_name, data in zip(batch, datas):
+                    writer.write_file(batch_file_name, data)
+                num_written += len(batch)
+                if progress is not None:
+                    progress.update(num_written)
+                batch = []
+                batch_bytes = 0
+
+async def repack_zipzarr(zipfs, to_path, time_dim="time", spatial_order="morton", keep_order=False):
+    """Repack a zipped Zarr into a new zip with a layout optimized for patch time series reads.
+
+    With keep_order=True, the files are kept in their current order and the
+    repacking only compacts the zip by leaving out superseded entries. The gap
+    files left by appending are always left out.
+    """
+    _, file_names, _, _ = await zipfs._list_members()
+    file_names = [file_name for file_name in file_names if not file_name.startswith(StoredZipWriter.GAP_FILE_PREFIX)]
+    if keep_order:
+        ordered_file_names = file_names
+    else:
+        array_metadatas = await get_array_metadatas(zipfs, file_names)
+        ordered_file_names = get_layout_order(file_names, array_metadatas, time_dim=time_dim, spatial_order=spatial_order)
+    progress = progressbar.ProgressBar(max_value=len(ordered_file_names))
+    await repack_files(zipfs, to_path, ordered_file_names, progress=progress)
+    return len(ordered_file_names)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Repack a zipped Zarr so that the chunks of a patch time series are contiguous in the zip'
+    )
+
+    defaults = {
+        "from_path": os.environ.get("DSLAB_S2L1C_NETWORK_ZIPZARR_PATH"),
+        "to_path": None,
+        "time_dim": "time",
+        "spatial_order": "morton",
+        "keep_order": False
+    }
+
+    parser.add_argument(
+        '--from_path',
+        type=str,
+        default=defaults["from_path"],
+        help=f'Zipped Zarr to repack, default: {defaults["from_path"]}'
+    )
+
+    parser.add_argument(
+        '--to_path',
+        type=str,
+        default=defaults["to_path"],
+        help='Repacked zipped Zarr to create, default: from_path with .zip replaced by .repacked.zip'
+    )
+
+    parser.add_argument(
+        '--time_dim',
+        type=str,
+        default=defaults["time_dim"],
+        help=f'Name of the time dimension, default: {defaults["time_dim"]}'
+    )
+
+    parser.add_argument(
+        '--spatial_order',
+        type=str,
+        choices=["morton", "row-major"],
+        default=defaults["spatial_order"],
+        help=f'Order of spatial chunks, default: {defaults["spatial_order"]}'
+    )
+
+    parser.add_argument(
+        '--keep_order',
+        action=argparse.BooleanOptionalAction,
+        default=defaults["keep_order"],
+        help=f'Keep the current order of the files and only leave out superseded entries (compaction after appends), default: {defaults["keep_order"]}'
+    )
+
+    return parser.parse_args()
+
+def repack(from_path, to_path, time_dim, spatial_order, keep_order):
+    start = time.time()
+    if to_path is None:
+        to_path = f"{os.path.splitext(from_path)[0]}.repacked.zip"
+    async_local_fs = AsyncFileSystemWrapper(LocalFileSystem())
+    zipfs = ReadOnlyZipFileSystem(async_local_fs, from_path)
+    num_files = asyncio.run(repack_zipzarr(zipfs, to_path, time_dim=time_dim, spatial_order=spatial_order, keep_order=keep_order))
+    duration = time.time() - start
+    print(f"Repacked {from_path} to {to_path}")
+    print("Duration (s):", duration)
+    print("Total number of files:", num_files)
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    repack(**vars(args))
@@ -0,0 +1,194 @@
+import asyncio
+import bisect
+import os
+import time
+import json
+import argparse
+import boto3
+import s3fs
+import progressbar
+from async_zipfs import ReadOnlyZipFileSystem
+from zip_writer import StoredZipWriter
+from fsspec.implementations.local import LocalFileSystem
+from fsspec.implementations.asyn_wrapper import AsyncFileSystemWrapper
+
+STATE_FILE_NAME = ".stage_zipzarr_state"
+
+def get_parts(offsets, sizes, part_size, max_gap):
+    """Split the byte ranges of the files in a zip into parts to download.
+
+    Files that are adjacent or separated by at most max_gap bytes (typically
+    by local headers only) are merged into spans, and the spans are split into
+    parts of at most part_size bytes. Returns a list of (start, end) parts.
+    """
+    spans = []
+    for offset, size in zip(offsets.tolist(), sizes.tolist()):
+        if spans and offset - spans[-1][1] <= max_gap:
+            spans[-1][1] = max(spans[-1][1], offset + size)
+        else:
+            spans.append([offset, offset + size])
+    parts = []
+    for span_start, span_end in spans:
+        for part_start in range(span_start, span_end, part_size):
+            parts.append((part_start, min(part_start + part_size, span_end)))
+    return parts
+
+async def stage_zipzarr(zipfs, to_folder, max_concurrency=16, part_size=32*1024*1024, max_gap=64*1024):
+    """Extract a zipped Zarr to a folder, downloading it with concurrent ranged reads.
+
+    The files are located using the central directory parsed by zipfs. The
+    zip is read in parts of at most part_size bytes, at most max_concurrency
+    parts at a time, so at most max_concurrency * part_size bytes are held in
+    memory. The bytes of each part are written directly to their final
+    positions in the extracted files. Completed parts are recorded in a state
+    file in to_folder, so that an interrupted staging can be resumed by
+    running it again. The state file is removed when staging is complete.
+    The gap files left by appending to the zip are not extracted.
+    """
+    start = time.time()
+    dir_names, file_names, offsets, sizes = await zipfs._list_members()
+    is_zarr_file = [not file_name.startswith(StoredZipWriter.GAP_FILE_PREFIX) for file_name in file_names]
+    file_names = [file_name for file_name, keep in zip(file_names, is_zarr_file) if keep]
+    offsets, sizes = offsets[is_zarr_file], sizes[is_zarr_file]
+    parts = get_parts(offsets, sizes, part_size, max_gap)
+    total_bytes = sum(part_end - part_start for part_start, part_end in parts)
+
+    # Load the state of an earlier interrupted staging of the same zip
+    info = await zipfs.fs._info(zipfs.path)
+    state_key = json.dumps({
+        "path": zipfs.path,
+        "size": info["size"],
+        "version": str(info.get("ETag", info.get("mtime"))),
+        "part_size": part_size,
+        "max_gap": max_gap
+    })
+    state_path = os.path.join(to_folder, STATE_FILE_NAME)
+    completed_parts = set()
+    if os.path.exists(state_path):
+        with open(state_path, "r") as state_file:
+            lines = state_file.read().splitlines()
+        if lines and lines[0] == state_key:
+            completed_parts = set(int(line) for line in lines[1:] if line)
+            print(f"Resuming staging, {len(completed_parts)} of {len(parts)} parts already done")
+    os.makedirs(to_folder, exist_ok=True)
+    if not completed_parts:
+        with open(state_path, "w") as state_file:
+            state_file.write(state_key + "\n")
+
+    # Create folders and files, keeping the contents of files from an earlier staging
+    for dir_name in dir_names:
+        os.makedirs(os.path.join(to_folder, dir_name), exist_ok=True)
+    for file_name, size in zip(file_names, sizes.tolist()):
+        file_path = os.path.join(to_folder, file_name)
+        with open(file_path, "r+b" if completed_parts and os.path.exists(file_path) else "wb") as file:
+            file.truncate(size)
+
+    # Files are sorted by offset, so the files overlapping a part are found by bisection
+    file_ends = (offsets + sizes).tolist()
+    offsets = offsets.tolist()
+    sizes = sizes.tolist()
+
+    def write_part(part_start, part_end, data):
+        first_file = bisect.bisect_right(file_ends, part_start)
+        for file_index in range(first_file, len(file_names)):
+            offset, size = offsets[file_index], sizes[file_index]
+            if offset >= part_end:
+                break
+            write_start = max(offset, part_start)
+            write_end = min(offset + size, part_end)
+            if write_end <= write_start:
+                continue
+            with open(os.path.join(to_folder, file_names[file_index]), "r+b") as file:
+                os.pwrite(file.fileno(), data[write_start - part_start:write_end - part_start], write_start - offset)
+
+    progress = progressbar.ProgressBar(max_value=total_bytes)
+    done_bytes = sum(parts[part_index][1] - parts[part_index][0] for part_index in completed_parts)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    state_file = open(state_path, "a")
+
+    async def stage_part(part_index):
+        nonlocal done_bytes
+        part_start, part_end = parts[part_index]
+        async with semaphore:
+            data = await zipfs._read(part_start, part_end)
+            await asyncio.to_thread(write_part, part_start, part_end, data)
+        state_file.write(f"{part_index}\n")
+        state_file.flush()
+        done_bytes += part_end - part_start
+        progress.update(done_bytes)
+
+    try:
+        await asyncio.gather(*[stage_part(part_index) for part_index in range(len(parts)) if part_index not in completed_parts])
+    finally:
+        state_file.close()
+    os.remove(state_path)
+    progress.finish()
+    duration = time.time() - start
+    print("Duration (s):", duration)
+    print("Total number of files:", len(file_names))
+    print("Total bytes read:", total_bytes)
+    print("Throughput (MiB/s):", total_bytes / 1024**2 / duration)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Stage a zipped Zarr from S3 or network storage to an unzipped Zarr in temp storage using concurrent ranged reads'
+    )
+
+    defaults = {
+        "storage": "s3",
+        "to_folder": os.environ.get("DSLAB_S2L1C_TEMP_ZARR_PATH"),
+        "max_concurrency": 16,
+        "part_size_mib": 32
+    }
+
+    parser.add_argument(
+        '--storage',
+        type=str,
+        choices=["network", "s3"],
+        default=defaults["storage"],
+        help=f'Storage of the zipped Zarr to stage, default: {defaults["storage"]}'
+    )
+
+    parser.add_argument(
+        '--to_folder',
+        type=str,
+        default=defaults["to_folder"],
+        help=f'Folder to extract the Zarr to, default: {defaults["to_folder"]}'
+    )
+
+    parser.add_argument(
+        '--max_concurrency',
+        type=int,
+        default=defaults["max_concurrency"],
+        help=f'Maximum number of concurrent ranged reads, default: {defaults["max_concurrency"]}'
+    )
+
+    parser.add_argument(
+        '--part_size_mib',
+        type=int,
+        default=defaults["part_size_mib"],
+        help=f'Size (MiB) of a ranged read, default: {defaults["part_size_mib"]}'
+    )
+
+    return parser.parse_args()
+
+def stage(storage, to_folder, max_concurrency, part_size_mib):
+    if storage == "s3":
+        s3_session = boto3.Session(profile_name=os.environ["DSLAB_S2L1C_S3_PROFILE"])
+        s3_client = s3_session.client('s3')
+        s3_endpoint_url = s3_client.meta.endpoint_url
+
+    async def run():
+        if storage == "s3":
+            s3 = s3fs.S3FileSystem(anon=True, endpoint_url=s3_endpoint_url, asynchronous=True)
+            zipfs = ReadOnlyZipFileSystem(s3, f'{os.environ["DSLAB_S2L1C_S3_ZIPZARR_BUCKET"]}/{os.environ["DSLAB_S2L1C_S3_ZIPZARR_KEY"]}')
+        elif storage == "network":
+            async_local_fs = AsyncFileSystemWrapper(LocalFileSystem())
+            zipfs = ReadOnlyZipFileSystem(async_local_fs, os.environ["DSLAB_S2L1C_NETWORK_ZIPZARR_PATH"])
+        await stage_zipzarr(zipfs, to_folder, max_concurrency=max_concurrency, part_size=part_size_mib*1024*1024)
+
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    stage(**vars(args))
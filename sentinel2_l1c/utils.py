@@ -4,20 +4,29 @@ band_groups = {
         "resolution": 60,
         "y_chunk_size": 128,
         "x_chunk_size": 128,
-        "time_chunk_size": 80
+        "time_chunk_size": 80,
+        "y_shard_size": 1024,
+        "x_shard_size": 1024,
+        "time_shard_size": 80
     },
     "B02_B03_B04_B08": {
         "bands": ["B02", "B03", "B04", "B08"],
         "resolution": 10,
         "y_chunk_size": 512,
         "x_chunk_size": 512,
-        "time_chunk_size": 20
+        "time_chunk_size": 20,
+        "y_shard_size": 4096,
+        "x_shard_size": 4096,
+        "time_shard_size": 20
     },
     "B05_B06_B07_B8A_B11_B12": {
         "bands": ["B05", "B06", "B07", "B8A", "B11", "B12"],
         "resolution": 20,
         "y_chunk_size": 256,
         "x_chunk_size": 256,
-        "time_chunk_size": 40
+        "time_chunk_size": 40,
+        "y_shard_size": 2048,
+        "x_shard_size": 2048,
+        "time_shard_size": 40
     }
 }
\ No newline at end of file
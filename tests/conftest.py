@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The modules are imported from the repo root, like when running them with python3 -m
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,273 @@
+import asyncio
+import gc
+import logging
+import os
+import struct
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+from fsspec.implementations.asyn_wrapper import AsyncFileSystemWrapper
+from async_zipfs import BlockCache, ReadOnlyZipFileSystem, ShardedZipFileSystem, ZipIndex
+from test_zip_writer import FILES, write_zip
+
+def get_index():
+    names = [b"a", b"a/c", b"a/b", b"d"]
+    return ZipIndex.from_entries(names, [0, 10, 20, 30], [-1, 5, 6, 7], "test.zip")
+
+def assert_equal_indices(index, other):
+    assert list(index.names) == list(other.names)
+    assert list(index.offsets) == list(other.offsets)
+    assert list(index.sizes) == list(other.sizes)
+    assert list(index.parents) == list(other.parents)
+
+def test_from_entries():
+    index = get_index()
+    assert [index.name(i) for i in range(len(index.names))] == ["", "a", "a/b", "a/c", "d"]
+    assert index.find("a/b") == 2
+    assert index.find("a/x") == -1
+    assert index.is_dir(index.find("a")) and not index.is_dir(index.find("d"))
+    assert [index.name(i) for i in index.children(0)] == ["a", "d"]
+    assert [index.name(i) for i in index.children(index.find("a"))] == ["a/b", "a/c"]
+
+def test_from_entries_last_entry_wins():
+    index = ZipIndex.from_entries([b"a", b"b", b"a"], [0, 10, 20], [5, 6, 7], "test.zip")
+    assert index.offsets[index.find("a")] == 20
+    assert index.sizes[index.find("a")] == 7
+    assert len(index.names) == 3
+
+def test_from_entries_missing_parent():
+    with pytest.raises(NotImplementedError):
+        ZipIndex.from_entries([b"a/b"], [0], [1], "test.zip")
+
+@pytest.mark.parametrize("index", [get_index(), ZipIndex.from_entries([], [], [], "test.zip")])
+def test_bytes_round_trip(index):
+    data = index.to_bytes()
+    assert_equal_indices(ZipIndex.from_bytes(data), index)
+    assert_equal_indices(ZipIndex.from_bytes(b"prefix" + data, len(b"prefix")), index)
+
+def test_from_bytes_invalid_size():
+    data = get_index().to_bytes()
+    for invalid_data in [data[:-1], data + b"\0", data[:8]]:
+        with pytest.raises((ValueError, struct.error)):
+            ZipIndex.from_bytes(invalid_data)
+
+def open_cached_zipfs(zip_path, cache_dir):
+    return ReadOnlyZipFileSystem(AsyncFileSystemWrapper(LocalFileSystem()), str(zip_path), index_cache_dir=str(cache_dir))
+
+def test_index_cache(tmp_path):
+    write_zip(tmp_path / "a.zip", FILES)
+    zipfs = open_cached_zipfs(tmp_path / "a.zip", tmp_path / "cache")
+    asyncio.run(zipfs._initialize())
+    cache_files = list((tmp_path / "cache").iterdir())
+    assert [cache_file.suffix for cache_file in cache_files] == [".zipidx"]
+    cached_zipfs = open_cached_zipfs(tmp_path / "a.zip", tmp_path / "cache")
+    asyncio.run(cached_zipfs._initialize())
+    assert_equal_indices(cached_zipfs._index, zipfs._index)
+
+def test_corrupt_index_cache(tmp_path, caplog):
+    write_zip(tmp_path / "a.zip", FILES)
+    zipfs = open_cached_zipfs(tmp_path / "a.zip", tmp_path / "cache")
+    asyncio.run(zipfs._initialize())
+    cache_path = next((tmp_path / "cache").iterdir())
+    cache_path.write_bytes(cache_path.read_bytes()[:-3])
+    corrupt_zipfs = open_cached_zipfs(tmp_path / "a.zip", tmp_path / "cache")
+    with caplog.at_level(logging.WARNING, logger="async_zipfs"):
+        asyncio.run(corrupt_zipfs._initialize())
+    assert "corrupt index cache" in caplog.text
+    # Falls back to the central directory and rewrites the cache
+    assert_equal_indices(corrupt_zipfs._index, zipfs._index)
+    cache_key = asyncio.run(zipfs._get_index_cache_key())
+    assert_equal_indices(zipfs._load_index_cache(cache_key), zipfs._index)
+
+class RecordingFileSystem:
+    """Fake underlying file system of a 1000 byte file, recording the byte ranges read."""
+
+    def __init__(self, short_read=False):
+        self.data = bytes(i % 251 for i in range(1000))
+        self.reads = []
+        self.short_read = short_read
+
+    async def _cat_file(self, path, start=None, end=None):
+        self.reads.append((start, end))
+        return self.data[start:end - 1 if self.short_read else end]
+
+def read_coalesced(ranges, max_gap=10, max_block=100):
+    """Read ranges coalesced from a RecordingFileSystem, checking the results and returning them and the reads."""
+    fs = RecordingFileSystem()
+    zipfs = ReadOnlyZipFileSystem(fs, "test.zip", max_gap=max_gap, max_block=max_block)
+    results = asyncio.run(zipfs._read_coalesced(ranges))
+    assert results == [fs.data[start:end] if end > start else b'' for start, end in ranges]
+    return results, sorted(fs.reads)
+
+def test_read_coalesced_adjacent():
+    _, reads = read_coalesced([(0, 10), (10, 20), (20, 30)])
+    assert reads == [(0, 30)]
+
+def test_read_coalesced_max_gap():
+    _, reads = read_coalesced([(0, 10), (20, 30)])
+    assert reads == [(0, 30)]
+    _, reads = read_coalesced([(0, 10), (21, 30)])
+    assert reads == [(0, 10), (21, 30)]
+
+def test_read_coalesced_max_block():
+    _, reads = read_coalesced([(0, 50), (50, 100)])
+    assert reads == [(0, 100)]
+    _, reads = read_coalesced([(0, 50), (50, 101)])
+    assert reads == [(0, 50), (50, 101)]
+
+def test_read_coalesced_oversized_range():
+    _, reads = read_coalesced([(0, 10), (10, 300), (300, 310)])
+    assert reads == [(0, 10), (10, 300), (300, 310)]
+
+def test_read_coalesced_empty_ranges():
+    results, reads = read_coalesced([(5, 5), (10, 20), (30, 20)])
+    assert results[0] == b'' and results[2] == b''
+    assert reads == [(10, 20)]
+    _, reads = read_coalesced([])
+    assert reads == []
+
+def test_read_coalesced_overlapping():
+    _, reads = read_coalesced([(0, 30), (10, 20), (25, 40), (0, 30)])
+    assert reads == [(0, 40)]
+
+def test_read_coalesced_order():
+    # The results are checked to be in the order of the requested ranges
+    _, reads = read_coalesced([(500, 510), (0, 10), (505, 520), (5, 8)])
+    assert reads == [(0, 10), (500, 520)]
+
+def test_read_coalesced_short_read():
+    fs = RecordingFileSystem(short_read=True)
+    zipfs = ReadOnlyZipFileSystem(fs, "test.zip", max_gap=10, max_block=100)
+    with pytest.raises(ValueError, match="Short read"):
+        asyncio.run(zipfs._read_coalesced([(0, 10)]))
+
+class SlowFile:
+    """Fake file of 100 bytes, whose reads wait until released."""
+
+    def __init__(self):
+        self.data = bytes(range(100))
+        self.release = asyncio.Event()
+        self.reads = []
+
+    async def fetch(self, start, end):
+        self.reads.append((start, end))
+        await self.release.wait()
+        return self.data[start:end]
+
+def test_block_cache_cancelled_read():
+    async def run():
+        file = SlowFile()
+        block_cache = BlockCache(file.fetch, 10, 1000)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(block_cache.read(5, 25), timeout=0.01)
+        # A read of the same blocks waits for the fetch of the cancelled read instead of hanging
+        file.release.set()
+        assert await asyncio.wait_for(block_cache.read(5, 25), timeout=1) == file.data[5:25]
+        assert file.reads == [(0, 30)]
+        assert block_cache._in_flight == {}
+    asyncio.run(run())
+
+def test_block_cache_cancelled_fetch():
+    async def run():
+        file = SlowFile()
+        block_cache = BlockCache(file.fetch, 10, 1000)
+        read = asyncio.ensure_future(block_cache.read(5, 25))
+        await asyncio.sleep(0.01)
+        for task in block_cache._fetch_tasks:
+            task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await read
+        assert block_cache._in_flight == {}
+        # The blocks are fetched again
+        file.release.set()
+        assert await asyncio.wait_for(block_cache.read(5, 25), timeout=1) == file.data[5:25]
+    asyncio.run(run())
+
+def test_block_cache_failed_fetch():
+    async def fetch(start, end):
+        raise OSError("read failed")
+    async def run():
+        block_cache = BlockCache(fetch, 10, 1000)
+        for _ in range(2):
+            with pytest.raises(OSError):
+                await asyncio.wait_for(block_cache.read(5, 25), timeout=1)
+        assert block_cache._in_flight == {}
+    asyncio.run(run())
+
+def open_sharded_zipfs(tmp_path):
+    local_fs = AsyncFileSystemWrapper(LocalFileSystem())
+    write_zip(tmp_path / "2024.zip", FILES)
+    write_zip(tmp_path / "2025.zip", {"zarr.json": b"2025", "group/c/0/0": b"y" * 10})
+    return ShardedZipFileSystem([
+        ("35VLH/2024", ReadOnlyZipFileSystem(local_fs, str(tmp_path / "2024.zip"))),
+        ("35VLH/2025", ReadOnlyZipFileSystem(local_fs, str(tmp_path / "2025.zip")))
+    ])
+
+def test_sharded_routing(tmp_path):
+    zipfs = open_sharded_zipfs(tmp_path)
+    (_, shard_2024), (_, shard_2025) = zipfs.shards
+    assert asyncio.run(zipfs._cat_file("35VLH/2025/group/c/0/0")) == b"y" * 10
+    # A path under the mount path of one shard initializes and reads only that shard
+    assert shard_2024._index is None and zipfs._index is None
+    assert asyncio.run(zipfs._cat_file("/35VLH/2024/group/c/1/0", start=10, end=20)) == FILES["group/c/1/0"][10:20]
+    datas = asyncio.run(zipfs._cat_ranges(["35VLH/2024/zarr.json", "35VLH/2025/zarr.json", "35VLH/2024/other/file"], None, None))
+    assert datas == [FILES["zarr.json"], b"2025", FILES["other/file"]]
+    stats = zipfs.read_stats()
+    assert stats["requests"] == shard_2024.read_stats()["requests"] + shard_2025.read_stats()["requests"]
+    assert set(stats["shards"]) == {f"35VLH/2024:{shard_2024.path}", f"35VLH/2025:{shard_2025.path}"}
+
+def test_sharded_merged_listing(tmp_path):
+    zipfs = open_sharded_zipfs(tmp_path)
+    assert asyncio.run(zipfs._ls("", detail=False)) == ["/35VLH"]
+    assert asyncio.run(zipfs._ls("35VLH", detail=False)) == ["/35VLH/2024", "/35VLH/2025"]
+    assert asyncio.run(zipfs._ls("35VLH/2025", detail=False)) == ["/35VLH/2025/group", "/35VLH/2025/zarr.json"]
+    assert asyncio.run(zipfs._ls("35VLH/2024/other/file")) == [{"name": "/35VLH/2024/other/file", "type": "file", "size": 5, "created": None, "islink": False}]
+    expected = sorted([f"35VLH/2024/{name}" for name in FILES] + ["35VLH/2025/zarr.json", "35VLH/2025/group/c/0/0"])
+    assert sorted(path.lstrip("/") for path in asyncio.run(zipfs._find(""))) == expected
+
+def test_sharded_missing_key(tmp_path):
+    zipfs = open_sharded_zipfs(tmp_path)
+    for path in ["35VLH/2024/missing", "35VLH/2026/zarr.json", "35VLH/2024", "zarr.json"]:
+        with pytest.raises(FileNotFoundError):
+            asyncio.run(zipfs._cat_file(path))
+    for path in ["35VLH/2026", "35VLH/2024/missing"]:
+        with pytest.raises(FileNotFoundError):
+            asyncio.run(zipfs._ls(path))
+    with pytest.raises(FileNotFoundError):
+        asyncio.run(zipfs._cat_ranges(["35VLH/2024/zarr.json", "35VLH/2026/zarr.json"], None, None, on_error="raise"))
+    datas = asyncio.run(zipfs._cat_ranges(["35VLH/2024/zarr.json", "35VLH/2026/zarr.json"], None, None))
+    assert datas[0] == FILES["zarr.json"] and isinstance(datas[1], FileNotFoundError)
+
+def open_fds(path):
+    return [fd for fd in os.listdir("/proc/self/fd") if os.path.realpath(f"/proc/self/fd/{fd}") == str(path)]
+
+def open_mmap_zipfs(zip_path):
+    zipfs = ReadOnlyZipFileSystem(AsyncFileSystemWrapper(LocalFileSystem()), str(zip_path), use_mmap=True)
+    assert bytes(asyncio.run(zipfs._cat_file("group/c/1/0"))) == FILES["group/c/1/0"]
+    assert len(open_fds(zip_path)) == 1
+    return zipfs
+
+def test_mmap_close(tmp_path):
+    write_zip(tmp_path / "a.zip", FILES)
+    zipfs = open_mmap_zipfs(tmp_path / "a.zip")
+    zipfs.close()
+    assert open_fds(tmp_path / "a.zip") == []
+    # A later read maps the zip file again
+    assert bytes(asyncio.run(zipfs._cat_file("other/file"))) == FILES["other/file"]
+    zipfs.close()
+    assert open_fds(tmp_path / "a.zip") == []
+
+def test_mmap_close_with_views_in_use(tmp_path):
+    write_zip(tmp_path / "a.zip", FILES)
+    zipfs = open_mmap_zipfs(tmp_path / "a.zip")
+    data = asyncio.run(zipfs._cat_file("other/file"))
+    zipfs.close()
+    assert bytes(data) == FILES["other/file"]
+    del data
+    assert open_fds(tmp_path / "a.zip") == []
+
+def test_mmap_closed_on_garbage_collection(tmp_path):
+    write_zip(tmp_path / "a.zip", FILES)
+    zipfs = open_mmap_zipfs(tmp_path / "a.zip")
+    del zipfs
+    gc.collect()
+    assert open_fds(tmp_path / "a.zip") == []
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import zarr
+from sentinel2_l1c.benchmark_patch_load import decode_cf_times, get_time_slice, get_zipzarr_store, parse_zip_shards
+from zip_writer import pack_folder
+
+TIMES = np.array(["2024-01-01", "2024-01-03", "2024-01-03", "2024-01-05", "2024-01-07"], dtype="datetime64[ns]")
+
+def day(date):
+    return np.datetime64(date, "ns")
+
+def test_time_slice_no_bounds():
+    assert get_time_slice(TIMES) == slice(0, 5)
+    assert get_time_slice(TIMES[:0]) == slice(0, 0)
+
+def test_time_slice_start_inclusive_end_exclusive():
+    assert get_time_slice(TIMES, day("2024-01-03"), day("2024-01-05")) == slice(1, 3)
+    assert get_time_slice(TIMES, day("2024-01-02"), day("2024-01-06")) == slice(1, 4)
+    assert get_time_slice(TIMES, time_start=day("2024-01-05")) == slice(3, 5)
+    assert get_time_slice(TIMES, time_end=day("2024-01-05")) == slice(0, 3)
+
+def test_time_slice_equal_times():
+    assert get_time_slice(TIMES, day("2024-01-03"), day("2024-01-04")) == slice(1, 3)
+    assert get_time_slice(TIMES, day("2024-01-03"), day("2024-01-03")) == slice(1, 1)
+
+def test_time_slice_outside_window():
+    assert get_time_slice(TIMES, day("2023-01-01"), day("2023-12-31")) == slice(0, 0)
+    assert get_time_slice(TIMES, day("2024-01-08"), day("2024-02-01")) == slice(5, 5)
+    assert len(TIMES[get_time_slice(TIMES, day("2024-01-06"), day("2024-01-04"))]) == 0
+
+def test_time_slice_unsorted():
+    with pytest.raises(ValueError):
+        get_time_slice(TIMES[::-1])
+
+def test_decode_cf_times():
+    times = decode_cf_times([0, 86400], "seconds since 2024-01-01")
+    assert list(times) == [np.datetime64("2024-01-01T00:00:00"), np.datetime64("2024-01-02T00:00:00")]
+    assert decode_cf_times([2], "days since 2024-01-01 00:00:00")[0] == np.datetime64("2024-01-03")
+
+def test_time_slice_legacy_string_times():
+    times = np.array(["2024-01-01T10:00:00", "2024-01-03T10:00:00"])
+    with pytest.raises(ValueError, match="convert to a new Zarr folder"):
+        get_time_slice(times, day("2024-01-02"))
+    # Without a time window, the times are not compared to the bounds
+    assert get_time_slice(times) == slice(0, 2)
+
+def test_decode_legacy_string_times():
+    with pytest.raises(ValueError, match="convert to a new Zarr folder"):
+        decode_cf_times(np.array(["2024-01-01T10:00:00"]), None)
+    with pytest.raises(ValueError, match="convert to a new Zarr folder"):
+        decode_cf_times([0], None)
+    with pytest.raises(ValueError, match="convert to a new Zarr folder"):
+        decode_cf_times([0], "fortnights since 2024-01-01")
+
+def test_parse_zip_shards():
+    assert parse_zip_shards("/data/zarr.zip") == "/data/zarr.zip"
+    assert parse_zip_shards("35VLH/2024=/data/2024.zip  35VLH/2025=/data/2025.zip") == {"35VLH/2024": "/data/2024.zip", "35VLH/2025": "/data/2025.zip"}
+
+def test_sharded_zipzarr_store(tmp_path):
+    # One shard per year, mounted at the tile/year path opened by the benchmark
+    zip_paths = {}
+    for year in [2024, 2025]:
+        zarr.open_group(str(tmp_path / str(year)), mode="w").create_array("B01", shape=(4, 4), dtype="uint16", chunks=(2, 2))[:] = year
+        pack_folder(str(tmp_path / str(year)), str(tmp_path / f"{year}.zip"))
+        zip_paths[f"35VLH/{year}"] = str(tmp_path / f"{year}.zip")
+    zarr_store = get_zipzarr_store(zip_paths)
+    for year in [2024, 2025]:
+        assert (zarr.open_group(store=zarr_store, path=f"35VLH/{year}", mode="r")["B01"][:] == year).all()
+    with pytest.raises(ValueError):
+        get_zipzarr_store(zip_paths, async_zipfs=False)
@@ -0,0 +1,66 @@
+import json
+import numpy as np
+import pytest
+from sentinel2_l1c.benchmark_report import get_report_rows, get_statistics, load_benchmark_logs
+
+def test_statistics():
+    durations = [1.0, 2.0, 3.0, 4.0, 10.0]
+    statistics = get_statistics(np.random.default_rng(0), durations, 0.95, 1000)
+    assert statistics["n"] == 5
+    assert statistics["mean"] == pytest.approx(4.0)
+    assert statistics["std"] == pytest.approx(np.sqrt(12.5))  # Sample standard deviation, ddof=1
+    assert statistics["stderr"] == pytest.approx(np.sqrt(12.5 / 5))
+    assert statistics["ci_low"] <= statistics["mean"] <= statistics["ci_high"]
+    assert 1.0 <= statistics["ci_low"] and statistics["ci_high"] <= 10.0
+    assert statistics["p50"] == pytest.approx(3.0)
+    assert statistics["p50"] <= statistics["p90"] <= statistics["p99"] <= statistics["max"]
+    assert (statistics["min"], statistics["max"]) == (1.0, 10.0)
+
+def test_statistics_single_duration():
+    statistics = get_statistics(np.random.default_rng(0), [2.5], 0.95, 100)
+    assert statistics["n"] == 1
+    assert statistics["std"] == 0.0 and statistics["stderr"] == 0.0
+    assert statistics["ci_low"] == statistics["ci_high"] == statistics["p99"] == 2.5
+
+def write_log(path, log):
+    path.write_text(json.dumps(log))
+    return path
+
+def test_loader_and_patch_load_logs_not_pooled(tmp_path):
+    results = {"local": {"zarr": {"durations": [1.0, 2.0]}}}
+    write_log(tmp_path / "sentinel2_l1c_patch_load.json", {"tile": "T", "year": 2024, "results": results})
+    write_log(tmp_path / "sentinel2_l1c_loader.json", {"tile": "T", "years": [2024], "results": results})
+    write_log(tmp_path / "sentinel2_l1c_concurrent.json", {"tile": "T", "results": {"local": {"zarr": {"loads_per_second": 1.0}}}})
+    logs = load_benchmark_logs([tmp_path])
+    assert len(logs) == 2
+    rows = get_report_rows(logs, num_bootstrap=100)
+    assert [(row["benchmark"], row["year"], row["n"]) for row in rows] == [("loader", "2024", 2), ("patch_load", "2024", 2)]
+
+def test_baseline_comparison(tmp_path):
+    baseline = write_log(tmp_path / "baseline.json", {"tile": "T", "year": 2024, "results": {"local": {"zarr": {"durations": [1.0, 1.1, 0.9, 1.0]}}}})
+    write_log(tmp_path / "sentinel2_l1c_slow.json", {"tile": "T", "year": 2024, "results": {"local": {"zarr": {"durations": [2.0, 2.1, 1.9, 2.0]}}}})
+    logs = load_benchmark_logs([tmp_path, baseline])
+    rows = get_report_rows(logs, baseline=str(baseline.resolve()), num_bootstrap=100, threshold=0.1)
+    assert len(rows) == 1
+    assert rows[0]["n"] == 4
+    assert rows[0]["change"] == pytest.approx(1.0)
+    assert rows[0]["flag"] == "regression"
+
+def test_cache_modes_and_settings_not_pooled(tmp_path):
+    results = {"s3": {"zipzarr": {"durations": [1.0, 2.0]}}}
+    zipfs = {"async": True, "index_cache": False, "block_cache_mib": 0, "mmap": False, "max_concurrency": 0, "hedge_quantile": 0}
+    log = {"tile": "T", "year": 2024, "cache_mode": "cold", "s3": {"standin": False}, "zipfs": zipfs, "results": results}
+    write_log(tmp_path / "sentinel2_l1c_cold.json", log)
+    write_log(tmp_path / "sentinel2_l1c_warm.json", {**log, "cache_mode": "warm"})
+    write_log(tmp_path / "sentinel2_l1c_standin.json", {**log, "s3": {"standin": True, "standin_latency_ms": 20}})
+    write_log(tmp_path / "sentinel2_l1c_block_cache.json", {**log, "zipfs": {**zipfs, "block_cache_mib": 64}})
+    write_log(tmp_path / "sentinel2_l1c_cold_again.json", log)
+    rows = get_report_rows(load_benchmark_logs([tmp_path]), num_bootstrap=100)
+    assert len(rows) == 4
+    assert sorted((row["cache_mode"], row["s3"], row["n"]) for row in rows) == [
+        ("cold", "s3", 2),
+        ("cold", "s3", 4),
+        ("cold", "standin=True standin_latency_ms=20", 2),
+        ("warm", "s3", 2)
+    ]
+    assert len({row["zipfs"] for row in rows}) == 2
@@ -0,0 +1,79 @@
+import asyncio
+import json
+from sentinel2_l1c.repack_zipzarr import get_layout_order, morton_key, parse_chunk_key, repack_zipzarr
+from zip_writer import StoredZipWriter
+from test_zip_writer import open_zipfs, read_all
+
+ARRAY_METADATA = {
+    "node_type": "array",
+    "shape": [8, 2, 4, 4],
+    "dimension_names": ["time", "band", "y", "x"],
+    "chunk_key_encoding": {"name": "default", "configuration": {"separator": "/"}}
+}
+
+def get_zarr_files():
+    """Files of a small zipped Zarr with one array of 2 x 1 x 2 x 2 chunks, in an order unrelated to the layout."""
+    files = {
+        "zarr.json": json.dumps({"node_type": "group"}).encode(),
+        "T/2024/B01/zarr.json": json.dumps({"node_type": "group"}).encode(),
+        "T/2024/B01/data/zarr.json": json.dumps(ARRAY_METADATA).encode()
+    }
+    for t in range(2):
+        for y in range(2):
+            for x in range(2):
+                files[f"T/2024/B01/data/c/{t}/0/{y}/{x}"] = f"{t}{y}{x}".encode()
+    return files
+
+def test_morton_key():
+    assert [morton_key((y, x)) for y in range(2) for x in range(2)] == [0, 2, 1, 3]
+    assert morton_key((3, 3)) == 15
+
+def test_parse_chunk_key():
+    assert parse_chunk_key(ARRAY_METADATA, "c/1/0/2/3") == [1, 0, 2, 3]
+    assert parse_chunk_key(ARRAY_METADATA, "zarr.json") is None
+    assert parse_chunk_key(ARRAY_METADATA, "c/1/0/2") is None
+    dot_metadata = {**ARRAY_METADATA, "chunk_key_encoding": {"name": "v2", "configuration": {"separator": "."}}}
+    assert parse_chunk_key(dot_metadata, "1.0.2.3") == [1, 0, 2, 3]
+
+def test_layout_order():
+    files = get_zarr_files()
+    order = get_layout_order(list(files), {"T/2024/B01/data": ARRAY_METADATA})
+    # Metadata first, then the time chunks of each spatial chunk together, spatial chunks in Z-order
+    assert order[:3] == sorted(name for name in files if name.endswith("zarr.json"))
+    assert order[3:] == [
+        f"T/2024/B01/data/c/{t}/0/{y}/{x}"
+        for y, x in sorted([(0, 0), (0, 1), (1, 0), (1, 1)], key=morton_key)
+        for t in range(2)
+    ]
+    row_major_order = get_layout_order(list(files), {"T/2024/B01/data": ARRAY_METADATA}, spatial_order="row-major")
+    assert row_major_order[3:5] == ["T/2024/B01/data/c/0/0/0/0", "T/2024/B01/data/c/1/0/0/0"]
+
+def test_repack(tmp_path):
+    files = get_zarr_files()
+    with StoredZipWriter(tmp_path / "a.zip") as writer:
+        for name in reversed(list(files)):
+            writer.write_file(name, files[name])
+    num_files = asyncio.run(repack_zipzarr(open_zipfs(tmp_path / "a.zip"), tmp_path / "b.zip"))
+    assert num_files == len(files)
+    assert read_all(tmp_path / "b.zip") == files
+    # The repacked files are in the layout order
+    _, file_names, _, _ = asyncio.run(open_zipfs(tmp_path / "b.zip")._list_members())
+    assert file_names == get_layout_order(list(files), {"T/2024/B01/data": ARRAY_METADATA})
+
+def test_repack_keep_order_compacts_appends(tmp_path):
+    files = get_zarr_files()
+    with StoredZipWriter(tmp_path / "a.zip") as writer:
+        for name, data in files.items():
+            writer.write_file(name, data)
+    new_files = {"T/2024/B01/data/c/1/0/1/1": b"new", "T/2024/B01/data/zarr.json": files["T/2024/B01/data/zarr.json"]}
+    with StoredZipWriter(tmp_path / "a.zip", append=True) as writer:
+        for name, data in new_files.items():
+            writer.write_file(name, data)
+    files.update(new_files)
+    num_files = asyncio.run(repack_zipzarr(open_zipfs(tmp_path / "a.zip"), tmp_path / "b.zip", keep_order=True))
+    assert num_files == len(files)
+    assert read_all(tmp_path / "b.zip") == files
+    # Superseded entries and the gap file of the old central directory are left out
+    assert (tmp_path / "b.zip").stat().st_size < (tmp_path / "a.zip").stat().st_size
+    _, file_names, _, _ = asyncio.run(open_zipfs(tmp_path / "b.zip")._list_members())
+    assert sorted(file_names) == sorted(files)
@@ -0,0 +1,164 @@
+import asyncio
+import shutil
+import subprocess
+import zipfile
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+from fsspec.implementations.asyn_wrapper import AsyncFileSystemWrapper
+from async_zipfs import ReadOnlyZipFileSystem
+from zip_writer import StoredZipWriter, list_folder, pack_folder
+
+FILES = {
+    "zarr.json": b'{"node_type": "group"}',
+    "group/zarr.json": b'{"node_type": "array"}',
+    "group/c/0/0": bytes(range(256)) * 3,
+    "group/c/0/1": b"",
+    "group/c/1/0": b"x" * 1000,
+    "other/file": b"other"
+}
+
+def open_zipfs(zip_path):
+    return ReadOnlyZipFileSystem(AsyncFileSystemWrapper(LocalFileSystem()), str(zip_path))
+
+def is_gap_file(name):
+    return name.startswith(StoredZipWriter.GAP_FILE_PREFIX)
+
+def read_all(zip_path):
+    """Read all files of a zip with ReadOnlyZipFileSystem, as a dict of name -> data, without the gap files of appends."""
+    zipfs = open_zipfs(zip_path)
+    async def read():
+        _, file_names, _, _ = await zipfs._list_members()
+        file_names = [file_name for file_name in file_names if not is_gap_file(file_name)]
+        datas = await asyncio.gather(*[zipfs._cat_file(file_name) for file_name in file_names])
+        return {file_name: bytes(data) for file_name, data in zip(file_names, datas)}
+    return asyncio.run(read())
+
+def write_zip(zip_path, files):
+    with StoredZipWriter(zip_path) as writer:
+        for name, data in files.items():
+            writer.write_file(name, data)
+
+@pytest.fixture
+def zip64(monkeypatch):
+    """Lower the ZIP64 limits so that small zips use ZIP64 extra fields and the ZIP64 EOCD."""
+    monkeypatch.setattr(StoredZipWriter, "ZIP64_LIMIT", 100)
+    monkeypatch.setattr(StoredZipWriter, "ZIP64_COUNT_LIMIT", 3)
+
+def test_round_trip(tmp_path):
+    write_zip(tmp_path / "a.zip", FILES)
+    assert read_all(tmp_path / "a.zip") == FILES
+
+def test_round_trip_zip64(tmp_path, zip64):
+    write_zip(tmp_path / "a.zip", FILES)
+    assert b"PK\x06\x06" in (tmp_path / "a.zip").read_bytes()[-200:]  # ZIP64 EOCD
+    assert read_all(tmp_path / "a.zip") == FILES
+
+@pytest.mark.parametrize("use_zip64", [False, True])
+def test_readable_by_zipfile(tmp_path, monkeypatch, use_zip64):
+    if use_zip64:
+        monkeypatch.setattr(StoredZipWriter, "ZIP64_LIMIT", 100)
+        monkeypatch.setattr(StoredZipWriter, "ZIP64_COUNT_LIMIT", 3)
+    write_zip(tmp_path / "a.zip", FILES)
+    with zipfile.ZipFile(tmp_path / "a.zip") as zip_file:
+        assert zip_file.testzip() is None
+        assert {info.filename: zip_file.read(info) for info in zip_file.infolist() if not info.is_dir()} == FILES
+        # Each directory entry comes before its contents
+        names = zip_file.namelist()
+        for name in names:
+            parent = name.rstrip("/").rpartition("/")[0]
+            if parent:
+                assert names.index(f"{parent}/") < names.index(name)
+
+def test_listing(tmp_path):
+    write_zip(tmp_path / "a.zip", FILES)
+    zipfs = open_zipfs(tmp_path / "a.zip")
+    assert sorted(asyncio.run(zipfs._ls("/", detail=False))) == ["/group", "/other", "/zarr.json"]
+    listing = asyncio.run(zipfs._ls("group/c/0", detail=True))
+    assert {entry["name"]: entry["size"] for entry in listing} == {"/group/c/0/0": 768, "/group/c/0/1": 0}
+
+def test_empty_zip(tmp_path):
+    write_zip(tmp_path / "a.zip", {})
+    assert read_all(tmp_path / "a.zip") == {}
+
+def test_pack_folder(tmp_path):
+    for name, data in FILES.items():
+        (tmp_path / "folder" / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / "folder" / name).write_bytes(data)
+    assert list_folder(tmp_path / "folder") == sorted(FILES)
+    pack_folder(tmp_path / "folder", tmp_path / "a.zip")
+    assert read_all(tmp_path / "a.zip") == FILES
+
+def append_zip(zip_path, files):
+    with StoredZipWriter(zip_path, append=True) as writer:
+        for name, data in files.items():
+            writer.write_file(name, data)
+
+@pytest.mark.parametrize("use_zip64", [False, True])
+def test_append(tmp_path, monkeypatch, use_zip64):
+    if use_zip64:
+        monkeypatch.setattr(StoredZipWriter, "ZIP64_LIMIT", 100)
+        monkeypatch.setattr(StoredZipWriter, "ZIP64_COUNT_LIMIT", 3)
+    write_zip(tmp_path / "a.zip", FILES)
+    old_data = (tmp_path / "a.zip").read_bytes()
+    with zipfile.ZipFile(tmp_path / "a.zip") as zip_file:
+        cd_offset = zip_file.start_dir
+    new_files = {"group/c/1/0": b"y" * 10, "group/c/2/0": b"new", "new/file": b"new file"}
+    append_zip(tmp_path / "a.zip", new_files)
+    data = (tmp_path / "a.zip").read_bytes()
+    # The old entries are kept in place, and the old central directory and EOCD are the data of a gap file
+    assert data[:cd_offset] == old_data[:cd_offset]
+    with zipfile.ZipFile(tmp_path / "a.zip") as zip_file:
+        gap_info = zip_file.getinfo(f"{StoredZipWriter.GAP_FILE_PREFIX}{cd_offset}")
+        assert gap_info.header_offset == cd_offset
+        assert old_data.endswith(zip_file.read(gap_info))
+    assert read_all(tmp_path / "a.zip") == {**FILES, **new_files}
+
+def test_repeated_appends(tmp_path):
+    write_zip(tmp_path / "a.zip", FILES)
+    expected = dict(FILES)
+    for append_index in range(3):
+        new_files = {f"group/c/{append_index}/9": bytes([append_index]) * 50, "other/file": f"other {append_index}".encode()}
+        append_zip(tmp_path / "a.zip", new_files)
+        expected.update(new_files)
+        assert read_all(tmp_path / "a.zip") == expected
+    with zipfile.ZipFile(tmp_path / "a.zip") as zip_file:
+        # The last entry of each name has the current data
+        assert {info.filename: zip_file.read(info) for info in zip_file.infolist() if not info.is_dir() and not is_gap_file(info.filename)} == expected
+        assert sum(is_gap_file(name) for name in zip_file.namelist()) == 3
+
+@pytest.mark.parametrize("use_zip64", [False, True])
+def test_appended_zip_is_valid(tmp_path, monkeypatch, use_zip64):
+    if use_zip64:
+        monkeypatch.setattr(StoredZipWriter, "ZIP64_LIMIT", 100)
+        monkeypatch.setattr(StoredZipWriter, "ZIP64_COUNT_LIMIT", 3)
+    write_zip(tmp_path / "a.zip", FILES)
+    for append_index in range(2):
+        append_zip(tmp_path / "a.zip", {"group/c/1/0": bytes([append_index]) * 10, f"new/{append_index}": b"new"})
+    with zipfile.ZipFile(tmp_path / "a.zip") as zip_file:
+        assert zip_file.testzip() is None
+    if shutil.which("unzip") is not None:
+        result = subprocess.run(["unzip", "-t", str(tmp_path / "a.zip")], capture_output=True, text=True)
+        assert result.returncode == 0, result.stdout + result.stderr
+
+def test_append_to_empty_zip(tmp_path):
+    write_zip(tmp_path / "a.zip", {})
+    append_zip(tmp_path / "a.zip", FILES)
+    assert read_all(tmp_path / "a.zip") == FILES
+
+def test_append_rolls_back_on_exception(tmp_path):
+    write_zip(tmp_path / "a.zip", FILES)
+    old_data = (tmp_path / "a.zip").read_bytes()
+    with pytest.raises(RuntimeError):
+        with StoredZipWriter(tmp_path / "a.zip", append=True) as writer:
+            writer.write_file("group/c/1/0", b"lost")
+            raise RuntimeError("interrupted")
+    assert (tmp_path / "a.zip").read_bytes() == old_data
+
+def test_interrupted_append_is_recoverable(tmp_path):
+    write_zip(tmp_path / "a.zip", FILES)
+    writer = StoredZipWriter(tmp_path / "a.zip", append=True)
+    writer.write_file("group/c/1/0", b"lost")
+    writer.file.close()  # Killed before close: no new central directory
+    with open(tmp_path / "a.zip", "r+b") as file:
+        file.truncate(writer.old_size)
+    assert read_all(tmp_path / "a.zip") == FILES
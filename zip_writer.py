@@ -0,0 +1,309 @@
+import os
+import struct
+import time
+import zlib
+from pathlib import Path
+from typing import BinaryIO, List, Optional, Union
+from async_zipfs import parse_eocd, parse_central_directory
+
+class StoredZipWriter:
+    """A streaming writer of uncompressed zip files in the layout read by ReadOnlyZipFileSystem.
+
+    Writes ZIP_STORED (uncompressed) entries one at a time, directly after
+    each other without gaps and without data descriptors, so that the CD
+    entries appear in the same order as the file headers and the files. The
+    entry of each directory is written automatically before the first entry
+    inside it. ZIP64 extra fields, ZIP64 EOCD and ZIP64 EOCD locator are
+    written when sizes, offsets or the number of entries need them. Usage:
+
+    ```Python
+    with StoredZipWriter(ZIP_PATH) as writer:
+        writer.write_file("group/zarr.json", data)
+    ```
+
+    Each file is written as soon as write_file is called, so the data can be
+    streamed into the zip as it is produced. Only the CD entries, about 100
+    bytes per file, are kept in memory until close.
+
+    With append=True, an existing zip file in the same layout is opened and
+    new entries are written after its old CD and EOCD, which are left in
+    place. The old entries are kept in place and in the new CD, which lists
+    them before the new entries. A file written again with the same name is
+    therefore superseded but not removed: ReadOnlyZipFileSystem uses the last
+    entry of each name. The old CD and EOCD become the data of a stored gap
+    file named GAP_FILE_PREFIX + old CD offset in the root of the zip, listed
+    between the old and the new entries in the new CD, so that the offset of
+    the last old file can still be inferred from the next local header offset
+    and the zip stays valid for other zip tools. The cost of an append is
+    proportional to the new data and the CD size. Superseded entries, old CDs
+    and gap files can be reclaimed later by compaction (repack_zipzarr with
+    --keep_order). The new data is synced to disk before the new CD and EOCD
+    are written, and those are synced before the local header of the gap file
+    is written over the start of the old CD. If the writer is closed by an
+    exception, the zip file is truncated back to its old size. If the process
+    is killed before the new EOCD is written, the old CD and EOCD are intact
+    and the zip file can be restored by truncating it to its old size
+    (old_size).
+    """
+    ZIP64_LIMIT = 0xFFFFFFFF  # Sizes and offsets from this up need ZIP64
+    ZIP64_COUNT_LIMIT = 0xFFFF  # Numbers of entries from this up need ZIP64
+    MAX_ZIP_TAIL_READ = 64 * 1024  # Tail read for finding the EOCD when appending
+    GAP_FILE_PREFIX = '.zip_gap_'  # Name prefix of the files covering old CDs and EOCDs after appending
+
+    def __init__(self, file: Union[str, Path, BinaryIO], append: bool = False):
+        """Initialize the StoredZipWriter.
+
+        Args:
+            file: Path of the zip file to create (or to append to), or a
+                binary file object open for writing at the position where the
+                zip starts (or open for reading and writing, when appending).
+            append: Append to an existing zip file instead of creating one.
+        """
+        if isinstance(file, (str, Path)):
+            self.file = open(file, 'r+b' if append else 'wb')
+            self._own_file = True
+        else:
+            self.file = file
+            self._own_file = False
+        self.offset = 0  # Offset of the next local header
+        self.old_size = None  # Size of the zip file before appending
+        self._cd_entries = []  # Packed CD file headers with names and extra fields, or the old CD when appending
+        self._num_entries = 0  # Number of entries in self._cd_entries
+        self._dirs = {''}  # Written directories, root autocreated by readers
+        self._gap_local_header = None  # Offset and local header of the gap file, written at close when appending
+        localtime = time.localtime()
+        self._dos_time = localtime.tm_hour << 11 | localtime.tm_min << 5 | localtime.tm_sec // 2
+        self._dos_date = (localtime.tm_year - 1980) << 9 | localtime.tm_mon << 5 | localtime.tm_mday
+        if append:
+            self._open_for_append()
+
+    def _open_for_append(self):
+        """Read the CD of the existing zip file and position the file at its end, after the old EOCD."""
+        path = getattr(self.file, 'name', '<file>')
+        self.file.seek(0, os.SEEK_END)
+        file_size = self.file.tell()
+        self.file.seek(max(0, file_size - self.MAX_ZIP_TAIL_READ))
+        cd_offset, cd_size, cd_entries = parse_eocd(self.file.read(), path)
+        if cd_size > 0:
+            self.file.seek(cd_offset)
+            cd_data = self.file.read(cd_size)
+            # Validates the layout, which appending must preserve
+            index = parse_central_directory(cd_data, cd_offset, cd_entries, path)
+            self._cd_entries.append(cd_data)
+            self._num_entries = cd_entries
+            self._dirs.update(index.name(i) for i in range(len(index.names)) if index.is_dir(i))
+            if (index.sizes >= 0).any():
+                # The old CD and EOCD after the last old file become the data of a
+                # gap file whose local header at the old CD offset ends that file there
+                gap_name = f'{self.GAP_FILE_PREFIX}{cd_offset}'
+                # The size of the local header depends on the size of the gap file through ZIP64
+                header_size = len(self._pack_local_header(gap_name, file_size - cd_offset, 0, cd_offset, is_dir=False))
+                gap_size = file_size - cd_offset - header_size
+                if gap_size <= 0 or len(self._pack_local_header(gap_name, gap_size, 0, cd_offset, is_dir=False)) != header_size:
+                    raise NotImplementedError(f"Appending to a zip file with a CD and EOCD of {file_size - cd_offset} bytes not implemented, in {path}")
+                self.file.seek(cd_offset + header_size)
+                gap_data = self.file.read(gap_size)
+                crc = zlib.crc32(gap_data)
+                self._gap_local_header = (cd_offset, self._pack_local_header(gap_name, len(gap_data), crc, cd_offset, is_dir=False))
+                self._cd_entries.append(self._pack_cd_entry(gap_name, len(gap_data), crc, cd_offset, is_dir=False))
+                self._num_entries += 1
+        self.old_size = file_size
+        self.offset = file_size
+        self.file.seek(file_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.old_size is not None:
+            self.rollback()
+        else:
+            self.close()
+
+    def rollback(self):
+        """Discard the appended entries by truncating the zip file to its old size, keeping the old CD."""
+        if self.file is None:
+            return
+        self.file.seek(self.old_size)
+        self.file.truncate()
+        if self._own_file:
+            self.file.close()
+        self.file = None
+
+    def _pack_cd_entry(self, name: str, size: int, crc: int, header_offset: int, is_dir: bool) -> bytes:
+        """Pack a CD file header with its name and ZIP64 extra field."""
+        fname = name.encode('utf-8')
+        zip64_size = size >= self.ZIP64_LIMIT
+        zip64_offset = header_offset >= self.ZIP64_LIMIT
+        version_needed = 45 if zip64_size or zip64_offset else (10 if is_dir else 20)
+        flags = 0x800  # Bit 11: UTF-8 file name
+
+        # CD ZIP64 extra field contains only the values marked as ZIP64, in this order
+        zip64_values = ([size, size] if zip64_size else []) + ([header_offset] if zip64_offset else [])
+        cd_extra = struct.pack(f'<HH{len(zip64_values)}Q', 0x0001, 8*len(zip64_values), *zip64_values) if zip64_values else b''
+        cd_file_header = struct.pack(
+            '<LHHHHHHLLLHHHHHLL',
+            0x02014b50,  # central file header signature
+            3 << 8 | 45,  # version made by (UNIX, 4.5)
+            version_needed,  # version needed to extract
+            flags,  # general purpose bit flag
+            0,  # compression method (stored)
+            self._dos_time,  # last mod file time
+            self._dos_date,  # last mod file date
+            crc,  # crc-32
+            0xFFFFFFFF if zip64_size else size,  # compressed size
+            0xFFFFFFFF if zip64_size else size,  # uncompressed size
+            len(fname),  # file name length
+            len(cd_extra),  # extra field length
+            0,  # file comment length
+            0,  # disk number start
+            0,  # internal file attributes
+            (0o40755 << 16 | 0x10) if is_dir else (0o100644 << 16),  # external file attributes
+            0xFFFFFFFF if zip64_offset else header_offset  # relative offset of local header
+        )
+        return cd_file_header + fname + cd_extra
+
+    def _pack_local_header(self, name: str, size: int, crc: int, header_offset: int, is_dir: bool) -> bytes:
+        """Pack a local file header with its name and ZIP64 extra field."""
+        fname = name.encode('utf-8')
+        zip64_size = size >= self.ZIP64_LIMIT
+        zip64_offset = header_offset >= self.ZIP64_LIMIT
+
+        # Local header ZIP64 extra field must contain both sizes if either is ZIP64
+        local_extra = struct.pack('<HHQQ', 0x0001, 16, size, size) if zip64_size else b''
+        version_needed = 45 if zip64_size or zip64_offset else (10 if is_dir else 20)
+        flags = 0x800  # Bit 11: UTF-8 file name
+        local_header = struct.pack(
+            '<LHHHHHLLLHH',
+            0x04034b50,  # local file header signature
+            version_needed,  # version needed to extract
+            flags,  # general purpose bit flag
+            0,  # compression method (stored)
+            self._dos_time,  # last mod file time
+            self._dos_date,  # last mod file date
+            crc,  # crc-32
+            0xFFFFFFFF if zip64_size else size,  # compressed size
+            0xFFFFFFFF if zip64_size else size,  # uncompressed size
+            len(fname),  # file name length
+            len(local_extra)  # extra field length
+        )
+        return local_header + fname + local_extra
+
+    def _write_entry(self, name: str, data: bytes, is_dir: bool):
+        """Write a local header and data, and record the CD entry."""
+        size = len(data)
+        crc = zlib.crc32(data)
+        local_header = self._pack_local_header(name, size, crc, self.offset, is_dir)
+        self.file.write(local_header)
+        self.file.write(data)
+
+        self._cd_entries.append(self._pack_cd_entry(name, size, crc, self.offset, is_dir))
+        self._num_entries += 1
+        self.offset += len(local_header) + size
+
+    def write_dir(self, name: str):
+        """Write a directory entry, and the entries of its missing parent directories first."""
+        name = name.strip('/')
+        if name in self._dirs:
+            return
+        self.write_dir(name.rpartition('/')[0])
+        self._write_entry(f'{name}/', b'', is_dir=True)
+        self._dirs.add(name)
+
+    def write_file(self, name: str, data: bytes):
+        """Write a file entry, and the entries of its missing parent directories first."""
+        name = name.strip('/')
+        self.write_dir(name.rpartition('/')[0])
+        self._write_entry(name, data, is_dir=False)
+
+    def close(self):
+        """Write the central directory and the end of central directory records."""
+        if self.file is None:
+            return
+        if self.old_size is not None and self._own_file:
+            # Make the appended data durable before the new CD makes it visible
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        cd_offset = self.offset
+        cd_data = b''.join(self._cd_entries)
+        self.file.write(cd_data)
+        cd_size = len(cd_data)
+        cd_entries = self._num_entries
+        zip64 = cd_entries >= self.ZIP64_COUNT_LIMIT or cd_size >= self.ZIP64_LIMIT or cd_offset >= self.ZIP64_LIMIT
+        if zip64:
+            zip64_eocd_offset = cd_offset + cd_size
+            self.file.write(struct.pack(
+                '<LQHHLLQQQQ',
+                0x06064b50,  # zip64 end of central dir signature
+                44,  # size of zip64 end of central directory record
+                3 << 8 | 45,  # version made by
+                45,  # version needed to extract
+                0,  # number of this disk
+                0,  # number of the disk with the start of the central directory
+                cd_entries,  # total number of entries in the central directory on this disk
+                cd_entries,  # total number of entries in the central directory
+                cd_size,  # size of the central directory
+                cd_offset  # offset of start of central directory with respect to the starting disk number
+            ))
+            self.file.write(struct.pack(
+                '<LLQL',
+                0x07064b50,  # zip64 end of central dir locator signature
+                0,  # number of the disk with the start of the zip64 end of central directory
+                zip64_eocd_offset,  # relative offset of the zip64 end of central directory record
+                1  # total number of disks
+            ))
+        self.file.write(struct.pack(
+            '<LHHHHLLH',
+            0x06054b50,  # end of central dir signature
+            0,  # number of this disk
+            0,  # number of the disk with the start of the central directory
+            0xFFFF if zip64 else cd_entries,  # total number of entries in the central directory on this disk
+            0xFFFF if zip64 else cd_entries,  # total number of entries in the central directory
+            0xFFFFFFFF if zip64 else cd_size,  # size of the central directory
+            0xFFFFFFFF if zip64 else cd_offset,  # offset of start of central directory with respect to the starting disk number
+            0  # .ZIP file comment length
+        ))
+        if self._gap_local_header is not None:
+            # Make the new CD and EOCD durable before the old CD is overwritten
+            self.file.flush()
+            if self._own_file:
+                os.fsync(self.file.fileno())
+            gap_offset, gap_local_header = self._gap_local_header
+            self.file.seek(gap_offset)
+            self.file.write(gap_local_header)
+        if self._own_file:
+            self.file.close()
+        self.file = None
+
+def list_folder(folder: Union[str, Path]) -> List[str]:
+    """List the files in a folder recursively, as sorted relative POSIX paths."""
+    folder = Path(folder)
+    return sorted(path.relative_to(folder).as_posix() for path in folder.rglob('*') if path.is_file())
+
+def list_modified(folder: Union[str, Path], since: float) -> List[str]:
+    """List the files in a folder recursively that were modified after since (a POSIX timestamp), as sorted relative POSIX paths."""
+    folder = Path(folder)
+    return sorted(path.relative_to(folder).as_posix() for path in folder.rglob('*') if path.is_file() and path.stat().st_mtime > since)
+
+def pack_folder(folder: Union[str, Path], zip_path: Union[str, Path], names: Optional[List[str]] = None, progress=None, append: bool = False):
+    """Pack the files in a folder (for example a Zarr) into an uncompressed zip file.
+
+    The files are streamed into the zip one at a time, in the order of names
+    (default: sorted relative paths), with each directory entry written before
+    its contents. The result can be read by ReadOnlyZipFileSystem.
+
+    Args:
+        folder: Folder to pack.
+        zip_path: Path of the zip file to create.
+        names: Relative POSIX paths of the files to pack, in the order to pack them.
+        progress: Optional progressbar.ProgressBar updated with the number of packed files.
+        append: Append the files to an existing zip file, superseding entries of the same names.
+    """
+    if names is None:
+        names = list_folder(folder)
+    with StoredZipWriter(zip_path, append=append) as writer:
+        for name_index, name in enumerate(names):
+            with open(os.path.join(folder, name), 'rb') as file:
+                writer.write_file(name, file.read())
+            if progress is not None:
+                progress.update(name_index + 1)